@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized scoring of gaze samples against areas of interest (AOIs)
+
+Any number of rectangular and circular AOIs, each with its own time window,
+are evaluated for both eyes in one pass over a block of gaze samples.
+Lost samples (NaN) are handled explicitly: they either count as outside the
+AOI ('outside') or are left out of the proportion ('exclude').
+
+@author: Marcus
+"""
+
+import numpy as np
+
+RECT, CIRCLE = 0, 1
+
+
+# %%
+class AOIs:
+    '''
+    Set of rectangular and circular AOIs (in the units of the gaze data)
+    '''
+    def __init__(self):
+        self.centers = np.zeros((0, 2))
+        self.half_sizes = np.zeros((0, 2))  # Radius in both columns for circles
+        self.shapes = np.zeros(0, dtype=int)
+        self.time_ranges = np.zeros((0, 2))
+        self.names = []
+
+    def _add(self, shape, center, half_size, time_range, name):
+        if time_range is None:
+            time_range = (-np.inf, np.inf)
+        self.centers = np.vstack([self.centers, center])
+        self.half_sizes = np.vstack([self.half_sizes, half_size])
+        self.shapes = np.append(self.shapes, shape)
+        self.time_ranges = np.vstack([self.time_ranges, time_range])
+        self.names.append(name)
+        return len(self.names) - 1
+
+    def add_rect(self, center, half_width, half_height=None, time_range=None,
+                 name=None):
+        ''' Adds a rectangle centered on center
+
+        Args:
+            center (x, y): center of the AOI
+            half_width, half_height: half the size of the AOI (a sample is
+                inside if strictly within center +- half size)
+            time_range (t_start, t_stop): only samples with
+                t_start <= t < t_stop are scored against this AOI
+            name (str): optional name
+
+        Returns:
+            index of the AOI
+        '''
+        if half_height is None:
+            half_height = half_width
+        return self._add(RECT, center, (half_width, half_height), time_range,
+                         name)
+
+    def add_circle(self, center, radius, time_range=None, name=None):
+        ''' Adds a circle (see add_rect) and returns its index '''
+        return self._add(CIRCLE, center, (radius, radius), time_range, name)
+
+    def __len__(self):
+        return len(self.names)
+
+
+# %%
+def inside_aois(xy, aois):
+    ''' Which samples are inside which AOI
+
+    Args:
+        xy (N x E x 2 array): gaze position for E eyes (NaN is lost)
+        aois (AOIs): the AOIs
+
+    Returns:
+        inside (A x N x E bool array)
+    '''
+    d = xy[np.newaxis] - aois.centers[:, np.newaxis, np.newaxis, :]
+    d = np.abs(d, out=d)
+    half = aois.half_sizes[:, np.newaxis, np.newaxis, :]
+
+    in_rect = np.all(d < half, axis=-1)
+    in_circle = np.sum(d**2, axis=-1) < half[..., 0]**2
+    is_circle = (aois.shapes == CIRCLE)[:, np.newaxis, np.newaxis]
+
+    return np.where(is_circle, in_circle, in_rect)
+
+def score_aois(xy, aois, t=None, lost='outside'):
+    ''' Proportion of samples inside each AOI, per eye
+
+    Args:
+        xy (N x E x 2 array): gaze position for E eyes (NaN is lost)
+        aois (AOIs): the AOIs
+        t (N array): time stamps of the samples, used for the time range
+            of each AOI (None is all samples for all AOIs)
+        lost (str): 'outside' counts lost samples as outside the AOI,
+            'exclude' leaves them out of the proportion
+
+    Returns:
+        proportion (A x E array, NaN if there are no samples),
+        n_valid (A x E array), number of non-lost samples in each window
+    '''
+    assert lost in ['outside', 'exclude'], f'Unknown value for lost: {lost}'
+    xy = np.asarray(xy, dtype=float)
+
+    if t is None:
+        in_window = np.ones((len(aois), len(xy)), dtype=bool)
+    else:
+        t = np.asarray(t)
+        in_window = ((t[np.newaxis] >= aois.time_ranges[:, [0]]) &
+                     (t[np.newaxis] < aois.time_ranges[:, [1]]))
+
+    valid = ~np.any(np.isnan(xy), axis=-1)                       # N x E
+    inside = inside_aois(xy, aois) & in_window[..., np.newaxis]  # A x N x E
+
+    n_inside = inside.sum(axis=1)
+    n_valid = (in_window[..., np.newaxis] & valid[np.newaxis]).sum(axis=1)
+    if lost == 'outside':
+        n = np.repeat(in_window.sum(axis=1)[:, np.newaxis], xy.shape[1], axis=1)
+    else:
+        n = n_valid
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        proportion = n_inside / n
+
+    return proportion, n_valid
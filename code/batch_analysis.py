@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Batch analysis of all sessions in a directory
+
+Finds the Titta data files (.h5) of all sessions, analyzes them in a process
+pool with session_analysis.analyze_session() and writes one table with a
+row per trial and session. Results are cached per session, keyed on a hash
+of the input file, the pipeline version and the analysis settings, so that
+re-runs only analyze new or changed sessions.
+
+Usage:
+    python batch_analysis.py <data dir> [-o results.tsv] [-j n_processes]
+        [--cache-dir dir] [--set aoi_radius=2.5 ...]
+
+@author: Marcus
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import session_analysis
+
+
+# %%
+def find_sessions(data_dir):
+    ''' Titta data files (.h5) in data_dir and its subfolders '''
+    return sorted(Path(data_dir).rglob('*.h5'))
+
+
+def file_hash(filename):
+    ''' Hash of the contents of a file '''
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ResultCache:
+    '''
+    Cached per-session results, keyed on input hash, pipeline version and settings
+    '''
+    def __init__(self, folder, settings):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        desc = json.dumps({'version': session_analysis.PIPELINE_VERSION,
+                           'settings': settings}, sort_keys=True)
+        self.pipeline_key = hashlib.sha1(desc.encode('utf-8')).hexdigest()[:12]
+
+        # path -> (size, mtime, hash), so unchanged files are not hashed again
+        self._index_file = self.folder / 'file_index.json'
+        try:
+            with open(self._index_file, 'r') as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {}
+
+    def input_hash(self, filename):
+        st = os.stat(filename)
+        entry = self._index.get(str(filename))
+        if entry is not None and entry[:2] == [st.st_size, st.st_mtime]:
+            return entry[2]
+        h = file_hash(filename)
+        self._index[str(filename)] = [st.st_size, st.st_mtime, h]
+        return h
+
+    def save_index(self):
+        with open(self._index_file, 'w') as f:
+            json.dump(self._index, f)
+
+    def path(self, input_hash):
+        return self.folder / f'{input_hash}_{self.pipeline_key}.pkl'
+
+    def load(self, input_hash):
+        try:
+            with open(self.path(input_hash), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def store(self, input_hash, result):
+        path = self.path(input_hash)
+        temp_path = path.with_name(path.name + '.tmp')
+        with open(temp_path, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(temp_path, path)
+
+
+def _analyze(gaze_file, settings):
+    ''' Runs in a worker process '''
+    return session_analysis.analyze_session(gaze_file, settings)
+
+
+def with_session(result, gaze_file):
+    ''' The result of a session with its name (the stem of its file)
+
+    The name is not part of the cached result, which is keyed on the
+    contents of the file only, so a renamed or copied file gets its own name.
+    '''
+    df = result.drop(columns='session', errors='ignore')
+    df.insert(0, 'session', Path(gaze_file).stem)
+    return df
+
+
+# %%
+def run_batch(data_dir, output, n_processes=None, cache_dir=None,
+              settings=None):
+    ''' Analyzes all sessions in data_dir and writes one table to output
+
+    Returns:
+        DataFrame with the results of all sessions
+    '''
+    import pandas as pd
+
+    settings = {**session_analysis.DEFAULT_SETTINGS, **(settings or {})}
+    cache = ResultCache(cache_dir or Path(data_dir) / '.analysis_cache',
+                        settings)
+
+    results, todo = {}, {}
+    for gaze_file in find_sessions(data_dir):
+        h = cache.input_hash(gaze_file)
+        result = cache.load(h)
+        if result is None:
+            todo[gaze_file] = h
+        else:
+            results[gaze_file] = with_session(result, gaze_file)
+    cache.save_index()
+    print(f'{len(results)} sessions cached, {len(todo)} to analyze')
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=n_processes) as pool:
+            futures = {pool.submit(_analyze, str(f), settings): f for f in todo}
+            for future in as_completed(futures):
+                gaze_file = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f'Failed: {gaze_file} ({e})')
+                    continue
+                cache.store(todo[gaze_file], result)
+                results[gaze_file] = with_session(result, gaze_file)
+                print(f'Analyzed: {gaze_file}')
+
+    frames = [results[f] for f in sorted(results)]
+    table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    table.to_csv(output, sep='\t', index=False)
+    print(f'{len(table)} trials from {len(frames)} sessions -> {output}')
+
+    return table
+
+
+def parse_settings(pairs):
+    ''' ['aoi_radius=2.5', ...] -> {'aoi_radius': 2.5, ...} '''
+    settings = {}
+    for pair in pairs or []:
+        key, value = pair.split('=', 1)
+        if key not in session_analysis.DEFAULT_SETTINGS:
+            raise ValueError(f'Unknown setting: {key}')
+        settings[key] = type(session_analysis.DEFAULT_SETTINGS[key])(value)
+    return settings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze all sessions in a directory')
+    parser.add_argument('data_dir')
+    parser.add_argument('-o', '--output', default='results.tsv')
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--set', nargs='*', default=[],
+                        help='analysis settings, e.g., aoi_radius=2.5')
+    args = parser.parse_args(argv)
+
+    run_batch(args.data_dir, args.output, args.processes, args.cache_dir,
+              parse_settings(args.set))
+
+if __name__ == '__main__':
+    main()
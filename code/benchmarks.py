@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths of the experiment
+
+Runs without PsychoPy, a display or an eye tracker (see headless.py), e.g.,
+on a CI box. Run from the command line, e.g.,
+    python benchmarks.py
+    python benchmarks.py noise_scaling
+    python benchmarks.py -o results.tsv    # also save the results
+
+@author: Marcus
+"""
+
+import argparse
+import copy
+import csv
+import os
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+
+import headless
+import noise_helpers as helpers
+import aoi
+import frame_plan
+import frame_timing
+import noise_stream
+import noise_colour
+import saccade_detection
+import parameters as params
+from event_log import EventLog
+from gaze_monitor import GazeMonitor
+from noise_bank import NoiseTextureBank, PhiloxNoiseFrames
+
+RESULTS = []  # (name, ms, extra) of all reported benchmarks
+
+# (rows, cols) of the visual noise frames of the experiment
+VISUAL_NOISE_GRID = helpers.noise_grid_shape(params.visualNoiseSize,
+                                             params.visualNoiseCheckSize)
+
+
+# %%
+def timeit(fn, repeats=3):
+    ''' Best wall time (s) of repeats calls to fn '''
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def peak_memory(fn):
+    ''' Peak memory (MB) allocated by numpy/Python during a call to fn '''
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024**2
+
+def report(name, seconds, **extra):
+    extra_str = ''.join([f'  {k}={v}' for k, v in extra.items()])
+    print(f'{name:<40s} {seconds * 1000:10.2f} ms{extra_str}')
+    RESULTS.append((name, seconds * 1000, extra_str.strip()))
+
+
+# %%
+def bench_noise_scaling(fs_audio=48000, duration_auditory_noise=5 * 60,
+                        max_workers=None):
+    ''' Scaling of noise synthesis with the number of worker threads
+
+    The generated noise is checked to be identical for all numbers of workers.
+    '''
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    n_samples = fs_audio * duration_auditory_noise
+
+    workers = sorted({1, 2, 4, 8, max_workers} & set(range(1, max_workers + 1)))
+    reference_audio, reference_bank = None, None
+    t1_audio, t1_visual = None, None
+    for w in workers:
+        audio = helpers.generate_auditory_noise(n_samples, seed=1,
+                                                dtype=np.int16, workers=w)
+        bank = NoiseTextureBank.generate(params.mask_duration,
+                                         VISUAL_NOISE_GRID, seed=1,
+                                         workers=w)
+        if reference_audio is None:
+            reference_audio, reference_bank = audio, bank.data
+        assert np.array_equal(audio, reference_audio), 'Audio depends on workers'
+        assert np.array_equal(bank.data, reference_bank), 'Bank depends on workers'
+        del audio, bank
+
+        t_audio = timeit(lambda: helpers.generate_auditory_noise(
+            n_samples, seed=1, dtype=np.int16, workers=w))
+        t_visual = timeit(lambda: NoiseTextureBank.generate(
+            params.mask_duration, VISUAL_NOISE_GRID, seed=1, workers=w))
+        t1_audio = t1_audio or t_audio
+        t1_visual = t1_visual or t_visual
+
+        report(f'auditory noise {duration_auditory_noise} s, {w} workers',
+               t_audio, speedup=f'{t1_audio / t_audio:.2f}')
+        report(f'visual noise {params.mask_duration} frames, {w} workers',
+               t_visual, speedup=f'{t1_visual / t_visual:.2f}')
+
+
+# %%
+class BenchMonitor:
+    ''' Stand-in for a PsychoPy monitor with the geometry in parameters.py '''
+    def getWidth(self):
+        return params.SCREEN_WIDTH
+
+    def getSizePix(self):
+        return params.SCREEN_RES
+
+    def getDistance(self):
+        return params.VIEWING_DIST
+
+def tobii2deg_reference(pos, mon):
+    ''' The original tobii2deg (deepcopy, monitor queries, cm2deg) '''
+    pos_temp = copy.deepcopy(pos)
+    pos_temp[:, 0] = pos_temp[:, 0] - 0.5
+    pos_temp[:, 1] = (pos_temp[:, 1] - 0.5) * -1
+    pos_temp[:, 0] = pos_temp[:, 0] * mon.getWidth()
+    pos_temp[:, 1] = pos_temp[:, 1] * mon.getWidth() * (float(mon.getSizePix()[1]) / \
+                                              float(mon.getSizePix()[0]))
+    return pos_temp / (mon.getDistance() * 0.017455)
+
+def bench_tobii2deg(fs=600, durations=(2, 60)):
+    ''' Original tobii2deg (per eye) vs. Tobii2Deg (stacked eyes, out=)
+
+    2 s is about the window scored after an MGS training trial,
+    60 s a PF trial. The conversion is memory bound: the original already
+    runs a few vectorized passes over the data, so on 60 s blocks the
+    speedup is only about 2x (float64) and 6-7x (float32), not an order of
+    magnitude. Most of the gain is on short blocks, where the monitor
+    queries and the deepcopy of the original dominate.
+    '''
+    mon = BenchMonitor()
+    rng = np.random.default_rng(0)
+    to_deg = helpers.Tobii2Deg(mon)
+
+    for duration in durations:
+        xy = rng.random((fs * duration, 2, 2))
+        left = np.ascontiguousarray(xy[:, 0])
+        right = np.ascontiguousarray(xy[:, 1])
+        xy32 = xy.astype(np.float32)
+        out, out32 = np.empty_like(xy), np.empty_like(xy32)
+
+        assert np.allclose(to_deg(xy)[:, 0], tobii2deg_reference(left, mon))
+
+        t_ref = timeit(lambda: (tobii2deg_reference(left, mon),
+                                tobii2deg_reference(right, mon)), repeats=20)
+        t_new = timeit(lambda: to_deg(xy, out=out), repeats=20)
+        t_new32 = timeit(lambda: to_deg(xy32, out=out32), repeats=20)
+
+        report(f'tobii2deg original, {duration} s at {fs} Hz', t_ref)
+        report(f'Tobii2Deg float64, {duration} s', t_new,
+               speedup=f'{t_ref / t_new:.1f}')
+        report(f'Tobii2Deg float32, {duration} s', t_new32,
+               speedup=f'{t_ref / t_new32:.1f}')
+
+
+# %%
+def bench_saccades(fs=600, duration=4 * (30 * 9 + 60)):
+    ''' Saccade detection on a full session (4 x 30 MGS trials + 4 x 60 s PF) '''
+    xy, onsets = headless.synthetic_gaze(fs * duration, fs)
+    saccades, thresholds = saccade_detection.detect_saccades(xy, fs)
+    t = timeit(lambda: saccade_detection.detect_saccades(xy, fs))
+    report(f'detect_saccades, {duration} s at {fs} Hz', t,
+           found=f'{len(saccades) // 2}/{len(onsets)}')
+
+    def stream():
+        detector = saccade_detection.SaccadeDetector(fs, thresholds=thresholds)
+        for i in range(0, len(xy), fs):
+            detector.process(xy[i:i + fs])
+        detector.flush()
+    report('SaccadeDetector, 1 s chunks', timeit(stream))
+
+
+# %%
+def bench_noise_throughput(fs_audio=48000, duration=60):
+    ''' Throughput and peak memory of auditory and visual noise generation '''
+    n_samples = fs_audio * duration
+    generate_audio = lambda: helpers.generate_auditory_noise(
+        n_samples, seed=1, dtype=np.int16)
+    t = timeit(generate_audio)
+    report(f'auditory noise {duration} s', t,
+           x_real_time=f'{duration / t:.0f}',
+           peak_MB=f'{peak_memory(generate_audio):.0f}')
+
+    # Visual noise with checks of 1x1, 2x2 and 4x4 pixels on the screen
+    for check_size in (1, 2, 4):
+        grid = helpers.noise_grid_shape(params.SCREEN_RES, check_size)
+        generate_bank = lambda: NoiseTextureBank.generate(
+            params.mask_duration, grid, seed=1)
+        t = timeit(generate_bank)
+        report(f'visual noise {params.mask_duration} frames, {check_size}x{check_size}', t,
+               frames_per_s=f'{params.mask_duration / t:.0f}',
+               peak_MB=f'{peak_memory(generate_bank):.0f}')
+
+def bench_noise_frames(n_frames=600, refresh_rate=60):
+    ''' Visual noise frames computed on demand (Philox) against the frame budget
+
+    The time per frame is that of the main thread: getting the frame (computed,
+    or prefetched by the worker thread) and converting it to a texture, or,
+    with VisualNoiseStream, taking the texture from its rolling buffer. The
+    upload of the texture to the graphics card is not included (there is no
+    OpenGL here), so these times are a lower bound; the frame timing on the
+    target hardware shows if the upload fits in the rest of the frame.
+    '''
+    budget = 1000 / refresh_rate
+    for check_size in (1, 2, 4):
+        grid = helpers.noise_grid_shape(params.SCREEN_RES, check_size)
+        for prefetch in (0, 2):
+            frames = PhiloxNoiseFrames(grid, seed=1, prefetch=prefetch)
+            texture = np.empty(grid, dtype=np.float32)
+            times = np.empty(n_frames)
+            def run():
+                for k in range(n_frames):
+                    t0 = time.perf_counter()
+                    frames.texture(k, out=texture)
+                    times[k] = time.perf_counter() - t0
+                    # Leave the worker the rest of the frame
+                    if prefetch:
+                        time.sleep(max(budget / 1000 - times[k], 0) / 2)
+            peak = peak_memory(run)
+            run()  # Timed without tracemalloc
+            frames.close()
+            report(f'noise frame {grid[1]}x{grid[0]}, prefetch {prefetch}',
+                   np.median(times), max_ms=f'{times.max() * 1000:.2f}',
+                   budget_ms=f'{budget:.1f}', peak_MB=f'{peak:.1f}')
+
+        frames = PhiloxNoiseFrames(grid, seed=1)
+        stream = helpers.VisualNoiseStream(headless.HeadlessWindow(None),
+                                           frames, check_size)
+        times = np.empty(n_frames)
+        for k in range(n_frames):
+            t0 = time.perf_counter()
+            stream[k]
+            times[k] = time.perf_counter() - t0
+            time.sleep(max(budget / 1000 - times[k], 0))
+        stream.close()
+        report(f'noise stream {grid[1]}x{grid[0]} (without upload)',
+               np.median(times), max_ms=f'{times.max() * 1000:.2f}',
+               budget_ms=f'{budget:.1f}', not_ready=stream.n_waits)
+
+def bench_noise_colour(fs_audio=48000, duration=60):
+    ''' Throughput and peak memory of coloured noise (overlap-add filtering) '''
+    n_samples = fs_audio * duration
+    for colour, band in [('pink', None), ('brown', None), ('white', (500, 4000))]:
+        generate = lambda: sum(len(chunk) for chunk in
+                               noise_colour.coloured_noise_chunks(
+                                   n_samples, colour, fs_audio, 1, band,
+                                   dtype=np.int16))
+        t = timeit(generate)
+        name = colour if band is None else f'{band[0]}-{band[1]} Hz'
+        report(f'{name} noise {duration} s', t,
+               x_real_time=f'{duration / t:.0f}',
+               peak_MB=f'{peak_memory(generate):.1f}')
+
+def bench_noise_stream(fs_audio=48000, block_size=512, duration=60,
+                       duration_realtime=5):
+    ''' Streamed auditory noise: producer throughput, and underruns and
+    callback time when played (to the headless sink) in real time
+    '''
+    stream = noise_stream.NoiseStream(noise_stream.white_noise_source(1),
+                                      fs_audio, block_size)
+    n_blocks = int(duration * fs_audio / block_size)
+    def produce():
+        for k, _ in zip(range(n_blocks), stream._blocks()):
+            pass
+    t = timeit(produce)
+    report(f'noise stream producer {duration} s', t,
+           x_real_time=f'{duration / t:.0f}',
+           peak_MB=f'{peak_memory(produce):.1f}')
+
+    sink = noise_stream.HeadlessSink(stream)
+    def play():
+        sink.play()
+        sink.run(duration_realtime)
+        sink.stop()
+    peak = peak_memory(play)
+    summary = sink.summary()
+    report(f'noise stream played {duration_realtime} s', summary['callback_mean_ms'] / 1000,
+           callbacks=summary['callbacks'], underruns=summary['underruns'],
+           callback_max_ms=f"{summary['callback_max_ms']:.3f}",
+           peak_MB=f'{peak:.1f}')
+
+def bench_frame_loop(n_frames=3600, refresh_rate=60):
+    ''' Overhead per frame of run_plan (draw calls, markers, flip timing) '''
+    win = headless.HeadlessWindow(headless.VirtualClock(), refresh_rate)
+    stims = [headless.HeadlessStim(win) for _ in range(3)]
+    noise = [headless.HeadlessStim(win) for _ in range(params.mask_duration)]
+    n = n_frames // 4
+    phases = [frame_plan.Phase('fixation_point', n, stims=stims[:1]),
+              frame_plan.Phase('flash', n, stims=stims[:2]),
+              frame_plan.Phase('memory_delay', n, stims=stims[:1]),
+              frame_plan.Phase('saccade_window', n, overlay=stims[2:])]
+    plan = frame_plan.compile_plan(phases, params.mask_duration)
+    timer = frame_timing.FlipTimer(refresh_rate)
+    events = []
+
+    def run():
+        timer.clear()
+        frame_plan.run_plan(win, plan, noise, lambda e, t: events.append(e),
+                            on_frame=lambda f: None, get_time=win.clock,
+                            timer=timer)
+    t = timeit(run)
+    report(f'run_plan, {plan.n_frames} frames', t,
+           us_per_frame=f'{t / plan.n_frames * 1e6:.1f}',
+           peak_MB=f'{peak_memory(run):.1f}')
+
+def bench_event_log(n_events=100000):
+    ''' Recording and exporting trial events '''
+    def record():
+        log = EventLog()
+        for i in range(n_events):
+            log.record(i / 60, 'MGS', 'visual', '25', i % 30, 7.07, -7.07,
+                       'start_saccade_window', False)
+        return log
+    t = timeit(record)
+    report(f'EventLog.record, {n_events} events', t,
+           us_per_event=f'{t / n_events * 1e6:.2f}',
+           peak_MB=f'{peak_memory(record):.1f}')
+
+    log = record()
+    t = timeit(lambda: log.rows(0, len(log)))
+    report(f'EventLog.rows, {n_events} events', t)
+
+def bench_aoi(fs=600, durations=(2, 60)):
+    ''' AOI scoring of a training trial (2 s) and a PF trial (60 s) '''
+    rng = np.random.default_rng(0)
+    for duration in durations:
+        xy = rng.normal(0, 2, (fs * duration, 2, 2))
+        t = np.arange(len(xy)) / fs
+        windows = aoi.AOIs()
+        windows.add_rect((0.0, 0.0), 3, time_range=(0, duration / 2))
+        windows.add_rect((7.07, 7.07), 3, time_range=(duration / 2, np.inf))
+        score = lambda: aoi.score_aois(xy, windows, t)
+        report(f'score_aois, 2 AOIs, {duration} s at {fs} Hz',
+               timeit(score, repeats=20),
+               peak_MB=f'{peak_memory(score):.1f}')
+
+def bench_gaze_monitor(fs=600, refresh_rate=60, duration=60):
+    ''' Cost per frame of the live fixation break monitor '''
+    clock = headless.VirtualClock()
+    gaze = headless.SyntheticGaze(p_lost=0.05)
+    tracker = headless.HeadlessTracker(clock, SimpleNamespace(SAMPLING_RATE=fs),
+                                       gaze)
+    tracker.start_recording()
+    for k in range(duration):
+        gaze.fixate(k + 0.5, (8.0 * (k % 2), 0.0))
+    clock.advance(duration)
+    tracker.buffer.generate()
+
+    monitor = GazeMonitor(tracker, helpers.Tobii2Deg(BenchMonitor()), fs)
+    def run():
+        clock.t = 0
+        monitor.reset()
+        monitor.set_aoi((0, 0), 3)
+        for _ in range(duration * refresh_rate):
+            clock.advance(1 / refresh_rate)
+            monitor.update()
+    t = timeit(run)
+    report(f'GazeMonitor.update, {duration} s', t,
+           us_per_frame=f'{t / (duration * refresh_rate) * 1e6:.1f}',
+           breaks=monitor.n_breaks)
+
+def bench_session():
+    ''' A whole headless session (small visual noise textures) '''
+    t0 = time.perf_counter()
+    _, sim = headless.run_session(visual_noise_size=256)
+    t = time.perf_counter() - t0
+    report('headless session', t,
+           x_real_time=f'{sim.clock() / t:.0f}',
+           flips=sim.windows[0].n_flips)
+
+
+# %%
+BENCHMARKS = {'noise_scaling': bench_noise_scaling,
+              'noise_throughput': bench_noise_throughput,
+              'noise_frames': bench_noise_frames,
+              'noise_colour': bench_noise_colour,
+              'noise_stream': bench_noise_stream,
+              'frame_loop': bench_frame_loop,
+              'event_log': bench_event_log,
+              'tobii2deg': bench_tobii2deg,
+              'aoi': bench_aoi,
+              'gaze_monitor': bench_gaze_monitor,
+              'saccades': bench_saccades,
+              'session': bench_session}
+
+def save_results(filename):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['benchmark', 'ms', 'extra'])
+        writer.writerows(RESULTS)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the hot paths')
+    parser.add_argument('names', nargs='*',
+                        help=f'benchmarks to run (default all): {", ".join(BENCHMARKS)}')
+    parser.add_argument('-o', '--output', help='save the results to a .tsv file')
+    args = parser.parse_args(argv)
+
+    headless.install()  # Stand-ins for psychopy, psychtoolbox, sounddevice and titta
+    for name in args.names or BENCHMARKS:
+        print(f'--- {name}')
+        BENCHMARKS[name]()
+
+    if args.output:
+        save_results(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Epoch index: trials and trial phases as sample index ranges
+
+The trial markers sent to the eye tracker (e.g., 'onset_MGS_visual_25_3_...',
+'start_flash_MGS_visual_25_3_...', 'offset_MGS_visual_25_3_...') are parsed
+once, and all marker time stamps are mapped to sample indices with a single
+np.searchsorted on the (sorted) sample time stamps. Extracting the samples of
+a trial or phase is then a slice, i.e., a view of the session arrays without
+any copying or masking.
+
+@author: Marcus
+"""
+
+import re
+
+import numpy as np
+
+# '<event>_<trial message>', where the trial message starts with the task
+MARKER = re.compile(r'^(.+?)_((?:MGS|FIX)_.+)$')
+
+
+# %%
+def parse_markers(msg_times, msgs):
+    ''' Groups trial markers by trial
+
+    Markers of a trial message belong to its latest trial, unless that trial
+    already has an offset, in which case they start a new trial (the same
+    trial message may be repeated in a session). Other messages are ignored.
+
+    Args:
+        msg_times (sequence): time stamps of the messages
+        msgs (sequence of str): the messages
+
+    Returns:
+        list of (trial message, {event: time stamp}) with both an onset and
+        an offset, ordered by onset
+    '''
+    trials, latest = [], {}
+    for ts, msg in zip(msg_times, msgs):
+        m = MARKER.match(msg)
+        if m is None:
+            continue
+        event, trial_msg = m.groups()
+        i = latest.get(trial_msg)
+        if i is None or 'offset' in trials[i][1]:
+            i = latest[trial_msg] = len(trials)
+            trials.append((trial_msg, {}))
+        trials[i][1][event] = ts
+
+    trials = [tr for tr in trials if 'onset' in tr[1] and 'offset' in tr[1]]
+    trials.sort(key=lambda tr: tr[1]['onset'])
+    return trials
+
+
+class EpochIndex:
+    '''
+    Sample index ranges [start, stop) of all trials and trial phases
+    '''
+    def __init__(self, t, msg_times, msgs):
+        '''
+        Args:
+            t (N array): sorted time stamps of the samples
+            msg_times (sequence): time stamps of the messages
+            msgs (sequence of str): the messages
+
+        A trial spans the samples from its onset to its offset marker and a
+        phase those from its 'start_<phase>' to its 'end_<phase>' marker
+        (both inclusive).
+        '''
+        markers = parse_markers(msg_times, msgs)
+        self.n_samples = len(t)
+        self.trials = [trial_msg for trial_msg, _ in markers]
+        self.events = [events for _, events in markers]
+
+        # All marker time stamps -> sample indices in one go
+        times = np.array([ts for events in self.events
+                          for ts in events.values()], dtype=np.asarray(t).dtype)
+        first = np.searchsorted(t, times, side='left')   # First sample at or after
+        after = np.searchsorted(t, times, side='right')  # First sample after
+
+        self._bounds = np.zeros((len(self.trials), 2), dtype=np.int64)
+        self._phases = []
+        k = 0
+        for i, events in enumerate(self.events):
+            start, stop = {}, {}
+            for event in events:
+                start[event], stop[event] = first[k], after[k]
+                k += 1
+            self._bounds[i] = start['onset'], stop['offset']
+
+            phases = {}
+            for event in events:
+                name = event[len('start_'):]
+                if event.startswith('start_') and 'end_' + name in events:
+                    phases[name] = (start[event], stop['end_' + name])
+            self._phases.append(phases)
+
+    @classmethod
+    def from_messages(cls, t, messages):
+        ''' From a Titta message table (columns system_time_stamp and msg) '''
+        return cls(t, messages['system_time_stamp'].to_numpy(),
+                   messages['msg'].to_list())
+
+    def __len__(self):
+        return len(self.trials)
+
+    def phases(self, i):
+        ''' Names of the phases of trial i, in order '''
+        return list(self._phases[i])
+
+    def slice(self, i, phase=None):
+        ''' Samples of trial i (or one of its phases) as a slice '''
+        if phase is None:
+            start, stop = self._bounds[i]
+        else:
+            start, stop = self._phases[i][phase]
+        return slice(int(start), int(stop))
+
+    def epoch(self, i, *arrays, phase=None):
+        ''' Views of the samples of trial i (or one of its phases)
+
+        Args:
+            i (int): trial
+            arrays: session arrays with one row per sample (t, xy, ...)
+            phase (str): e.g., 'saccade_window' (None is the whole trial)
+
+        Returns:
+            tuple with a view of each array
+        '''
+        s = self.slice(i, phase)
+        return tuple(a[s] for a in arrays)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Typed, columnar log of trial events
+
+Events are stored in preallocated numpy columns (time, categorical codes
+for task, noise condition, noise level and event, trial, target position),
+so recording an event does not format or parse any strings. The log is
+exported directly as columns to a .tsv file.
+
+@author: Marcus
+"""
+
+import numpy as np
+
+COLUMNS = ['time', 'task', 'noise_condition', 'noise_level', 'trial',
+           'target_x', 'target_y', 'event', 'training']
+CATEGORICAL = ['task', 'noise_condition', 'noise_level', 'event']
+
+
+# %%
+class EventLog:
+    '''
+    Growable columnar event log
+    '''
+    def __init__(self, capacity=4096):
+        '''
+        Args:
+            capacity (int): initial number of events (doubled when full)
+        '''
+        self.n = 0
+        self._categories = {c: {} for c in CATEGORICAL}
+        self._columns = {'time': np.zeros(capacity, dtype=np.float64),
+                         'task': np.zeros(capacity, dtype=np.int16),
+                         'noise_condition': np.zeros(capacity, dtype=np.int16),
+                         'noise_level': np.zeros(capacity, dtype=np.int16),
+                         'trial': np.zeros(capacity, dtype=np.int32),
+                         'target_x': np.zeros(capacity, dtype=np.float64),
+                         'target_y': np.zeros(capacity, dtype=np.float64),
+                         'event': np.zeros(capacity, dtype=np.int16),
+                         'training': np.zeros(capacity, dtype=bool)}
+
+    def _code(self, column, value):
+        codes = self._categories[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+        return code
+
+    def _grow(self):
+        for name, col in self._columns.items():
+            new_col = np.zeros(2 * len(col), dtype=col.dtype)
+            new_col[:len(col)] = col
+            self._columns[name] = new_col
+
+    def record(self, t, task, noise_condition, noise_level, trial,
+               target_x, target_y, event, training=False):
+        ''' Records one event
+
+        Args:
+            t (float): time of the event (s)
+            task (str): e.g., 'MGS' or 'FIX'
+            noise_condition (str): e.g., 'visual'
+            noise_level (str): e.g., '25' ('0' for no level)
+            trial (int): trial number
+            target_x, target_y (float): position of the target (deg)
+            event (str): e.g., 'start_flash'
+            training (bool): True for training trials
+        '''
+        if self.n == len(self._columns['time']):
+            self._grow()
+
+        i = self.n
+        cols = self._columns
+        cols['time'][i] = t
+        cols['task'][i] = self._code('task', task)
+        cols['noise_condition'][i] = self._code('noise_condition', noise_condition)
+        cols['noise_level'][i] = self._code('noise_level', noise_level)
+        cols['trial'][i] = trial
+        cols['target_x'][i] = target_x
+        cols['target_y'][i] = target_y
+        cols['event'][i] = self._code('event', event)
+        cols['training'][i] = training
+        self.n += 1
+
+    def __len__(self):
+        return self.n
+
+    def column(self, name):
+        ''' Recorded values of a column (codes for categorical columns) '''
+        return self._columns[name][:self.n]
+
+    def categories(self, name):
+        ''' Category names of a categorical column, indexed by code '''
+        codes = dict(self._categories[name])
+        return sorted(codes, key=codes.get)
+
+    def rows(self, start=0, stop=None):
+        ''' Copies of rows start:stop, with category names instead of codes
+
+        Safe to call from another thread while events are being recorded.
+
+        Returns:
+            dict with a list per column in COLUMNS
+        '''
+        stop = self.n if stop is None else stop
+        columns = self._columns
+        rows = {}
+        for name in COLUMNS:
+            values = columns[name][start:stop].tolist()
+            if name in CATEGORICAL:
+                names = self.categories(name)
+                values = [names[v] for v in values]
+            rows[name] = values
+
+        return rows
+
+    def to_frame(self):
+        ''' Returns the log as a pandas DataFrame with categorical columns '''
+        import pandas as pd
+
+        data = {}
+        for name in COLUMNS:
+            if name in CATEGORICAL:
+                data[name] = pd.Categorical.from_codes(self.column(name),
+                                                       self.categories(name))
+            else:
+                data[name] = self.column(name)
+
+        return pd.DataFrame(data, columns=COLUMNS)
+
+    def save(self, filename):
+        ''' Writes the log to a .tsv file '''
+        self.to_frame().to_csv(filename, sep='\t')
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Frame plans: trials compiled into per-frame arrays and run in a tight loop
+
+A trial is described as a sequence of phases (e.g., fixation, flash, memory
+delay, saccade window, feedback). compile_plan() turns the phases into
+arrays with the phase and visual noise frame of every frame and the frames
+where onset/offset markers are emitted, so that run_plan() does not have to
+compute anything but draws and flips.
+
+@author: Marcus
+"""
+
+import numpy as np
+
+
+# %%
+class Phase:
+    '''
+    Part of a trial where the same stimuli are drawn every frame
+    '''
+    def __init__(self, name, n_frames, stims=(), overlay=(), noise=True,
+                 markers=True, start_event=None, end_event=None):
+        '''
+        Args:
+            name (str): name of the phase, e.g., 'flash'
+            n_frames (int): duration of the phase in frames
+            stims (sequence): stimuli drawn below the visual noise
+            overlay (sequence): stimuli drawn on top of the visual noise
+            noise (bool): draw visual noise (if any) during the phase
+            markers (bool): emit start/end events for the phase
+            start_event (str): name of start event (default 'start_<name>')
+            end_event (str): name of end event (default 'end_<name>')
+        '''
+        self.name = name
+        self.n_frames = int(n_frames)
+        self.stims = tuple(stims)
+        self.overlay = tuple(overlay)
+        self.noise = noise
+        self.markers = markers
+        self.start_event = start_event or 'start_' + name
+        self.end_event = end_event or 'end_' + name
+
+
+class FramePlan:
+    '''
+    Phases of a trial compiled into per-frame arrays
+    '''
+    def __init__(self, phases, mask_duration):
+        '''
+        Args:
+            phases (list of Phase): phases of the trial, in order
+            mask_duration (int): number of frames in the visual noise bank
+
+        Phases with 0 frames are skipped; if no phase has any frames, the
+        plan is empty (n_frames is 0 and run_plan() draws nothing).
+
+        The visual noise frame (noise_index) restarts at 0 at the start of
+        every phase and wraps at mask_duration, i.e., frame f of a phase
+        shows noise frame f % mask_duration.
+        '''
+        phases = [p for p in phases if p.n_frames > 0]
+        n_frames = np.array([p.n_frames for p in phases], dtype=int)
+        starts = (np.cumsum(n_frames) - n_frames).astype(int)
+
+        self.phases = phases
+        self.n_frames = int(n_frames.sum())
+
+        # Per-frame phase index and visual noise frame (-1 is no noise).
+        # The noise restarts at frame 0 at the start of every phase.
+        self.phase_index = np.repeat(np.arange(len(phases), dtype=int), n_frames)
+        self.noise_index = np.arange(self.n_frames) - np.repeat(starts, n_frames)
+        self.noise_index %= mask_duration
+        no_noise = np.array([not p.noise for p in phases], dtype=bool)
+        self.noise_index[no_noise[self.phase_index]] = -1
+
+        # Stimuli drawn before and after the noise, per frame (via phase)
+        self.draw_before = [p.stims for p in phases]
+        self.draw_after = [p.overlay for p in phases]
+
+        # Markers are emitted right after the flip of their frame
+        marker_frames, marker_events = [], []
+        for p, start in zip(phases, starts):
+            if p.markers:
+                marker_frames += [start, start + p.n_frames - 1]
+                marker_events += [p.start_event, p.end_event]
+        order = np.argsort(marker_frames, kind='stable')
+        self.marker_frames = np.array(marker_frames, dtype=int)[order]
+        self.marker_events = [marker_events[i] for i in order]
+
+
+def compile_plan(phases, mask_duration):
+    ''' Compiles a list of phases into a FramePlan '''
+    return FramePlan(phases, mask_duration)
+
+
+# %%
+def run_plan(win, plan, visual_noise=None, on_marker=None, on_frame=None,
+             get_time=None, timer=None):
+    ''' Draws and flips all frames of a plan
+
+    Args:
+        win: PsychoPy window
+        plan (FramePlan): compiled plan
+        visual_noise: indexable visual noise frames (None is no noise)
+        on_marker (callable): on_marker(event, t) is called right after the
+            flip of the first and last frame of each phase with markers
+        on_frame (callable): on_frame(f) is called after the flip of
+            every frame, e.g., to check for key presses
+        get_time (callable): clock used to time stamp markers
+            (e.g., psychtoolbox.GetSecs)
+        timer (FlipTimer): if given, the time of every flip is recorded
+            with the phase it belongs to
+    '''
+    # Python lists are faster to index than numpy arrays in the loop
+    phase_index = plan.phase_index.tolist()
+    noise_index = plan.noise_index.tolist()
+    marker_frames = plan.marker_frames.tolist() + [-1]
+    marker_events = plan.marker_events
+    draw_before = plan.draw_before
+    draw_after = plan.draw_after
+    if visual_noise is None:
+        noise_index = [-1] * plan.n_frames
+    if timer is not None:
+        phase_codes = [timer.phase_code(phase.name) for phase in plan.phases]
+
+    m = 0
+    for f in range(plan.n_frames):
+        p = phase_index[f]
+        for stim in draw_before[p]:
+            stim.draw()
+        if noise_index[f] >= 0:
+            visual_noise[noise_index[f]].draw()
+        for stim in draw_after[p]:
+            stim.draw()
+        t_flip = win.flip()
+        if timer is not None:
+            timer.record(t_flip, phase_codes[p], f > 0)
+
+        if f == marker_frames[m]:
+            t = get_time() if get_time is not None else None
+            while f == marker_frames[m]:
+                if on_marker is not None:
+                    on_marker(marker_events[m], t)
+                m += 1
+
+        if on_frame is not None:
+            on_frame(f)
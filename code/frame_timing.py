@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Per-flip timing instrumentation
+
+Every flip time stamp is recorded in a preallocated ring buffer, tagged with
+task, noise condition, trial and phase. Flip intervals longer than the frame
+duration (plus a tolerance) are counted as late, and the number of refreshes
+they span as dropped frames. Summaries per phase are written to a .tsv file
+at the end of each condition.
+
+@author: Marcus
+"""
+
+import csv
+import os
+
+import numpy as np
+
+SUMMARY_COLUMNS = ['task', 'noise_condition', 'phase', 'n_flips',
+                   'mean_interval_ms', 'jitter_ms', 'p99_interval_ms',
+                   'max_interval_ms', 'n_late', 'n_dropped', 'overflow']
+
+
+# %%
+class FlipTimer:
+    '''
+    Ring buffer with flip time stamps and their task/condition/trial/phase
+    '''
+    def __init__(self, refresh_rate, capacity=2**15, tolerance=0.5):
+        '''
+        Args:
+            refresh_rate (float): nominal refresh rate of the monitor (Hz)
+            capacity (int): number of flips kept in the buffer
+            tolerance (float): a flip interval is late if it is longer than
+                (1 + tolerance) frame durations
+        '''
+        self.frame_duration = 1 / refresh_rate
+        self.capacity = capacity
+        self.tolerance = tolerance
+
+        self.t = np.zeros(capacity, dtype=np.float64)
+        self.trial = np.zeros(capacity, dtype=np.int32)
+        self.context = np.zeros(capacity, dtype=np.int16)
+        self.phase = np.zeros(capacity, dtype=np.int16)
+        self.continued = np.zeros(capacity, dtype=bool)
+
+        self._contexts = {}   # (task, noise_condition) -> code
+        self._phases = {}     # phase name -> code
+        self._context_code = 0
+        self._trial = 0
+        self.n = 0            # Total number of recorded flips since clear()
+
+    def _code(self, codes, key):
+        if key not in codes:
+            codes[key] = len(codes)
+        return codes[key]
+
+    def phase_code(self, phase):
+        ''' Integer code of a phase name (look up once, before the loop) '''
+        return self._code(self._phases, phase)
+
+    def set_context(self, task, noise_condition, trial=0):
+        ''' Task, noise condition and trial of the following flips '''
+        self._context_code = self._code(self._contexts, (task, noise_condition))
+        self._trial = trial
+
+    def record(self, t, phase_code, continued=True):
+        ''' Records one flip
+
+        Args:
+            t (float): time stamp of the flip (s)
+            phase_code (int): code from phase_code()
+            continued (bool): False if the previous flip was not the frame
+                just before this one (e.g., the first frame of a trial)
+        '''
+        i = self.n % self.capacity
+        self.t[i] = t
+        self.trial[i] = self._trial
+        self.context[i] = self._context_code
+        self.phase[i] = phase_code
+        self.continued[i] = continued
+        self.n += 1
+
+    def clear(self):
+        ''' Forgets all recorded flips (codes are kept) '''
+        self.n = 0
+
+    def _ordered(self):
+        ''' Indices of the flips in the buffer, oldest first '''
+        if self.n <= self.capacity:
+            return np.arange(self.n)
+        return (np.arange(self.capacity) + self.n) % self.capacity
+
+    def intervals(self):
+        ''' Flip intervals (s) with the context and phase of the later flip
+
+        Returns:
+            dt, context, trial, phase (arrays of equal length)
+        '''
+        idx = self._ordered()
+        if len(idx) < 2:
+            empty = np.zeros(0)
+            return empty, empty.astype(int), empty.astype(int), empty.astype(int)
+
+        dt = np.diff(self.t[idx])
+        later = idx[1:]
+        valid = (self.continued[later] &
+                 (self.context[later] == self.context[idx[:-1]]) &
+                 (self.trial[later] == self.trial[idx[:-1]]))
+
+        return (dt[valid], self.context[later][valid],
+                self.trial[later][valid], self.phase[later][valid])
+
+    def summary(self):
+        ''' Timing summary per task, noise condition and phase
+
+        Returns:
+            list of dicts with the keys in SUMMARY_COLUMNS
+        '''
+        dt, context, trial, phase = self.intervals()
+        contexts = {v: k for k, v in self._contexts.items()}
+        phases = {v: k for k, v in self._phases.items()}
+
+        # Number of refreshes each interval spans, minus the expected one
+        n_frames = np.rint(dt / self.frame_duration).astype(int)
+        late = dt > (1 + self.tolerance) * self.frame_duration
+        dropped = np.where(late, np.maximum(n_frames - 1, 1), 0)
+
+        rows = []
+        for c in np.unique(context):
+            for p in np.unique(phase[context == c]):
+                sel = (context == c) & (phase == p)
+                task, noise_condition = contexts[c]
+                rows.append({'task': task,
+                             'noise_condition': noise_condition,
+                             'phase': phases[p],
+                             'n_flips': int(sel.sum()),
+                             'mean_interval_ms': 1000 * dt[sel].mean(),
+                             'jitter_ms': 1000 * dt[sel].std(),
+                             'p99_interval_ms': 1000 * np.percentile(dt[sel], 99),
+                             'max_interval_ms': 1000 * dt[sel].max(),
+                             'n_late': int(late[sel].sum()),
+                             'n_dropped': int(dropped[sel].sum()),
+                             'overflow': self.n > self.capacity})
+
+        return rows
+
+    def save_summary(self, filename, clear=True):
+        ''' Appends the summary to a .tsv file (and clears the buffer)
+
+        Returns:
+            rows of the summary
+        '''
+        rows = self.summary()
+        new_file = not os.path.isfile(filename)
+        with open(filename, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS,
+                                    delimiter='\t')
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+
+        if clear:
+            self.clear()
+
+        return rows
+
+
+def print_summary(rows):
+    ''' Prints timing summary rows as a table (columns sized to the data) '''
+    w_task = max([len('task')] + [len(r['task']) for r in rows]) + 1
+    w_cond = max([len('condition')] + [len(r['noise_condition']) for r in rows]) + 1
+    w_phase = max([len('phase')] + [len(r['phase']) for r in rows]) + 1
+    print(f"{'task':<{w_task}s}{'condition':<{w_cond}s}{'phase':<{w_phase}s}{'n':>7s}"
+          f"{'mean':>8s}{'jitter':>8s}{'p99':>8s}{'late':>6s}{'drop':>6s}")
+    for r in rows:
+        print(f"{r['task']:<{w_task}s}{r['noise_condition']:<{w_cond}s}{r['phase']:<{w_phase}s}"
+              f"{r['n_flips']:>7d}{r['mean_interval_ms']:>8.2f}"
+              f"{r['jitter_ms']:>8.2f}{r['p99_interval_ms']:>8.2f}"
+              f"{r['n_late']:>6d}{r['n_dropped']:>6d}")
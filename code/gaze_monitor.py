@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Live gaze-contingent monitoring of fixation breaks and track loss
+
+Every update() reads only the gaze samples that arrived in the Titta buffer
+since the previous update (about 10 samples per frame at 600 Hz), so the cost
+per frame is small and bounded. The samples are scored against the AOI of the
+current phase (e.g., the fixation point), and the length of the current run
+of samples outside the AOI (or lost) is carried from one update to the next,
+so a fixation break or track loss is reported as soon as it has lasted long
+enough, whatever the chunking of the samples.
+
+@author: Marcus
+"""
+
+import warnings
+
+import numpy as np
+
+import aoi
+
+FIXATION_BREAK = 'fixation_break'
+TRACK_LOSS = 'track_loss'
+
+
+# %%
+def run_lengths(flag, carry=0):
+    ''' Length of the run of True that ends at each sample
+
+    Args:
+        flag (bool array)
+        carry (int): length of the run at the end of the previous chunk
+
+    Returns:
+        runs (int array), 0 where flag is False
+    '''
+    idx = np.arange(len(flag))
+    last_false = np.maximum.accumulate(np.where(flag, -1, idx))
+    runs = idx - last_false
+    runs[last_false < 0] += carry
+    return runs
+
+
+class GazeMonitor:
+    '''
+    Fixation breaks and track loss from the live gaze samples
+    '''
+    def __init__(self, tracker, to_deg, fs=600, min_break_duration=0.1,
+                 min_loss_duration=0.25, max_samples=None):
+        '''
+        Args:
+            tracker: Titta tracker (recording gaze)
+            to_deg (Tobii2Deg): Tobii coordinates -> deg
+            fs (float): sampling frequency (Hz)
+            min_break_duration (float): gaze has to be outside the AOI for
+                this long (s, valid samples) to count as a fixation break
+            min_loss_duration (float): both eyes have to be lost this long (s)
+                to count as track loss
+            max_samples (int): most samples read per update (default 1 s);
+                if more have arrived, e.g., after a long pause, only the
+                latest are scored
+        '''
+        self.tracker = tracker
+        self.to_deg = to_deg
+        self.min_break_samples = max(int(round(min_break_duration * fs)), 1)
+        self.min_loss_samples = max(int(round(min_loss_duration * fs)), 1)
+        self.max_samples = max_samples or int(fs)
+
+        self.aois = None
+        self.reset()
+
+    def reset(self):
+        ''' Starts monitoring from now (e.g., at the start of a trial) '''
+        self.t_last = self.tracker.get_system_time_stamp()
+        self.run_outside = (0, None)  # (length, time stamp of first sample)
+        self.run_lost = (0, None)
+        self.n_samples = 0
+        self.n_lost = 0
+        self.n_breaks = 0
+        self.n_losses = 0
+        self.events = []  # (event, time stamp (us) of the first sample)
+
+    def set_aoi(self, center=None, half_size=None):
+        ''' Sets the AOI gaze has to stay in (None is no AOI, e.g., during
+        the saccade window)
+        '''
+        if center is None:
+            self.aois = None
+        else:
+            self.aois = aoi.AOIs()
+            self.aois.add_rect(center, half_size)
+        self.run_outside = (0, None)
+
+    def _read(self):
+        ''' New samples as time stamps (us) and binocular gaze (deg) '''
+        t_now = self.tracker.get_system_time_stamp()
+        samples = self.tracker.buffer.peek_time_range('gaze', self.t_last + 1,
+                                                      t_now)
+        if not samples or len(samples['system_time_stamp']) == 0:
+            return None, None
+
+        t = np.asarray(samples['system_time_stamp'])[-self.max_samples:]
+        xy = np.empty((len(t), 2, 2))  # samples x [left, right] x [x, y]
+        for e, eye in enumerate(['left', 'right']):
+            for d, dim in enumerate(['x', 'y']):
+                xy[:, e, d] = np.asarray(
+                    samples[f'{eye}_gaze_point_on_display_area_{dim}'])[-len(t):]
+        self.to_deg(xy, out=xy)
+        self.t_last = int(t[-1])
+
+        # Average of the eyes (or the one eye that is not lost)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            return t, np.nanmean(xy, axis=1)
+
+    @staticmethod
+    def _runs_reaching(t, flag, run, min_samples):
+        ''' Runs of True in flag that reach min_samples in this chunk
+
+        Args:
+            t (N array): time stamps (us)
+            flag (N bool array)
+            run (length, t_start): run at the end of the previous chunk
+            min_samples (int): minimum length of a run
+
+        Returns:
+            time stamps of the first samples of the runs,
+            (length, t_start) of the run at the end of this chunk
+        '''
+        if len(t) == 0:
+            return [], run
+
+        runs = run_lengths(flag, run[0])
+        starts = np.flatnonzero(runs == min_samples) - (min_samples - 1)
+        t_starts = [int(t[i]) if i >= 0 else run[1] for i in starts]
+
+        length = int(runs[-1])
+        i = len(t) - length
+        return t_starts, (length, int(t[i]) if 0 <= i < len(t) else run[1])
+
+    def update(self):
+        ''' Scores the samples that arrived since the last update
+
+        Returns:
+            list of new (event, time stamp (us) of its first sample), with
+            event FIXATION_BREAK or TRACK_LOSS
+        '''
+        t, gaze = self._read()
+        if t is None:
+            return []
+
+        lost = np.isnan(gaze[:, 0])
+        if self.aois is None:
+            outside = np.zeros(len(t), dtype=bool)
+        else:
+            outside = ~aoi.inside_aois(gaze[:, np.newaxis], self.aois)[0, :, 0]
+
+        # An event is reported once per run, as soon as the run is long
+        # enough. Lost samples neither end nor extend a fixation break
+        breaks, self.run_outside = self._runs_reaching(
+            t[~lost], outside[~lost], self.run_outside, self.min_break_samples)
+        losses, self.run_lost = self._runs_reaching(
+            t, lost, self.run_lost, self.min_loss_samples)
+        new_events = sorted([(FIXATION_BREAK, ts) for ts in breaks] +
+                            [(TRACK_LOSS, ts) for ts in losses],
+                            key=lambda e: e[1])
+
+        self.n_samples += len(t)
+        self.n_lost += int(lost.sum())
+        self.n_breaks += len(breaks)
+        self.n_losses += len(losses)
+        self.events += new_events
+
+        return new_events
+
+    @property
+    def prop_lost(self):
+        ''' Proportion of lost samples since reset() '''
+        return self.n_lost / self.n_samples if self.n_samples else np.nan
@@ -0,0 +1,651 @@
+# -*- coding: utf-8 -*-
+"""
+Headless simulation of the experiment
+
+Stand-ins for the PsychoPy window, stimuli, sound, keyboard, dialog and
+monitor, for psychtoolbox, for sounddevice and for Titta are installed as the
+psychopy, psychtoolbox, sounddevice and titta modules, so that noise_em.py (MGS, PF and the noise
+generation) runs without a display, audio device or eye tracker. All stand-ins
+share a virtual clock that advances one refresh interval per flip (and by the
+requested time in core.wait), so a session runs faster than real time with
+consistent time stamps.
+
+The stand-in tracker produces synthetic gaze at its sampling rate on the
+virtual clock: fixation at the center of the screen with noise and lost
+samples, and a saccade to the target in the saccade window of MGS trials
+(parsed from the trial messages).
+
+Run a whole session from the command line, e.g.,
+    python headless.py
+    python headless.py --quick      # smaller visual noise textures
+    python headless.py --imports    # import time of the heavy modules
+
+The startup stages of the session (noise_em.startup_times) are printed when
+the session starts.
+
+@author: Marcus
+"""
+
+import argparse
+import importlib
+import math
+import os
+import subprocess
+import sys
+import time
+import types
+from types import SimpleNamespace
+
+import numpy as np
+
+import parameters as params
+
+GAZE_COLUMNS = ['system_time_stamp',
+                'left_gaze_point_on_display_area_x',
+                'left_gaze_point_on_display_area_y',
+                'right_gaze_point_on_display_area_x',
+                'right_gaze_point_on_display_area_y']
+
+STAND_IN_MODULES = ['psychopy', 'psychopy.prefs', 'psychopy.visual',
+                    'psychopy.monitors', 'psychopy.tools',
+                    'psychopy.tools.coordinatetools',
+                    'psychopy.tools.monitorunittools', 'psychopy.core',
+                    'psychopy.gui', 'psychopy.event', 'psychopy.sound',
+                    'psychopy.logging', 'psychtoolbox', 'titta', 'sounddevice']
+
+# Modules whose (real) import time is reported by import_times()
+IMPORT_TIME_MODULES = ['numpy', 'psychopy.gui', 'psychopy.visual',
+                       'psychopy.sound', 'psychtoolbox', 'titta', 'pandas',
+                       'noise_em']
+
+
+# %%
+class VirtualClock:
+    '''
+    Simulated time (s), advanced by flips and waits
+    '''
+    def __init__(self, t=0.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+    def advance(self, dt):
+        self.t += dt
+        return self.t
+
+
+class HeadlessWindow:
+    '''
+    Stand-in for visual.Window; a flip advances the clock one refresh interval
+    '''
+    def __init__(self, clock, refresh_rate=60, size=params.SCREEN_RES,
+                 units='deg', **kwargs):
+        self.clock = clock
+        self.refresh_rate = refresh_rate
+        self.size = size
+        self.units = units
+        self.mouseVisible = True
+        self.n_flips = 0
+        self.n_draws = 0
+        self.closed = False
+
+    def flip(self):
+        self.n_flips += 1
+        return self.clock.advance(1 / self.refresh_rate)
+
+    def getActualFrameRate(self, **kwargs):
+        return float(self.refresh_rate)
+
+    def clearBuffer(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class HeadlessStim:
+    '''
+    Stand-in for any visual stimulus (Circle, TextStim, GratingStim, ...)
+    '''
+    def __init__(self, win=None, **kwargs):
+        self.win = win
+        self.pos = (0, 0)
+        self.opacity = 1.0
+        self.text = ''
+        self.__dict__.update(kwargs)
+
+    def draw(self):
+        if self.win is not None:
+            self.win.n_draws += 1
+
+
+class HeadlessSound:
+    '''
+    Stand-in for sound.Sound; keeps the (virtual) times it was started and stopped
+    '''
+    def __init__(self, clock, value=None, **kwargs):
+        self.clock = clock
+        self.value = value
+        self.starts, self.stops = [], []
+
+    def play(self, **kwargs):
+        self.starts.append(self.clock())
+
+    def stop(self, **kwargs):
+        self.stops.append(self.clock())
+
+
+class HeadlessOutputStream(HeadlessSound):
+    '''
+    Stand-in for sounddevice.OutputStream (the callback is not called; use
+    noise_stream.HeadlessSink to drive it)
+    '''
+    def __init__(self, clock, callback=None, **kwargs):
+        super().__init__(clock, callback, **kwargs)
+        self.settings = kwargs
+
+    def start(self):
+        self.play()
+
+    def close(self):
+        pass
+
+
+class HeadlessMonitor:
+    '''
+    Stand-in for monitors.Monitor
+    '''
+    def __init__(self, name=None, width=params.SCREEN_WIDTH,
+                 distance=params.VIEWING_DIST, size_pix=params.SCREEN_RES):
+        self.name = name
+        self.width, self.distance, self.size_pix = width, distance, size_pix
+
+    def setWidth(self, width):
+        self.width = width
+
+    def setDistance(self, distance):
+        self.distance = distance
+
+    def setSizePix(self, size_pix):
+        self.size_pix = size_pix
+
+    def getWidth(self):
+        return self.width
+
+    def getDistance(self):
+        return self.distance
+
+    def getSizePix(self):
+        return self.size_pix
+
+
+class HeadlessKeyboard:
+    '''
+    Stand-in for psychopy.event: escape is never pressed
+
+    getKeys() returns the keys in pressed (default 'c', i.e., pauses end
+    right away) and waitKeys() the last key of its key list (e.g., 'n' to
+    'More training (y/n)').
+    '''
+    def __init__(self, clock, pressed=('c',)):
+        self.clock = clock
+        self.pressed = list(pressed)
+
+    def getKeys(self, keyList=None, **kwargs):
+        return [k for k in self.pressed if keyList is None or k in keyList]
+
+    def waitKeys(self, keyList=None, **kwargs):
+        self.clock.advance(1)
+        return [keyList[-1]] if keyList else list(self.pressed[:1])
+
+    def clearEvents(self, **kwargs):
+        pass
+
+    def Mouse(self, win=None, **kwargs):
+        return SimpleNamespace(pos=(0, 0), setPos=lambda pos: None,
+                               getPos=lambda: (0, 0),
+                               setVisible=lambda visible: None)
+
+
+class HeadlessDialog:
+    '''
+    Stand-in for gui.Dlg; OK is pressed with the given answers
+    '''
+    answers = ['headless']
+
+    def __init__(self, title='', **kwargs):
+        self.title = title
+        self.data = []
+        self.OK = True
+
+    def addField(self, label, initial='', **kwargs):
+        pass
+
+    def show(self):
+        self.data = list(self.answers)
+        return self.data
+
+
+# %%
+def pol2cart(theta, radius, units='deg'):
+    theta = np.radians(theta) if units in ['deg', 'degs'] else theta
+    return radius * np.cos(theta), radius * np.sin(theta)
+
+def cm2deg(cm, monitor, correctFlat=False):
+    if correctFlat:
+        return np.degrees(np.arctan(cm / monitor.getDistance()))
+    return cm / (monitor.getDistance() * 0.017455)
+
+def deg2pix(degrees, monitor, correctFlat=False):
+    cm = (np.degrees(np.tan(np.radians(degrees))) if correctFlat else degrees)
+    cm = cm * monitor.getDistance() * 0.017455
+    return cm * monitor.getSizePix()[0] / monitor.getWidth()
+
+
+# %%
+def synthetic_gaze(n_samples, fs=600, seed=0, noise_sd=0.02):
+    ''' Fixations (0.5-1 s) and 50 ms saccades to random positions (deg)
+
+    Returns:
+        xy (n_samples x 2 (eyes) x 2 array), saccade onsets (samples)
+    '''
+    rng = np.random.default_rng(seed)
+    xy = np.zeros((n_samples, 2, 2))
+    profile = (1 - np.cos(np.linspace(0, np.pi, int(0.05 * fs)))) / 2
+    pos, i, onsets = np.zeros(2), 0, []
+    while i < n_samples - len(profile):
+        fix = rng.integers(fs // 2, fs)
+        xy[i:i + fix] = pos
+        i += fix
+        if i >= n_samples - len(profile):
+            break
+        new_pos = rng.uniform(-10, 10, 2)
+        xy[i:i + len(profile)] = (pos + (new_pos - pos) *
+                                  profile[:, np.newaxis, np.newaxis])
+        onsets.append(i)
+        i += len(profile)
+        pos = new_pos
+    xy[i:] = pos
+    xy += rng.normal(0, noise_sd, xy.shape)
+
+    return xy, np.array(onsets)
+
+class SyntheticGaze:
+    '''
+    Gaze of a model participant who follows the MGS instructions
+
+    The gaze rests at the center of the screen and, after a latency, makes
+    a saccade to the remembered target at the start of the saccade window
+    and back when the next fixation point appears. In a proportion of the
+    trials, the participant fails to inhibit a saccade to the flashed target
+    (and looks back at the fixation point after half a second).
+    '''
+    def __init__(self, noise_sd=0.05, p_lost=0.01, latency=0.2,
+                 saccade_duration=0.04, p_error=0.0, seed=0):
+        '''
+        Args:
+            noise_sd (float): SD of the gaze position (deg)
+            p_lost (float): proportion of lost samples
+            latency (float): saccade latency (s)
+            saccade_duration (float): duration of the saccades (s)
+            p_error (float): proportion of trials with a saccade to the flash
+            seed: seed of the noise
+        '''
+        self.noise_sd = noise_sd
+        self.p_lost = p_lost
+        self.p_error = p_error
+        self.latency = latency
+        self.saccade_duration = saccade_duration
+        self.rng = np.random.default_rng(seed)
+        self._times = [-np.inf]
+        self._positions = [(0.0, 0.0)]
+
+    def fixate(self, t, pos):
+        ''' Starts a saccade to pos (deg) at time t (s) '''
+        self._times.append(t)
+        self._positions.append(tuple(pos))
+
+    def respond(self, msg, t):
+        ''' Reacts to a trial message sent at time t (s) '''
+        if msg.startswith('start_saccade_window_MGS'):
+            self.fixate(t + self.latency, self._target(msg))
+        elif (msg.startswith('start_flash_MGS') and
+              self.rng.random() < self.p_error):
+            self.fixate(t + self.latency, self._target(msg))
+            self.fixate(t + self.latency + 0.5, (0.0, 0.0))
+        elif msg.startswith('start_fixation_point_'):
+            self.fixate(t + self.latency, (0.0, 0.0))
+
+    @staticmethod
+    def _target(msg):
+        ''' Target position from e.g. 'start_flash_MGS_visual_25_3_7.07_-7.07' '''
+        parts = msg.split('_')
+        if parts[-1] == 'TRAINING':
+            parts = parts[:-1]
+        return float(parts[-2]), float(parts[-1])
+
+    def samples(self, t):
+        ''' Gaze position (N x 2 (eyes) x 2 array, deg, NaN is lost) at times t (s) '''
+        times = np.array(self._times)
+        positions = np.array(self._positions)
+        i = np.searchsorted(times, t, side='right') - 1
+        frac = np.clip((t - times[i]) / self.saccade_duration, 0, 1)
+        start = positions[np.maximum(i - 1, 0)]
+        xy = start + (positions[i] - start) * frac[:, np.newaxis]
+
+        xy = xy[:, np.newaxis, :] + self.rng.normal(0, self.noise_sd,
+                                                    (len(t), 2, 2))
+        xy[self.rng.random(len(t)) < self.p_lost] = np.nan
+        return xy
+
+
+class GazeBuffer:
+    '''
+    Stand-in for the Titta sample buffer (growable columns, time stamps in us)
+    '''
+    def __init__(self, generate, capacity=2**16):
+        '''
+        Args:
+            generate (callable): called before every read to add the
+                samples up to the current time
+            capacity (int): initial number of samples (doubled when full)
+        '''
+        self.generate = generate
+        self.n = 0
+        self._columns = {c: np.zeros(capacity) for c in GAZE_COLUMNS}
+        self._columns['system_time_stamp'] = np.zeros(capacity, dtype=np.int64)
+
+    def append(self, t, xy):
+        ''' Adds samples with time stamps t (us) and positions xy (N x 2 x 2) '''
+        n = len(t)
+        capacity = len(self._columns['system_time_stamp'])
+        if self.n + n > capacity:
+            new_capacity = max(2 * capacity, self.n + n)
+            for c, col in self._columns.items():
+                grown = np.zeros(new_capacity, dtype=col.dtype)
+                grown[:self.n] = col[:self.n]
+                self._columns[c] = grown
+
+        s = slice(self.n, self.n + n)
+        self._columns['system_time_stamp'][s] = t
+        for e, eye in enumerate(['left', 'right']):
+            for d, dim in enumerate(['x', 'y']):
+                self._columns[f'{eye}_gaze_point_on_display_area_{dim}'][s] = xy[:, e, d]
+        self.n += n
+
+    def _range(self, t_start, t_stop):
+        self.generate()
+        t = self._columns['system_time_stamp'][:self.n]
+        if t_stop is None:
+            t_stop = np.iinfo(np.int64).max
+        return (np.searchsorted(t, t_start, side='left'),
+                np.searchsorted(t, t_stop, side='right'))
+
+    def peek_time_range(self, stream, t_start=0, t_stop=None):
+        ''' Copies of the samples with t_start <= t <= t_stop (us) '''
+        start, stop = self._range(t_start, t_stop)
+        return {c: col[start:stop].copy() for c, col in self._columns.items()}
+
+    def consume_time_range(self, stream, t_start=0, t_stop=None):
+        ''' As peek_time_range, but the samples are removed from the buffer '''
+        start, stop = self._range(t_start, t_stop)
+        samples = {c: col[start:stop].copy() for c, col in self._columns.items()}
+        for col in self._columns.values():
+            col[start:self.n - (stop - start)] = col[stop:self.n]
+        self.n -= stop - start
+        return samples
+
+
+class HeadlessTracker:
+    '''
+    Stand-in for a connected Titta tracker with synthetic gaze
+    '''
+    def __init__(self, clock, settings, gaze=None, monitor=None):
+        self.clock = clock
+        self.settings = settings
+        self.fs = getattr(settings, 'SAMPLING_RATE', 600)
+        self.gaze = gaze or SyntheticGaze()
+        self.monitor = monitor or HeadlessMonitor()
+        self.buffer = GazeBuffer(self._generate)
+        self.messages = []
+        self.recording = False
+        self._next_sample = None  # Sample number of the next sample
+
+    def get_system_time_stamp(self):
+        return int(round(self.clock() * 1e6))
+
+    def send_message(self, msg, ts=None):
+        ts = self.get_system_time_stamp() if ts is None else ts
+        self.messages.append((ts, msg))
+        self.gaze.respond(msg, ts / 1e6)
+
+    def _generate(self):
+        ''' Adds the samples recorded since the last call to the buffer '''
+        if not self.recording:
+            return
+        last = math.floor(self.clock() * self.fs)
+        if last < self._next_sample:
+            return
+        t = np.arange(self._next_sample, last + 1) / self.fs
+        self._next_sample = last + 1
+
+        xy = self.gaze.samples(t)
+        # deg -> Tobii display area coordinates (inverse of tobii2deg)
+        w, h = self.monitor.getSizePix()
+        scale = self.monitor.getDistance() * 0.017455 / self.monitor.getWidth()
+        xy[..., 0] = xy[..., 0] * scale + 0.5
+        xy[..., 1] = 0.5 - xy[..., 1] * scale * w / h
+        self.buffer.append(np.round(t * 1e6).astype(np.int64), xy)
+
+    def start_recording(self, gaze=True, **kwargs):
+        self._generate()
+        if not self.recording:
+            self.recording = True
+            self._next_sample = math.ceil(self.clock() * self.fs)
+
+    def stop_recording(self, gaze=True, **kwargs):
+        self._generate()
+        self.recording = False
+
+    def init(self):
+        pass
+
+    def set_dummy_mode(self):
+        pass
+
+    def calibrate(self, win, **kwargs):
+        self.clock.advance(30)
+
+    def save_data(self, **kwargs):
+        ''' The samples and messages stay in buffer and messages '''
+        self._generate()
+
+
+# %%
+class Simulation:
+    '''
+    Installs the stand-ins as the psychopy, psychtoolbox, sounddevice and
+    titta modules
+
+    Use as a context manager; the modules that were there before are
+    restored on exit. The windows, sounds and trackers created while it is
+    installed are kept in windows, sounds and trackers.
+    '''
+    def __init__(self, refresh_rate=60, gaze=None, pid='headless'):
+        self.clock = VirtualClock()
+        self.refresh_rate = refresh_rate
+        self.gaze = gaze
+        self.windows, self.sounds, self.trackers = [], [], []
+        HeadlessDialog.answers = [pid]
+        self._saved = {}
+
+    def _modules(self):
+        clock = self.clock
+
+        def window(*args, **kwargs):
+            kwargs.pop('size', None)
+            win = HeadlessWindow(clock, self.refresh_rate, **kwargs)
+            self.windows.append(win)
+            return win
+
+        def sound(value=None, **kwargs):
+            s = HeadlessSound(clock, value, **kwargs)
+            self.sounds.append(s)
+            return s
+
+        def output_stream(**kwargs):
+            s = HeadlessOutputStream(clock, **kwargs)
+            self.sounds.append(s)
+            return s
+
+        def connect(settings):
+            tracker = HeadlessTracker(clock, settings, self.gaze)
+            self.trackers.append(tracker)
+            return tracker
+
+        def quit():
+            raise SystemExit(0)
+
+        keyboard = HeadlessKeyboard(clock)
+        modules = {name: types.ModuleType(name) for name in STAND_IN_MODULES}
+        modules['psychopy.prefs'].hardware = {}
+        modules['psychopy.prefs'].general = {}
+        modules['psychopy.visual'].__dict__.update(
+            Window=window, Circle=HeadlessStim, TextStim=HeadlessStim,
+            GratingStim=HeadlessStim, Rect=HeadlessStim, ImageStim=HeadlessStim)
+        modules['psychopy.monitors'].Monitor = HeadlessMonitor
+        modules['psychopy.tools.coordinatetools'].pol2cart = pol2cart
+        modules['psychopy.tools.monitorunittools'].__dict__.update(
+            cm2deg=cm2deg, deg2pix=deg2pix)
+        modules['psychopy.core'].__dict__.update(
+            wait=clock.advance, getTime=clock, quit=quit)
+        modules['psychopy.gui'].Dlg = HeadlessDialog
+        modules['psychopy.event'].__dict__.update(
+            getKeys=keyboard.getKeys, waitKeys=keyboard.waitKeys,
+            clearEvents=keyboard.clearEvents, Mouse=keyboard.Mouse)
+        modules['psychopy.sound'].Sound = sound
+        modules['psychtoolbox'].GetSecs = clock
+        modules['sounddevice'].OutputStream = output_stream
+        modules['titta'].Titta = SimpleNamespace(
+            get_defaults=lambda et_name: SimpleNamespace(
+                et_name=et_name, FILENAME='', N_CAL_TARGETS=5, DEBUG=False,
+                SAMPLING_RATE=600),
+            Connect=connect)
+
+        # Submodules are attributes of their parents
+        for name, module in modules.items():
+            if '.' in name:
+                parent, child = name.rsplit('.', 1)
+                setattr(modules[parent], child, module)
+        return modules
+
+    def install(self):
+        for name, module in self._modules().items():
+            self._saved[name] = sys.modules.get(name)
+            sys.modules[name] = module
+        return self
+
+    def uninstall(self):
+        for name, module in self._saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        self._saved = {}
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+
+def install():
+    ''' Installs the stand-ins for good (e.g., for benchmarks without a display) '''
+    return Simulation().install()
+
+
+# %%
+def run_session(visual_noise_size=None, refresh_rate=60, gaze=None,
+                pid='headless'):
+    ''' Runs a session of noise_em.py headless
+
+    Args:
+        visual_noise_size (int or (width, height)): size of the visual noise
+            in pixels (None is params.visualNoiseSize)
+        refresh_rate (int): refresh rate of the simulated screen
+        gaze (SyntheticGaze): gaze of the model participant
+        pid (str): participant ID entered in the dialog
+
+    Returns:
+        the noise_em module (freshly imported, after main()), the Simulation
+    '''
+    saved_size = params.visualNoiseSize
+    if visual_noise_size is not None:
+        params.visualNoiseSize = visual_noise_size
+
+    sim = Simulation(refresh_rate, gaze, pid)
+    try:
+        with sim:
+            sys.modules.pop('noise_em', None)
+            noise_em = importlib.import_module('noise_em')
+            noise_em.main()
+    finally:
+        params.visualNoiseSize = saved_size
+
+    return noise_em, sim
+
+def import_times(modules=IMPORT_TIME_MODULES):
+    ''' Time (s) to import each module in a fresh interpreter (python -X importtime)
+
+    Returns:
+        list of (module, s or None if it could not be imported)
+    '''
+    folder = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for module in modules:
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                 f'import {module}'], cwd=folder,
+                                capture_output=True, text=True)
+        t = None
+        if result.returncode == 0:
+            # Last line: 'import time: self [us] | cumulative [us] | module'
+            lines = [l for l in result.stderr.splitlines()
+                     if l.startswith('import time:')]
+            t = int(lines[-1].split('|')[1]) / 1e6
+        times.append((module, t))
+    return times
+
+def print_import_times(times):
+    print(f'{"module":<25s} {"import (s)":>10s}')
+    for module, t in times:
+        print(f'{module:<25s} ' + ('not installed' if t is None else f'{t:10.2f}'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a session headless')
+    parser.add_argument('--quick', action='store_true',
+                        help='small visual noise textures')
+    parser.add_argument('--imports', action='store_true',
+                        help='only report the import time of the heavy modules')
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        print_import_times(import_times())
+        return
+
+    t0 = time.perf_counter()
+    noise_em, sim = run_session(256 if args.quick else None)
+    wall = time.perf_counter() - t0
+
+    tracker = sim.trackers[0]
+    win = sim.windows[0]
+    print(f'Simulated {sim.clock():.0f} s in {wall:.1f} s '
+          f'({sim.clock() / wall:.0f} x real time)')
+    print(f'{win.n_flips} flips, {win.n_draws} draws, '
+          f'{len(noise_em.event_log)} events, '
+          f'{len(tracker.messages)} messages, {tracker.buffer.n} gaze samples')
+
+if __name__ == '__main__':
+    main()
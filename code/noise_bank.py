@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Bank of visual noise textures stored in one contiguous 3-D array
+
+Frames are kept in a compact dtype (uint8 or float16 levels) and only
+converted to the float [-1, 1] textures PsychoPy expects when they are
+uploaded. The bank can optionally be backed by a memory-mapped .npy file.
+With checks larger than a pixel, the frames only hold the grid of checks;
+the texture is expanded when drawn (or by texture(k, check_size=...)).
+
+PhiloxNoiseFrames has the same interface without a stored bank: frame k is
+computed on demand from a counter-based generator (Philox), whose counter
+can be set directly to the start of frame k. Any number of frames can be
+drawn without repeating the noise, with a memory use of a few frames.
+
+@author: Marcus
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import noise_helpers as helpers
+
+BANK_DTYPES = (np.uint8, np.float16)
+
+
+# %%
+def noise_frame(seed_seq, k, size, dtype=np.uint8):
+    ''' Generate noise frame k of a bank
+
+    Each frame is drawn from its own child stream of seed_seq, so any
+    frame can be computed independently of the others.
+
+    Args:
+        seed_seq (SeedSequence): seed of the bank
+        k (int): index of the frame
+        size (int or tuple): size of the frame (rows, cols) in pixels
+        dtype: np.uint8 (256 levels) or np.float16 ([-1, 1])
+
+    Returns:
+        frame (size array)
+    '''
+    if np.isscalar(size):
+        size = (size, size)
+
+    rng = np.random.default_rng(helpers.child_seed(seed_seq, k))
+    if np.dtype(dtype) == np.uint8:
+        return rng.integers(0, 256, size=size, dtype=np.uint8)
+
+    frame = rng.random(size, dtype=np.float32)
+    frame *= 2
+    frame -= 1
+    return frame.astype(np.float16)
+
+
+def upscale_nearest(frame, check_size, out=None):
+    ''' Expand each value of frame to a check_size x check_size check
+
+    Args:
+        frame (rows x cols array)
+        check_size (int): size of a check in pixels
+        out (array): optional (rows * check_size) x (cols * check_size) array
+
+    Returns:
+        out
+    '''
+    rows, cols = frame.shape
+    if out is None:
+        out = np.empty((rows * check_size, cols * check_size), dtype=frame.dtype)
+    out.reshape(rows, check_size, cols, check_size)[...] = \
+        frame[:, np.newaxis, :, np.newaxis]
+    return out
+
+
+def frame_texture(frame, out=None, check_size=1):
+    ''' Noise levels of a frame as a float32 texture in [-1, 1]
+
+    Args:
+        frame (rows x cols array): uint8 or float16 noise levels
+        out (array): optional float32 array to write into
+        check_size (int): expand each value of the frame to a check of
+            check_size x check_size pixels (nearest neighbour)
+
+    Returns:
+        texture (rows x cols float32 array, times check_size)
+    '''
+    rows, cols = frame.shape
+    if out is None:
+        out = np.empty((rows * check_size, cols * check_size),
+                       dtype=np.float32)
+
+    if check_size > 1:
+        frame = upscale_nearest(frame, check_size)
+    if frame.dtype == np.uint8:
+        np.multiply(frame, np.float32(1 / 127.5), out=out)
+        out -= 1
+    else:
+        out[...] = frame
+
+    return out
+
+
+# %%
+class NoiseTextureBank:
+    '''
+    n_frames x rows x cols noise levels with conversion to textures on upload
+    '''
+    def __init__(self, data):
+        '''
+        Args:
+            data (array or memmap): n_frames x rows x cols array of uint8
+                or float16 noise levels
+        '''
+        assert data.ndim == 3, 'data should be n_frames x rows x cols'
+        assert data.dtype in BANK_DTYPES, f'Unsupported dtype {data.dtype}'
+
+        self.data = data
+
+    @classmethod
+    def generate(cls, n_frames, size, seed=None, dtype=np.uint8,
+                 filename=None, workers=1):
+        ''' Generate a bank of noise frames
+
+        Args:
+            n_frames (int): number of frames in the bank
+            size (int or tuple): size of each frame (rows, cols) in pixels
+            seed (int, SeedSequence or None): seed of the noise
+            dtype: np.uint8 (256 levels) or np.float16 ([-1, 1])
+            filename (str or Path): if given, the bank is backed by a
+                memory-mapped .npy file with this name
+            workers (int): number of worker threads (None is one per core).
+                The bank is identical whatever the number of workers
+
+        Returns:
+            bank (NoiseTextureBank)
+        '''
+        if np.isscalar(size):
+            size = (size, size)
+        shape = (n_frames,) + tuple(size)
+
+        if filename is None:
+            data = np.empty(shape, dtype=dtype)
+        else:
+            data = np.lib.format.open_memmap(filename, mode='w+',
+                                             dtype=dtype, shape=shape)
+
+        seed_seq = helpers.noise_seed_sequence(seed)
+
+        def fill(k):
+            data[k] = noise_frame(seed_seq, k, size, dtype)
+
+        for _ in helpers.parallel_map(fill, n_frames, workers):
+            pass
+
+        if filename is not None:
+            data.flush()
+
+        return cls(data)
+
+    @classmethod
+    def load(cls, filename):
+        ''' Open a bank saved as a .npy file (memory-mapped, read only) '''
+        return cls(np.load(filename, mmap_mode='r'))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, k):
+        ''' Noise levels of frame k (in the compact dtype) '''
+        return self.data[k]
+
+    @property
+    def frame_size(self):
+        return self.data.shape[1:]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def texture(self, k, out=None, check_size=1):
+        ''' Frame k as a float32 texture in [-1, 1], ready for upload
+
+        Args:
+            k (int): index of the frame
+            out (array): optional float32 array to write into
+            check_size (int): expand each value of the frame to a check of
+                check_size x check_size pixels (nearest neighbour). Not
+                needed when the texture is drawn without interpolation at
+                check_size times its size, which the GPU does for free
+
+        Returns:
+            texture (rows x cols float32 array, times check_size)
+        '''
+        return frame_texture(self.data[k], out, check_size)
+
+
+# %%
+class PhiloxNoiseFrames:
+    '''
+    Noise frames computed on demand, with no stored bank and no repetition
+    '''
+    def __init__(self, size, seed=None, dtype=np.uint8, prefetch=0):
+        '''
+        Args:
+            size (int or tuple): size of each frame (rows, cols) in pixels
+            seed (int, SeedSequence or None): seed of the noise
+            dtype: np.uint8 (256 levels) or np.float16 ([-1, 1])
+            prefetch (int): number of upcoming frames computed ahead in a
+                worker thread (0 is none; frames are computed when indexed)
+        '''
+        if np.isscalar(size):
+            size = (size, size)
+        assert np.dtype(dtype) in BANK_DTYPES, f'Unsupported dtype {dtype}'
+
+        self.size = tuple(size)
+        self.dtype = np.dtype(dtype)
+        self.key = helpers.noise_seed_sequence(seed).generate_state(2, np.uint64)
+        self.prefetch = prefetch
+
+        # Recently used and prefetched frames (least recently used first)
+        self._cache = collections.OrderedDict()
+        self._cache_size = 2 * prefetch + 1
+        self._pending = {}  # k -> Future of prefetched frames
+        self._pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def frame(self, k):
+        ''' Compute frame k (the same for the same seed, in any order)
+
+        Frame k starts at counter k * 2^192 of the Philox stream, i.e., the
+        frames are non-overlapping blocks of the same stream.
+        '''
+        bit_generator = np.random.Philox(key=self.key, counter=[0, 0, 0, k])
+        n = int(np.prod(self.size))
+        if self.dtype == np.uint8:
+            raw = bit_generator.random_raw(-(-n // 8))
+            return raw.view(np.uint8)[:n].reshape(self.size)
+
+        frame = np.random.Generator(bit_generator).random(self.size,
+                                                          dtype=np.float32)
+        frame *= 2
+        frame -= 1
+        return frame.astype(np.float16)
+
+    def __getitem__(self, k):
+        ''' Noise levels of frame k (in the compact dtype) '''
+        k = int(k)
+        if k in self._cache:
+            self._cache.move_to_end(k)
+            frame = self._cache[k]
+        elif k in self._pending:
+            frame = self._pending.pop(k).result()
+        else:
+            frame = self.frame(k)
+
+        # Start computing the next frames
+        for j in range(k + 1, k + 1 + self.prefetch):
+            if j not in self._cache and j not in self._pending:
+                self._pending[j] = self._pool.submit(self.frame, j)
+        for j in [j for j in self._pending if j < k]:
+            self._pending.pop(j).cancel()
+
+        self._cache[k] = frame
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return frame
+
+    @property
+    def frame_size(self):
+        return self.size
+
+    def texture(self, k, out=None, check_size=1):
+        ''' Frame k as a float32 texture in [-1, 1] (see NoiseTextureBank) '''
+        return frame_texture(self[k], out, check_size)
+
+    def close(self):
+        ''' Stops the prefetching '''
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+        self._pending = {}
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache for generated noise assets (wav files, texture banks)
+
+Each asset is stored under a key computed from a hash of the parameters used
+to generate it (including the seed), next to a sidecar manifest (.json) with
+its size and checksum. Assets that do not match their manifest are removed
+and generated again, and the least recently used assets are evicted when
+the cache grows beyond its disk budget.
+
+@author: Marcus
+"""
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+import noise_helpers as helpers
+import noise_colour
+from noise_bank import NoiseTextureBank
+
+CACHE_VERSION = 1
+CHECK_BYTES = 1 << 16  # Bytes hashed at the start and end of a file
+MANIFEST_KEYS = ('size', 'checksum', 'last_used')  # Needed to use an asset
+
+
+# %%
+def asset_key(kind, params):
+    ''' Hash of the kind of asset and the parameters it was generated with
+
+    Args:
+        kind (str): kind of asset, e.g., 'auditory_noise'
+        params (dict): parameters (json serializable) including the seed
+
+    Returns:
+        key (str)
+    '''
+    desc = json.dumps({'kind': kind, 'version': CACHE_VERSION,
+                       'params': params}, sort_keys=True)
+    return kind + '_' + hashlib.sha1(desc.encode('utf-8')).hexdigest()[:16]
+
+def file_checksum(filename, full=False):
+    ''' Checksum of a file
+
+    By default only the first and last CHECK_BYTES bytes (and the size)
+    are hashed, which is enough to detect truncated or replaced files
+    without reading hundreds of MB.
+
+    Args:
+        filename (str or Path): file to check
+        full (bool): hash the whole file
+
+    Returns:
+        checksum (str)
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    size = os.path.getsize(filename)
+    h.update(str(size).encode('ascii'))
+    with open(filename, 'rb') as f:
+        if full or size <= 2 * CHECK_BYTES:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        else:
+            h.update(f.read(CHECK_BYTES))
+            f.seek(-CHECK_BYTES, os.SEEK_END)
+            h.update(f.read(CHECK_BYTES))
+
+    return h.hexdigest()
+
+
+# %%
+class NoiseCache:
+    '''
+    Folder with generated noise assets, keyed on their generation parameters
+    '''
+    def __init__(self, folder, max_bytes=2 * 1024**3):
+        '''
+        Args:
+            folder (str or Path): cache folder (created if needed)
+            max_bytes (int): disk budget of the cache
+        '''
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def asset_path(self, key, suffix):
+        return self.folder / (key + suffix)
+
+    def _manifest_path(self, asset_path):
+        return asset_path.with_name(asset_path.name + '.json')
+
+    def _read_manifest(self, asset_path):
+        ''' The manifest of an asset, or None if it is missing, is not valid
+        JSON or lacks any of MANIFEST_KEYS (e.g., truncated or hand-edited)
+        '''
+        try:
+            with open(self._manifest_path(asset_path), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(manifest, dict) or any(k not in manifest
+                                                 for k in MANIFEST_KEYS):
+            return None
+        return manifest
+
+    def _write_manifest(self, asset_path, manifest):
+        manifest_path = self._manifest_path(asset_path)
+        temp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(temp_path, manifest_path)
+
+    def remove(self, asset_path):
+        ''' Removes an asset and its manifest '''
+        for p in [asset_path, self._manifest_path(asset_path)]:
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                # Still memory-mapped by someone (Windows); try again later
+                pass
+
+    def lookup(self, kind, params, suffix, full_check=False):
+        ''' Returns the path to a valid cached asset, or None
+
+        An asset whose size or checksum does not match its
+        manifest is removed from the cache.
+        '''
+        asset_path = self.asset_path(asset_key(kind, params), suffix)
+        manifest = self._read_manifest(asset_path)
+        if manifest is None or not asset_path.is_file():
+            self.remove(asset_path)
+            return None
+
+        if (os.path.getsize(asset_path) != manifest['size'] or
+                file_checksum(asset_path, full_check) != manifest['checksum']):
+            self.remove(asset_path)
+            return None
+
+        manifest['last_used'] = time.time()
+        self._write_manifest(asset_path, manifest)
+
+        return asset_path
+
+    def fetch(self, kind, params, suffix, build):
+        ''' Returns the path to an asset, building it if needed
+
+        Args:
+            kind (str): kind of asset
+            params (dict): generation parameters, including the seed
+            suffix (str): file suffix, e.g., '.wav'
+            build (callable): build(path) writes the asset to path
+
+        Returns:
+            path (Path) to the asset
+        '''
+        asset_path = self.lookup(kind, params, suffix)
+        if asset_path is not None:
+            return asset_path
+
+        asset_path = self.asset_path(asset_key(kind, params), suffix)
+        build(asset_path)
+
+        now = time.time()
+        self._write_manifest(asset_path, {'kind': kind,
+                                          'params': params,
+                                          'size': os.path.getsize(asset_path),
+                                          'checksum': file_checksum(asset_path),
+                                          'created': now,
+                                          'last_used': now})
+        self.evict(keep=[asset_path])
+
+        return asset_path
+
+    def evict(self, keep=()):
+        ''' Removes least recently used assets until within the disk budget '''
+        assets = []
+        for manifest_path in self.folder.glob('*.json'):
+            asset_path = manifest_path.with_name(manifest_path.name[:-len('.json')])
+            manifest = self._read_manifest(asset_path)
+            if manifest is None or not asset_path.is_file():
+                self.remove(asset_path)
+                continue
+            assets.append((manifest['last_used'], asset_path, manifest['size']))
+
+        total = sum(a[2] for a in assets)
+        for last_used, asset_path, size in sorted(assets, key=lambda a: a[0]):
+            if total <= self.max_bytes:
+                break
+            if asset_path in keep:
+                continue
+            self.remove(asset_path)
+            total -= size
+
+
+# %%
+def auditory_noise_file(cache, fs, duration, seed, ramp_duration=1,
+                        workers=1, colour='white', band=None):
+    ''' Returns the path to a cached wav file with auditory noise
+
+    Args:
+        cache (NoiseCache): cache to use
+        fs (int): sampling frequency
+        duration (float): duration of the noise in seconds
+        seed (int): seed of the noise
+        ramp_duration (float): duration of the onset ramp in seconds
+        workers (int): number of worker threads used to generate white noise
+        colour (str): 'white' (uniform) or a colour of noise_colour, e.g., 'pink'
+        band (low, high): band of the noise (Hz), see noise_colour
+    '''
+    params = {'fs': fs, 'duration': duration, 'seed': seed,
+              'ramp_duration': ramp_duration}
+
+    if colour == 'white' and band is None:
+        def build(path):
+            helpers.write_auditory_noise_wav(path, fs, int(fs * duration), seed,
+                                             ramp_samples=int(fs * ramp_duration),
+                                             workers=workers)
+    else:
+        params.update(colour=colour, band=band, rms=noise_colour.NOISE_RMS)
+
+        def build(path):
+            noise_colour.write_coloured_noise_wav(path, fs, int(fs * duration),
+                                                  colour, seed, band,
+                                                  ramp_samples=int(fs * ramp_duration))
+
+    return cache.fetch('auditory_noise', params, '.wav', build)
+
+def visual_noise_bank(cache, n_frames, size, seed, dtype=np.uint8,
+                      workers=1):
+    ''' Returns a cached, memory-mapped bank of visual noise frames
+
+    Args:
+        cache (NoiseCache): cache to use
+        n_frames (int): number of frames in the bank
+        size (int or tuple): size of each frame (rows, cols) in pixels
+        seed (int): seed of the noise
+        dtype: np.uint8 (256 levels) or np.float16 ([-1, 1])
+        workers (int): number of worker threads used to generate the noise
+
+    Returns:
+        bank (NoiseTextureBank)
+    '''
+    params = {'n_frames': n_frames, 'size': np.atleast_1d(size).tolist(),
+              'seed': seed, 'dtype': np.dtype(dtype).name}
+
+    def build(path):
+        NoiseTextureBank.generate(n_frames, size, seed, dtype, filename=path,
+                                  workers=workers)
+
+    return NoiseTextureBank.load(cache.fetch('visual_noise', params, '.npy',
+                                             build))
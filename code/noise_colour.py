@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Spectrally shaped (coloured) auditory noise, generated block by block
+
+The uniform white noise of noise_helpers is filtered with a linear-phase FIR
+filter designed from the wanted magnitude spectrum (e.g., 1/sqrt(f) for pink
+noise), using FFT overlap-add: each block of white noise is convolved with
+the filter in the frequency domain and the tail of the convolution is added
+to the start of the next block. The output is therefore identical to
+filtering the whole (endless) noise at once, without seams between blocks,
+and memory use depends only on the filter length.
+
+All colours are scaled to NOISE_RMS, the RMS of the uniform white noise of
+noise_helpers (1/sqrt(3) = 0.58), so they are as loud (in the sense of the
+same power) as the white noise of the 'auditory' condition, which is still
+built by noise_helpers. The tails of shaped noise go beyond [-1, 1] at that
+RMS and are clipped in wav files (see ColouredNoise).
+
+Use
+    coloured_noise_chunks()     - chunks of a given length (e.g., a wav file)
+    write_coloured_noise_wav()  - wav file, written chunk by chunk
+    coloured_noise_source()     - endless source for noise_stream.NoiseStream
+
+@author: Marcus
+"""
+
+import numpy as np
+
+import noise_helpers as helpers
+
+# Exponent of the magnitude spectrum, |H(f)| = f^-exponent
+# (the power spectrum falls with 2 * exponent, e.g., 1/f for pink noise)
+COLOUR_EXPONENTS = {'white': 0, 'pink': 0.5, 'brown': 1}
+
+UNIFORM_RMS = 1 / np.sqrt(3)  # RMS of uniform noise in [-1, 1]
+NOISE_RMS = UNIFORM_RMS       # RMS of the noise of all colours
+
+
+# %%
+def spectral_gain(f, colour='pink', band=None, f_min=20):
+    ''' Magnitude spectrum of a noise colour
+
+    Args:
+        f (array): frequencies (Hz)
+        colour (str, float or callable): 'white', 'pink', 'brown', an
+            exponent (|H(f)| = f^-exponent) or a function of f
+        band (low, high): only keep frequencies in this band (Hz); None or
+            a None limit is no limit
+        f_min (float): the gain is constant below this frequency (Hz), so
+            that pink and brown noise stay finite at 0 Hz
+
+    Returns:
+        gain (array like f)
+    '''
+    f = np.asarray(f, dtype=float)
+    if callable(colour):
+        gain = np.asarray(colour(f), dtype=float)
+    else:
+        exponent = COLOUR_EXPONENTS.get(colour, colour)
+        gain = np.maximum(f, f_min) ** -float(exponent)
+
+    if band is not None:
+        low, high = band
+        if low is not None:
+            gain = np.where(f >= low, gain, 0)
+        if high is not None:
+            gain = np.where(f <= high, gain, 0)
+    return gain
+
+def design_filter(fs=48000, colour='pink', band=None, n_taps=8193, f_min=20):
+    ''' Linear-phase FIR filter with the magnitude spectrum of a colour
+
+    Designed by frequency sampling (and a Hann window), and scaled so that
+    white noise keeps its power (sum of squared taps is 1).
+
+    Args:
+        fs (int): sampling frequency
+        colour, band, f_min: see spectral_gain()
+        n_taps (int): length of the filter (odd); its frequency resolution
+            is about fs / n_taps
+
+    Returns:
+        h (n_taps array)
+    '''
+    assert n_taps % 2 == 1, 'n_taps has to be odd'
+    n = n_taps - 1
+    gain = spectral_gain(np.fft.rfftfreq(n, 1 / fs), colour, band, f_min)
+
+    # Zero-phase impulse response, centered and made symmetric
+    h = np.roll(np.fft.irfft(gain, n), n // 2)
+    h = np.append(h, h[0]) * np.hanning(n_taps)
+
+    return h / np.sqrt(np.sum(h ** 2))
+
+
+class ColouredNoise:
+    '''
+    Endless stereo coloured noise by overlap-add filtering of white noise
+    '''
+    def __init__(self, colour='pink', fs=48000, seed=None, band=None,
+                 rms=NOISE_RMS, n_taps=8193, n_fft=2**15, f_min=20):
+        '''
+        Args:
+            colour, band, f_min: see spectral_gain()
+            fs (int): sampling frequency
+            seed (int, SeedSequence or None): seed of the white noise
+            rms (float): RMS of the output (samples beyond [-1, 1] are clipped
+                when converted to int16, about 8% of them at NOISE_RMS)
+            n_taps (int): length of the filter (odd)
+            n_fft (int): FFT length; each block has n_fft - n_taps + 1 samples
+        '''
+        assert n_fft > n_taps, 'n_fft has to be longer than the filter'
+        self.fs = fs
+        self.seed_seq = helpers.noise_seed_sequence(seed)
+        self.n_taps = n_taps
+        self.n_fft = n_fft
+        self.block_size = n_fft - n_taps + 1
+
+        self.h = design_filter(fs, colour, band, n_taps, f_min)
+        self._H = np.fft.rfft(self.h * (rms / UNIFORM_RMS), n_fft)[:, np.newaxis]
+
+    def chunks(self):
+        ''' Yields blocks of block_size x 2 float32 noise, endlessly
+
+        The same seed gives the same noise. The group delay of the filter
+        ((n_taps - 1) / 2 samples, while it fills up) is trimmed from the
+        start, so the first block is that much shorter and the noise has its
+        full level from the first sample.
+        '''
+        tail = np.zeros((self.n_taps - 1, 2))
+        start = (self.n_taps - 1) // 2
+        k = 0
+        while True:
+            white = helpers.auditory_noise_chunk(self.seed_seq, k,
+                                                 self.block_size,
+                                                 (k + 1) * self.block_size)
+            y = np.fft.irfft(np.fft.rfft(white, self.n_fft, axis=0) * self._H,
+                             self.n_fft, axis=0)
+            y[:len(tail)] += tail
+            tail = y[self.block_size:self.block_size + len(tail)]
+            yield y[start:self.block_size].astype(np.float32)
+            start = 0
+            k += 1
+
+
+# %%
+def coloured_noise_chunks(n_samples, colour='pink', fs=48000, seed=None,
+                          band=None, rms=NOISE_RMS, dtype=np.float32,
+                          ramp_samples=0, **kwargs):
+    ''' Generate n_samples of stereo coloured noise, chunk by chunk
+
+    Args:
+        n_samples (int): length of noise in samples
+        colour, fs, seed, band, rms: see ColouredNoise
+        dtype: np.float32 ([-1, 1]) or np.int16 (full scale, clipped)
+        ramp_samples (int): length of sigmoid onset ramp (0 is no ramp)
+        kwargs: passed to ColouredNoise (n_taps, n_fft, f_min)
+
+    Yields:
+        chunk (block_size x 2 array), the first and last ones are shorter.
+    '''
+    ramp = helpers.sigmoid_ramp(ramp_samples).astype(np.float32) if ramp_samples else None
+
+    start = 0
+    for chunk in ColouredNoise(colour, fs, seed, band, rms, **kwargs).chunks():
+        if start >= n_samples:
+            return
+        chunk = chunk[:n_samples - start]
+
+        # Apply the part of the ramp that falls within this chunk
+        if ramp is not None and start < len(ramp):
+            stop = min(start + len(chunk), len(ramp))
+            chunk[:stop - start] *= ramp[start:stop, np.newaxis]
+        start += len(chunk)
+
+        if np.dtype(dtype) == np.int16:
+            np.clip(chunk, -1, 1, out=chunk)
+            chunk *= np.iinfo(np.int16).max
+            yield chunk.astype(np.int16)
+        else:
+            yield chunk.astype(dtype, copy=False)
+
+def write_coloured_noise_wav(filename, fs, n_samples, colour='pink', seed=None,
+                             band=None, rms=NOISE_RMS, ramp_samples=0):
+    ''' Stream stereo int16 coloured noise to a wav file, chunk by chunk
+
+    Args:
+        filename (str or Path): wav file to write
+        fs (int): sampling frequency
+        n_samples (int): length of noise in samples
+        colour, seed, band, rms: see ColouredNoise
+        ramp_samples (int): length of sigmoid onset ramp (0 is no ramp)
+    '''
+    helpers.write_wav_chunks(filename, fs, n_samples,
+                             coloured_noise_chunks(n_samples, colour, fs, seed,
+                                                   band, rms, np.int16,
+                                                   ramp_samples))
+
+def coloured_noise_source(colour='pink', seed=None, fs=48000, band=None,
+                          rms=NOISE_RMS):
+    ''' Source of coloured noise for noise_stream.NoiseStream '''
+    return ColouredNoise(colour, fs, seed, band, rms).chunks
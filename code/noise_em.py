@@ -1,26 +1,57 @@
 # -*- coding: utf-8 -*-
+"""
+Memory guided saccades (MGS) and prolonged fixation (PF) in silence,
+auditory noise and visual noise
+
+Run with python noise_em.py (or main()). Importing the module only imports
+light modules; PsychoPy is imported in main(), the parts needed for the
+participant dialog first, and Titta once the dialog is closed, so that the
+dialog shows up quickly. The time of each startup stage is kept in
+startup_times.
+
+@author: Marcus
+"""
+import time
+_t_import = time.perf_counter()
 
 # Import relevant modules
-from psychopy import prefs
-prefs.hardware['audioLib'] = ['ptb']
-prefs.hardware['audioLatencyMode'] = 1
-import psychtoolbox as ptb
-from psychopy import visual, monitors, tools, core, gui, event, sound
-import pandas as pd
-import copy
 import datetime
 import numpy as np
 from pathlib import Path
-from titta import Titta
 import noise_helpers as helpers
+import aoi
+import noise_cache
+import noise_colour
+import noise_stream
+import profiling
+import schedule
+import frame_plan
+import frame_timing
+from event_log import EventLog
+from session_writer import SessionWriter
+from noise_prep import NoisePreparation
+from noise_bank import PhiloxNoiseFrames
+from gaze_monitor import GazeMonitor
 import parameters as params
-from scipy.io.wavfile import write
 import os
 
-# Change directory to current dir
-abspath = os.path.abspath(__file__)
-dname = os.path.dirname(abspath)
-os.chdir(dname)
+# PsychoPy, psychtoolbox and Titta are imported in main()
+visual = monitors = core = gui = event = sound = ptb = Titta = None
+
+# (stage, time since import started (s)), e.g., ('dialog', 0.8)
+startup_times = [('imports', time.perf_counter() - _t_import)]
+
+def mark(stage):
+    ''' Records the time of a startup stage (and its memory use if profiled) '''
+    startup_times.append((stage, time.perf_counter() - _t_import))
+    profiling.mark(stage)
+
+def print_startup_times():
+    print(f'{"stage":<25s} {"t (s)":>8s} {"dt (s)":>8s}')
+    t_prev = 0
+    for stage, t in startup_times:
+        print(f'{stage:<25s} {t:8.2f} {t - t_prev:8.2f}')
+        t_prev = t
 
 
 # %% Class fixation marker
@@ -85,8 +116,54 @@ class FixMarker:
 ########################################
 ########################################
 
+# %%
+def check_escape():
+    ''' Quits the experiment if escape has been pressed, after saving the
+    data recorded so far as at the end of the session (the session folder
+    is not marked complete)
+    '''
+    keys = event.getKeys()
+    if 'escape' in keys:
+        win.close()
+        tracker.stop_recording(gaze=True)
+        tracker.save_data(append_version=False)
+        session_writer.finalize(complete=False)
+        event_log.save(settings.FILENAME + '.tsv')
+        core.quit()
+
+def split_condition(noise_condition):
+    ''' Splits e.g. 'visual_25' into ('visual', '25') and 'auditory' into ('auditory', '0') '''
+    temp = noise_condition.split('_')
+    if len(temp) > 1:
+        return temp[0], temp[1]
+    return noise_condition, '0'
+
+def end_condition():
+    ''' Saves data from the last condition in the background and
+    saves (and prints) a summary of its flip timing
+    '''
+    session_writer.flush()
+    rows = flip_timer.save_summary(settings.FILENAME + '_timing.tsv')
+    frame_timing.print_summary(rows)
+
+def log_gaze_events(task, condition, level, trial, x, y, training=False):
+    ''' Logs the fixation breaks and track loss since the last update, at
+    the time of the first gaze sample of each (system time stamps are in us,
+    on the clock of ptb.GetSecs())
+    '''
+    for event_name, ts in gaze_monitor.update():
+        event_log.record(ts / 1e6, task, condition, level, trial, x, y,
+                         event_name, training)
+
+def show_noise(noise, n_frames):
+    ''' Shows only visual noise for n_frames frames '''
+    plan = frame_plan.compile_plan([frame_plan.Phase('noise', n_frames,
+                                                     markers=False)],
+                                   params.mask_duration)
+    frame_plan.run_plan(win, plan, noise)
+
 # %% Task MSG
-def MGS(noise_condition, n_trials, training=False):
+def MGS(noise_condition, n_trials, trials, training=False):
     # Show instruction
     text.text = "Titta på punkten i mitten tills den försvinner. Flytta sedan ögonen till positionen där andra punkten dök upp.\
         \n\n(Tryck på mellanslagstangenten för att börja)"
@@ -96,6 +173,9 @@ def MGS(noise_condition, n_trials, training=False):
     had to remember the location of this peripheral stimulus,
     wait for the extinction of the central fixation target, and
     only after the fixation target was switched off, make a saccade directed toward the remembered stimulus location.
+
+    trials are the rows of the block in the trial schedule (target position and
+    durations in frames), with room for the repeated trials
     '''
 
     # text.draw()
@@ -115,32 +195,30 @@ def MGS(noise_condition, n_trials, training=False):
         mouse.setPos((50, 50)) # set outside of the screen
         win.mouseVisible = False
 
+    # Visual noise is only drawn in the visual noise conditions
+    trial_noise = visual_noise if 'visual' in noise_condition else None
+    overlay = (performance,) if training else ()
+
     #Play noise a bit prior to real exp starts
     if 'auditory' in noise_condition:
         auditory_noise.play()
         core.wait(1)
     elif 'visual' in noise_condition:
-        for i in range(int(monitor_refresh_rate)):
-            visual_noise[np.mod(i, params.mask_duration)].draw()
-            win.flip()
+        show_noise(trial_noise, int(monitor_refresh_rate))
     else:
         core.wait(1)
 
-    for trial in range(n_trials):
+    trial = 0
+    n_trials_run = n_trials # Grows when trials with fixation breaks are repeated
+    while trial < n_trials_run:
 
-        # Trial message
-        temp = noise_condition.split('_')
-        if len(temp) > 1:
-            # e.g, MSG_visual_25_0
-            msg = '_'.join(['MGS', temp[0], str(temp[1]), str(trial)])
-        else:
-            # e.g., MSG_auditory_0_1
-            msg = '_'.join(['MGS', noise_condition, str(0), str(trial)])
+        # Trial message, e.g, MSG_visual_25_0 or MSG_auditory_0_1
+        condition, level = split_condition(noise_condition)
+        msg = '_'.join(['MGS', condition, level, str(trial)])
 
-        # Decide direction and amplitude of target
-        rho, theta = (amplitude[np.random.randint(len(amplitude))],
-                      direction[np.random.randint(len(direction))])
-        x, y = tools.coordinatetools.pol2cart(theta, rho)
+        # Direction and amplitude of target, and durations, from the schedule
+        row = trials[trial]
+        x, y = float(row['x']), float(row['y'])
         target.pos = (x, y)
 
         if training:
@@ -152,165 +230,86 @@ def MGS(noise_condition, n_trials, training=False):
         # xy = helpers.deg2tobii(np.expand_dims(np.array([x, y]), axis=0), mon)[0]
         # print(x, y, xy)
 
-        # Present fixation cross in center of the screen for random period
-        wait_dur = np.random.rand() * (central_fixation_duration[1] \
-                                     - central_fixation_duration[0]) \
-                                     + central_fixation_duration[0]
-        # if train:
-        #     wait_dur = 100
-
-        for i in range(int(wait_dur * monitor_refresh_rate)):
-            fixation_point.draw()
-            if 'visual' in noise_condition:
-                visual_noise[np.mod(i, params.mask_duration)].draw()
-            if training:
-                performance.draw()
-            win.flip()
-            now = str(ptb.GetSecs())
-            if i == 0:
-                tracker.send_message('_'.join(['start_fixation_point', msg, position_msg]))
+        # Fixation point (random period) -> flash peripheral target ->
+        # memory delay (offset of fixation point is triggered to launch saccade) ->
+        # wait for the participant to respond (empty screen is shown [just with noise])
+        # -> finally show true target position
+        phases = [frame_plan.Phase('fixation_point', row['fixation_frames'],
+                                   stims=(fixation_point,), overlay=overlay),
+                  frame_plan.Phase('flash', row['flash_frames'],
+                                   stims=(fixation_point, target), overlay=overlay),
+                  frame_plan.Phase('memory_delay', row['memory_delay_frames'],
+                                   stims=(fixation_point,), overlay=overlay),
+                  frame_plan.Phase('saccade_window', row['saccade_window_frames'],
+                                   overlay=overlay)]
+        if show_target_after_trial:
+            phases.append(frame_plan.Phase('feedback', row['feedback_frames'],
+                                           stims=(target,), overlay=overlay,
+                                           markers=False))
+        plan = frame_plan.compile_plan(phases, params.mask_duration)
+
+        # Eye tracker time stamps of events used to score training trials
+        stamps = {}
+
+        def on_marker(event_name, now):
+            if event_name in ['start_flash', 'start_saccade_window']:
+                stamps[event_name] = tracker.get_system_time_stamp()
+
+            tracker.send_message('_'.join([event_name, msg, position_msg]))
+            if event_name == 'start_fixation_point':
                 tracker.send_message('_'.join(['onset', msg, position_msg])) # Sent to parse trials
+                gaze_monitor.reset()
 
-                # e.g, 22225_MSG_visual_25_0_0.73_-0.73_start_fixation_point
-                trial_messages.append('_'.join([now, msg, position_msg, 'start_fixation_point']))
-
-            # if train and event.getKeys():
-            #     break
-
-        tracker.send_message('_'.join(['end_fixation_point', msg, position_msg]))
-        trial_messages.append('_'.join([now, msg, position_msg, 'end_fixation_point']))
-
-        # if train:
-        #     flash_duration_frames = 10 * monitor_refresh_rate
-
-        # Flash peripheral target
-        for i in range(flash_duration_frames):
-            fixation_point.draw()
-            target.draw()
-            if 'visual' in noise_condition:
-                visual_noise[np.mod(i, params.mask_duration)].draw()
-            if training:
-                performance.draw()
-            win.flip()
-            now = str(ptb.GetSecs())
-
-            if i == 0:
-                t0 = tracker.get_system_time_stamp()
-                tracker.send_message('_'.join(['start_flash', msg, position_msg]))
-                trial_messages.append('_'.join([now, msg, position_msg, 'start_flash']))
-
-            # if train and event.getKeys():
-            #     break
-
-        tracker.send_message('_'.join(['end_flash', msg, position_msg]))
-        trial_messages.append('_'.join([now, msg, position_msg, 'end_flash']))
-
-        # Memory delay (offset of fixation point is triggered to launch saccade)
-        memory_delay_frames = int(np.random.rand() * (memory_delay[1] \
-                                     - memory_delay[0]) \
-                                     + memory_delay[0] * monitor_refresh_rate)
-
-        # if train:
-        #     memory_delay_frames = 100 * monitor_refresh_rate
-
-        for i in range(memory_delay_frames):
-            fixation_point.draw()
-            if 'visual' in noise_condition:
-                visual_noise[np.mod(i, params.mask_duration)].draw()
-            if training:
-                performance.draw()
-            win.flip()
-            now = str(ptb.GetSecs())
-
-            if i == 0:
-                tracker.send_message('_'.join(['start_memory_delay', msg, position_msg]))
-                trial_messages.append('_'.join([now, msg, position_msg, 'start_memory_delay']))
-
-            # if train and event.getKeys():
-            #     break
-
-        tracker.send_message('_'.join(['end_memory_delay', msg, position_msg]))
-        trial_messages.append('_'.join([now, msg, position_msg, 'end_memory_delay']))
-
-        # Wait for the participant to respond (empty screen is shown [just with noise])
-        for i in range(int(wait_response_duration * monitor_refresh_rate)):
-            if 'visual' in noise_condition:
-                visual_noise[np.mod(i, params.mask_duration)].draw()
-            if training:
-                performance.draw()
-            win.flip()
-            now = str(ptb.GetSecs())
-
-            if i == 0:
-                t1 = tracker.get_system_time_stamp()
-                tracker.send_message('_'.join(['start_saccade_window', msg, position_msg]))
-                trial_messages.append('_'.join([now, msg, position_msg, 'start_saccade_window']))
-
-        tracker.send_message('_'.join(['end_saccade_window', msg, position_msg]))
-        trial_messages.append('_'.join([now, msg, position_msg, 'end_saccade_window']))
-        tracker.send_message('_'.join(['offset', msg, position_msg])) # Sent to parse trial offset
-
-        t2 = tracker.get_system_time_stamp()
-
-        # Finally show true target position
-        if show_target_after_trial:
-            for i in range(int(monitor_refresh_rate * target_duration_feedback)):
-                target.draw()
-                if 'visual' in noise_condition:
-                    visual_noise[np.mod(i, params.mask_duration)].draw()
-                if training:
-                    performance.draw()
-                win.flip()
+            # Gaze has to stay on the fixation point from the flash until
+            # the saccade window
+            if event_name == 'start_flash':
+                gaze_monitor.set_aoi((0, 0), window_size)
+            elif event_name == 'start_saccade_window':
+                gaze_monitor.set_aoi(None)
+
+            event_log.record(now, 'MGS', condition, level, trial, x, y,
+                             event_name, training)
+
+            if event_name == 'end_saccade_window':
+                tracker.send_message('_'.join(['offset', msg, position_msg])) # Sent to parse trial offset
+                stamps['offset'] = tracker.get_system_time_stamp()
+
+        def on_frame(f):
+            log_gaze_events('MGS', condition, level, trial, x, y, training)
+
+        flip_timer.set_context('MGS_TRAINING' if training else 'MGS',
+                               noise_condition, trial)
+        frame_plan.run_plan(win, plan, trial_noise, on_marker, on_frame,
+                            get_time=ptb.GetSecs, timer=flip_timer)
+
+        t0 = stamps['start_flash']
+        t1 = stamps['start_saccade_window']
+        t2 = stamps['offset']
 
         if training:
 
             # Present feedback
-            samples = tracker.buffer.consume_time_range('gaze', t0, t1)
-            xy_left = helpers.tobii2deg(np.c_[samples['left_gaze_point_on_display_area_x'],
-                                              samples['left_gaze_point_on_display_area_y']], mon)
-            xy_right = helpers.tobii2deg(np.c_[samples['right_gaze_point_on_display_area_x'],
-                                              samples['right_gaze_point_on_display_area_y']], mon)
+            samples = tracker.buffer.consume_time_range('gaze', t0, t2)
+            xy = np.empty((len(samples['system_time_stamp']), 2, 2)) # samples x [left, right] x [x, y]
+            for e, eye in enumerate(eyes):
+                for d, dim in enumerate(dimensions):
+                    xy[:, e, d] = samples[f'{eye}_gaze_point_on_display_area_{dim}']
+            tobii2deg(xy, out=xy)
 
             # Were all the samples in this time window (target onset to fixation point offset) in the center of the screen
-            # (should be for a successful trial) 80% of samples should be in this window
-            # Tobii coordinate system [0, 1], center is at [0.5, 0.5]]
-            prop_samples_L = np.sum(((0.0 - window_size) < xy_left[:, 0]) & \
-               ((0.0 + window_size) > xy_left[:, 0]) & \
-               ((0.0 - window_size) < xy_left[:, 1]) & \
-               ((0.0 + window_size) > xy_left[:, 1])) / len(xy_left[:, 0])
-            prop_samples_R = np.sum(((0.0 - window_size) < xy_right[:, 0]) & \
-               ((0.0 + window_size) > xy_right[:, 0]) & \
-               ((0.0 - window_size) < xy_right[:, 1]) & \
-               ((0.0 + window_size) > xy_right[:, 1])) / len(xy_right[:, 0])
-
-            # if the best eye has more than 80% of data in the center.
-            # print(prop_samples_L, prop_samples_R)
-            if np.logical_or((prop_samples_L > 0.8), (prop_samples_R > 0.8)):
-                success0 = True
-            else:
-                success0 = False
-
-            # Get samples from the other time window (fixation point offset -> trial offset)
-            samples = tracker.buffer.consume_time_range('gaze', t1, t2)
-            xy_left = helpers.tobii2deg(np.c_[samples['left_gaze_point_on_display_area_x'],
-                                              samples['left_gaze_point_on_display_area_y']], mon)
-            xy_right = helpers.tobii2deg(np.c_[samples['right_gaze_point_on_display_area_x'],
-                                              samples['right_gaze_point_on_display_area_y']], mon)
-
-            prop_samples_L = np.sum(((x - window_size) < xy_left[:, 0]) & \
-               ((x + window_size) > xy_left[:, 0]) & \
-               ((y - window_size) < xy_left[:, 1]) & \
-               ((y + window_size) > xy_left[:, 1])) / len(xy_left[:, 0])
-            prop_samples_R = np.sum(((x - window_size) < xy_right[:, 0]) & \
-               ((x + window_size) > xy_right[:, 0]) & \
-               ((y - window_size) < xy_right[:, 1]) & \
-               ((y + window_size) > xy_right[:, 1])) / len(xy_right[:, 0])
-
-            # if the best eye has more than 5% of data in the target area
-            if np.logical_or((prop_samples_L > 0.05), (prop_samples_R > 0.05)):
-                success1 = True
-            else:
-                success1 = False
+            # (should be for a successful trial) 80% of samples should be in this window.
+            # In the other time window (fixation point offset -> trial offset),
+            # 5% of samples should be in the target area
+            windows = aoi.AOIs()
+            windows.add_rect((0.0, 0.0), window_size, time_range=(t0, t1))
+            windows.add_rect((x, y), window_size, time_range=(t1, np.inf))
+            prop_samples, _ = aoi.score_aois(xy, windows,
+                                             samples['system_time_stamp'])
+
+            # if the best eye has more than 80% of data in the center
+            # and more than 5% of data in the target area
+            success0 = np.any(prop_samples[0] > 0.8)
+            success1 = np.any(prop_samples[1] > 0.05)
 
             # print(success0, success1)
             success = success0 & success1
@@ -326,20 +325,25 @@ def MGS(noise_condition, n_trials, training=False):
             #         visual_noise[np.mod(i, params.mask_duration)].draw()
             #     win.flip()
 
+        # Run an extra trial if fixation was broken before the saccade window
+        if (repeat_broken_trials and not training and gaze_monitor.n_breaks > 0
+                and n_trials_run - n_trials < max_repeated_trials):
+            n_trials_run += 1
+
         # interrupt?
-        keys = event.getKeys()
-        if 'escape' in keys:
-            win.close()
-            core.quit()
+        check_escape()
+        trial += 1
 
     win.flip()
     if 'auditory' in noise_condition:
         auditory_noise.stop()
 
+    end_condition()
+
     return n_correct_trials
 
 # %% Task PF
-def PF(noise_condition):
+def PF(noise_condition, trials):
     '''
     In the ocular fixation task, the child was instructed to
     look at a fixation cross at the center of a computer
@@ -349,6 +353,8 @@ def PF(noise_condition):
     Interest (AOI) covering the fixation cross
     plus ~2 visual degrees (Munoz et al., 2003)
     served as the dependent variable
+
+    trials are the rows of the block in the trial schedule
     '''
     text.text = "Titta på punkten i mitten hela tiden den visas \
         \n\n(Tryck på mellanslagstangenten för att börja)"
@@ -360,52 +366,57 @@ def PF(noise_condition):
     '''
     Falck-Ytter, T., Pettersson, E., Bölte, S., D'Onofrio, B., Lichtenstein, P., & Kennedy, D. P. (2020). Difficulties maintaining prolonged fixation and attention-deficit/hyperactivity symptoms share genetic influences in childhood. Psychiatry Research, 293, 113384.'''
 
+    # Visual noise is only drawn in the visual noise conditions
+    trial_noise = visual_noise if 'visual' in noise_condition else None
+
     #Play noise a bit prior to real exp starts
     if 'auditory' in noise_condition:
         auditory_noise.play()
         core.wait(1)
     if 'visual' in noise_condition:
-        for i in range(int(monitor_refresh_rate)):
-            visual_noise[np.mod(i, params.mask_duration)].draw()
-            win.flip()
+        show_noise(trial_noise, int(monitor_refresh_rate))
 
-    for trial in range(1):
+    for trial in range(len(trials)):
 
-        # Trial message
-        temp = noise_condition.split('_')
-        if len(temp) > 1:
-            # e.g, FIX_visual_25_0
-            msg = '_'.join(['FIX', temp[0], str(temp[1]), str(trial)])
-        else:
-            msg = '_'.join(['FIX', noise_condition, str(0), str(trial)])
+        # Trial message, e.g, FIX_visual_25_0
+        condition, level = split_condition(noise_condition)
+        msg = '_'.join(['FIX', condition, level, str(trial)])
 
         # Look at the dot for a prolonged period of time
         target.pos = (0, 0)
-        for i in range(int(long_fixation_duration * monitor_refresh_rate)):
-            fixation_point.draw()
-            if 'visual' in noise_condition:
-                visual_noise[np.mod(i, params.mask_duration)].draw()
-            win.flip()
-            now = str(ptb.GetSecs())
-
-            if i == 0:
+        plan = frame_plan.compile_plan([frame_plan.Phase('fixation',
+                                            trials[trial]['fixation_frames'],
+                                            stims=(fixation_point,),
+                                            start_event='start', end_event='end')],
+                                       params.mask_duration)
+
+        def on_marker(event_name, now):
+            if event_name == 'start':
                 tracker.send_message('_'.join(['onset', msg]))
-                trial_messages.append('_'.join([now, msg, '0_0', 'start']))
+                gaze_monitor.reset()
+                gaze_monitor.set_aoi((0, 0), window_size)
+            else:
+                tracker.send_message('_'.join(['offset', msg]))
+                gaze_monitor.set_aoi(None)
+            event_log.record(now, 'FIX', condition, level, trial, 0, 0,
+                             event_name)
 
-            # interrupt?
-            keys = event.getKeys()
-            if 'escape' in keys:
-                win.close()
-                core.quit()
+        # interrupt? (checked every frame)
+        def on_frame(f):
+            check_escape()
+            log_gaze_events('FIX', condition, level, trial, 0, 0)
 
-        tracker.send_message('_'.join(['offset', msg]))
-        trial_messages.append('_'.join([now, msg, '0_0', 'end']))
+        flip_timer.set_context('FIX', noise_condition, trial)
+        frame_plan.run_plan(win, plan, trial_noise, on_marker, on_frame,
+                            get_time=ptb.GetSecs, timer=flip_timer)
 
 
     win.flip()
     if 'auditory' in noise_condition:
         auditory_noise.stop()
 
+    end_condition()
+
 # %%
 def pause():
     text.text = 'Ta en paus!'
@@ -455,31 +466,33 @@ target_duration_feedback = 1
 # Parameters long fixation
 long_fixation_duration = 60 #60 # sec
 
+# Live monitoring of gaze (fixation breaks and track loss are logged as events)
+min_fixation_break_duration = 0.1 # sec outside the fixation window
+min_track_loss_duration = 0.25 # sec with both eyes lost
+repeat_broken_trials = False # Run an extra MGS trial for each trial with a fixation break
+max_repeated_trials = 10 # per condition
+
 noise_conditions = ['silence', 'auditory', 'visual_25', 'visual_50']
+schedule_seed = None # Seed of the trial schedule (condition orders, targets and durations).
+                     # None is a new seed; it is printed, sent to the eye tracker and
+                     # saved with the schedule in <FILENAME>_session/schedule.tsv
+schedule_file = None # Replay the schedule.tsv of an earlier session instead
+training_rounds = 10 # MGS training rounds in the schedule (further rounds reuse them)
 
 fs_audio = 48000
-trial_messages = []
+event_log = EventLog() # Trial events, saved to <FILENAME>.tsv
 
 duration_auditory_noise = 5 * 60 # in seconds
-sound_file = Path.cwd() / "white_noise.wav"
-
-# Pause instructions
-pause_instructions = sound.Sound("paus.wav")
-
-
-# %%
-myDlg = gui.Dlg(title="MS exp")
-myDlg.addField('Participant ID:')
-
-ok_data = myDlg.show()  # show dialog and wait for OK or Cancel
-if myDlg.OK:  # if ok_data is not None
-    print(ok_data)
-else:
-    print('user cancelled')
-    core.quit()
-
-
-pid = myDlg.data[0]
+noise_seed = 20201109 # Seed of the generated noise (part of the cache key)
+auditory_noise_colour = 'white' # 'white' (uniform), 'pink' or 'brown', all at the same RMS (see noise_colour)
+auditory_noise_band = None # (low, high) in Hz, e.g., (500, 4000), or None
+visual_noise_on_demand = False # Compute each visual noise frame when it is shown (the noise
+                               # never repeats) instead of cycling through a bank of
+                               # params.mask_duration frames
+profile_startup = False # Record wall time and memory use (RSS, tracemalloc peak) of
+                        # each startup stage, saved to <FILENAME>_session/profile.tsv
+stream_auditory_noise = False # Generate the auditory noise while it plays (no duration
+                              # limit, bounded memory) instead of playing the wav file
 
 # %%  Monitor/geometry
 MY_MONITOR = 'testMonitor'  # needs to exists in PsychoPy monitor center
@@ -489,181 +502,311 @@ SCREEN_WIDTH = 52.7  # cm
 VIEWING_DIST = 63  # distance from eye to center of screen (cm)
 
 monitor_refresh_rate = 60  # frames per second (fps)
-mon = monitors.Monitor(MY_MONITOR)  # Defined in defaults file
-mon.setWidth(SCREEN_WIDTH)          # Width of screen (cm)
-mon.setDistance(VIEWING_DIST)       # Distance eye / monitor (cm)
-mon.setSizePix(SCREEN_RES)
 
-flash_duration_frames = int(monitor_refresh_rate * flash_duration)
+# Time stamps of all flips (to detect dropped frames)
+flip_timer = frame_timing.FlipTimer(monitor_refresh_rate)
 
 # %%  ET settings
 et_name = 'Tobii Pro Spectrum'
 
-# Change any of the default dettings?e
-settings = Titta.get_defaults(et_name)
-settings.FILENAME = pid  + '_' + datetime.datetime.now().strftime("%H_%M_%S")
-settings.N_CAL_TARGETS = 5
-settings.DEBUG = False
-settings.SAMPLING_RATE = 600
-
-
-# %% Connect to eye tracker and calibrate
-tracker = Titta.Connect(settings)
-if dummy_mode:
-    tracker.set_dummy_mode()
-tracker.init()
-
-# Window set-up (this color will be used for calibration)
-win = visual.Window(monitor=mon, fullscr=FULLSCREEN,
-                    screen=1, size=SCREEN_RES, units='deg')
-
-fixation_point = FixMarker(win, outer_diameter=1.0, inner_diameter=0.2)
-# fixation_cross = visual.TextStim(win, text='+', height=1)
-target = visual.Circle(win, fillColor = 'white', radius = 0.5)
-
-text = visual.TextStim(win, text='', height=1, color='white')
-performance = visual.TextStim(win, text=f'0/{n_trials_practise}', height=0.1, color='white',
-                              units='norm', pos=(-0.8, 0.8))
-
-# Check screen refresh rate
-measured_rate = win.getActualFrameRate()
-assert ((measured_rate < (monitor_refresh_rate  + 1)) & \
-        (measured_rate > (monitor_refresh_rate  - 1))),\
-        f"Screen refresh rate should be {monitor_refresh_rate}, \
-        but is {measured_rate}"
-
-# %% Generate noise
-
-text.text = 'Skapar brus. Vänta!'
-text.draw()
-win.flip()
-
-noise_array = helpers.generate_auditory_noise(fs_audio * duration_auditory_noise)
-
-# Ramp up noise slowly
-x = np.linspace(-fs_audio, fs_audio, fs_audio)
-z = 1/(1 + np.exp(-1/(fs_audio/4)*x))
-noise_array[:fs_audio] = noise_array[:fs_audio] * np.c_[z,z]
-
-# Create file with noise if it does not already exist
-if not sound_file.is_file():
-    max_amplitude = np.iinfo(np.int16).max
-    noise_array = max_amplitude * noise_array
-    write("white_noise.wav", fs_audio, noise_array.astype(np.int16))
-auditory_noise = sound.Sound("white_noise.wav")
-
-visual_noise_25 = helpers.generate_visual_noise(win, params.mask_duration,
-                          params.visualNoiseSize, 0.25)
 
-visual_noise_50 = helpers.generate_visual_noise(win, params.mask_duration,
-                          params.visualNoiseSize, 0.50)
-
-# %% ET setup
+# %%
+def import_psychopy():
+    ''' Imports the parts of PsychoPy that are needed for the dialog, with
+    the audio settings (which have to be made before psychopy.sound is imported)
+    '''
+    global core, gui
+    from psychopy import prefs
+    prefs.hardware['audioLib'] = ['ptb']
+    prefs.hardware['audioLatencyMode'] = 1
+    from psychopy import core, gui
+
+def import_stimuli():
+    ''' Imports the rest of PsychoPy and psychtoolbox (after the dialog) '''
+    global visual, monitors, event, sound, ptb
+    import psychtoolbox as ptb
+    from psychopy import visual, monitors, event, sound
+
+def main():
+    ''' Runs a session: dialog, calibration, MGS, PF and MGS '''
+    global pid, mon, tobii2deg, settings, tracker, Titta
+    global win, fixation_point, target, text, performance, mouse
+    global pause_instructions, auditory_noise, visual_noise
+    global visual_noise_levels, session_writer, gaze_monitor
+
+    # Change directory to current dir
+    abspath = os.path.abspath(__file__)
+    dname = os.path.dirname(abspath)
+    os.chdir(dname)
+
+    if profile_startup:
+        profiling.enable()
+
+    import_psychopy()
+    mark('import psychopy.gui')
+
+    # %%
+    myDlg = gui.Dlg(title="MS exp")
+    myDlg.addField('Participant ID:')
+    mark('dialog')
+
+    ok_data = myDlg.show()  # show dialog and wait for OK or Cancel
+    if myDlg.OK:  # if ok_data is not None
+        print(ok_data)
+    else:
+        print('user cancelled')
+        core.quit()
+
+    pid = myDlg.data[0]
+    mark('participant ID entered')
+
+    import_stimuli()
+    mark('import psychopy')
+
+    # Pause instructions
+    pause_instructions = sound.Sound("paus.wav")
+
+    # %%  Monitor/geometry
+    mon = monitors.Monitor(MY_MONITOR)  # Defined in defaults file
+    mon.setWidth(SCREEN_WIDTH)          # Width of screen (cm)
+    mon.setDistance(VIEWING_DIST)       # Distance eye / monitor (cm)
+    mon.setSizePix(SCREEN_RES)
+
+    # Tobii coordinates -> deg for this monitor
+    tobii2deg = helpers.Tobii2Deg(mon)
+
+    # %% Start preparing auditory and visual noise in a worker thread
+    asset_cache = noise_cache.NoiseCache(Path.cwd() / 'noise_cache',
+                                         max_bytes=2 * 1024**3)
+    noise_preparation = NoisePreparation(asset_cache, fs_audio,
+                                         duration_auditory_noise,
+                                         params.mask_duration,
+                                         params.visualNoiseSize,
+                                         noise_seed,
+                                         colour=auditory_noise_colour,
+                                         band=auditory_noise_band,
+                                         check_size=params.visualNoiseCheckSize,
+                                         visual_bank=not visual_noise_on_demand).start()
+    if profile_startup:
+        # One stage at the time, so that the memory of each stage is its own
+        noise_preparation.wait()
+        mark('noise preparation')
+
+    # %%  ET settings
+    from titta import Titta
+    mark('import titta')
+
+    # Change any of the default dettings?e
+    settings = Titta.get_defaults(et_name)
+    settings.FILENAME = pid  + '_' + datetime.datetime.now().strftime("%H_%M_%S")
+    settings.N_CAL_TARGETS = 5
+    settings.DEBUG = False
+    settings.SAMPLING_RATE = 600
+
+    # %% Connect to eye tracker and calibrate
+    with profiling.stage('tracker init'):
+        tracker = Titta.Connect(settings)
+        if dummy_mode:
+            tracker.set_dummy_mode()
+        tracker.init()
+    mark('tracker connected')
+
+    # Fixation breaks and track loss during the trials (from the live gaze)
+    gaze_monitor = GazeMonitor(tracker, tobii2deg, settings.SAMPLING_RATE,
+                               min_fixation_break_duration,
+                               min_track_loss_duration)
+
+    # Window set-up (this color will be used for calibration)
+    win = visual.Window(monitor=mon, fullscr=FULLSCREEN,
+                        screen=1, size=SCREEN_RES, units='deg')
+
+    fixation_point = FixMarker(win, outer_diameter=1.0, inner_diameter=0.2)
+    # fixation_cross = visual.TextStim(win, text='+', height=1)
+    target = visual.Circle(win, fillColor = 'white', radius = 0.5)
+
+    text = visual.TextStim(win, text='', height=1, color='white')
+    performance = visual.TextStim(win, text=f'0/{n_trials_practise}', height=0.1, color='white',
+                                  units='norm', pos=(-0.8, 0.8))
+
+    # Check screen refresh rate
+    measured_rate = win.getActualFrameRate()
+    assert ((measured_rate < (monitor_refresh_rate  + 1)) & \
+            (measured_rate > (monitor_refresh_rate  - 1))),\
+            f"Screen refresh rate should be {monitor_refresh_rate}, \
+            but is {measured_rate}"
+    mark('window')
+
+    # %% ET setup
+
+    #  Calibratse (the noise is prepared in the background meanwhile)
+    tracker.calibrate(win)
+    win.flip()
+    mark('calibration')
 
-#  Calibratse
-tracker.calibrate(win)
-win.flip()
+    # %% Load noise and upload visual noise (has to be done in the main thread)
 
-mouse = event.Mouse(win)
+    if not noise_preparation.ready():
+        text.text = 'Skapar brus. Vänta!'
+        text.draw()
+        win.flip()
 
+    # Noise file and texture bank, ramped up over 1 s and read from the cache if valid
+    sound_file, noise_bank = noise_preparation.wait()
+    mark('wait for noise')
 
-# %% RUN tasks
-# np.random.shuffle(tasks) # MGS always first
-np.random.shuffle(noise_conditions)
+    if stream_auditory_noise:
+        if auditory_noise_colour == 'white' and auditory_noise_band is None:
+            source = noise_stream.white_noise_source(noise_seed)
+        else:
+            source = noise_colour.coloured_noise_source(auditory_noise_colour,
+                                                        noise_seed, fs_audio,
+                                                        auditory_noise_band)
+        auditory_noise = noise_stream.SoundDeviceOutput(noise_stream.NoiseStream(
+            source, fs_audio, ramp_duration=1))
+    else:
+        with profiling.stage('load auditory noise'):
+            auditory_noise = sound.Sound(str(sound_file))
+
+    # Upload the visual noise once and draw it with the opacity of each condition
+    # e.g., 'visual_25' -> 0.25
+    noise_opacities = {c: int(c.split('_')[1]) / 100
+                       for c in noise_conditions if 'visual' in c}
+    if visual_noise_on_demand:
+        noise_frames = PhiloxNoiseFrames(helpers.noise_grid_shape(params.visualNoiseSize,
+                                                                  params.visualNoiseCheckSize),
+                                         noise_seed)  # Computed ahead by the stream
+        visual_noise_levels = helpers.visual_noise_stream_levels(win, noise_frames,
+                                  noise_opacities, params.visualNoiseCheckSize)
+    else:
+        visual_noise_levels = helpers.generate_visual_noise_levels(win, params.mask_duration,
+                                  params.visualNoiseSize, noise_opacities, noise_bank,
+                                  check_size=params.visualNoiseCheckSize)
+    win.clearBuffer() # Clear buffer from drawings of noise
+    win.flip()
+    mark('noise ready')
+
+    mouse = event.Mouse(win)
+
+    # Save events (and gaze) incrementally so that an interrupted session can be recovered
+    session_writer = SessionWriter(settings.FILENAME + '_session', event_log,
+                                   tracker=None if dummy_mode else tracker,
+                                   interval=30).start()
+
+    print_startup_times()
+    if profile_startup:
+        profiling.print_table()
+        profiling.save(os.path.join(session_writer.folder, 'profile.tsv'))
+        profiling.disable()  # tracemalloc would slow down the trials
+
+    # %% Trial schedule of the whole session (MGS always first)
+    if schedule_file is None:
+        trial_schedule = schedule.compile_schedule(
+            schedule_seed, noise_conditions, n_trials, n_trials_practise,
+            max_repeated_trials, amplitude, direction, central_fixation_duration,
+            memory_delay, flash_duration, wait_response_duration,
+            target_duration_feedback, long_fixation_duration, monitor_refresh_rate,
+            training_rounds)
+    else:
+        trial_schedule = schedule.TrialSchedule.load(schedule_file)
+    trial_schedule.save(os.path.join(session_writer.folder, 'schedule.tsv'))
+    tracker.send_message(f'schedule_seed_{trial_schedule.seed}')
+    print(f'Trial schedule seed: {trial_schedule.seed}')
 
-mouse.setPos((50, 50)) # set outside of the screen
-# mouse.setVisible(False)
+    mgs_blocks = trial_schedule.blocks('MGS')
+    pf_blocks = trial_schedule.blocks('FIX')
 
-if not dummy_mode:
-    win.mouseVisible = False
+    # %% RUN tasks
 
+    mouse.setPos((50, 50)) # set outside of the screen
+    # mouse.setVisible(False)
 
-# %%Run MGS for the first two noise conditions
-tracker.start_recording(gaze=True)
+    if not dummy_mode:
+        win.mouseVisible = False
 
-noise_conditions_msg = copy.deepcopy(noise_conditions)
-for j, noise_condition in enumerate(noise_conditions_msg[:2]):
 
-    # Adjust visual noise level
-    if '_25' in noise_condition:
-        visual_noise = visual_noise_25
-    if '_50' in noise_condition:
-        visual_noise = visual_noise_50
+    # %%Run MGS for the first two noise conditions
+    tracker.start_recording(gaze=True)
 
-    # Practice until ready (only first noise condition)
-    if j == 0:
-        while True:
-            n_correct_trials = MGS(noise_condition, n_trials_practise, training=True)
-            text.text = f'{n_correct_trials}/{n_trials_practise} correct. More training (y/n)'
-            text.draw()
-            win.flip()
-            k = event.waitKeys(keyList=['y', 'n'])
-            win.flip()
+    for j, trials in enumerate(mgs_blocks[:2]):
+        noise_condition = str(trials['noise_condition'][0])
 
-            if 'n' in k:
-                break
+        # Adjust visual noise level
+        if 'visual' in noise_condition:
+            visual_noise = visual_noise_levels[noise_condition]
 
-    # Run experimental trials of MSG
-    MGS(noise_condition, n_trials)
+        # Practice until ready (only first noise condition)
+        if j == 0:
+            training_round = 0
+            while True:
+                n_correct_trials = MGS(noise_condition, n_trials_practise,
+                                       trial_schedule.training_round(training_round,
+                                                                     n_trials_practise),
+                                       training=True)
+                training_round += 1
+                text.text = f'{n_correct_trials}/{n_trials_practise} correct. More training (y/n)'
+                text.draw()
+                win.flip()
+                k = event.waitKeys(keyList=['y', 'n'])
+                win.flip()
 
-tracker.stop_recording(gaze=True)
+                if 'n' in k:
+                    break
 
-# %% Pause
-pause()
+        # Run experimental trials of MSG
+        MGS(noise_condition, n_trials, trials)
 
-# %% Run PF (four conditions)
-tracker.start_recording(gaze=True)
+    tracker.stop_recording(gaze=True)
 
-np.random.shuffle(noise_conditions)
-for j, noise_condition in enumerate(noise_conditions):
+    # %% Pause
+    pause()
 
-    # Adjust visual noise level
-    if '_25' in noise_condition:
-        visual_noise = visual_noise_25
-    if '_50' in noise_condition:
-        visual_noise = visual_noise_50
+    # %% Run PF (four conditions)
+    tracker.start_recording(gaze=True)
 
-    PF(noise_condition)
+    for j, trials in enumerate(pf_blocks):
+        noise_condition = str(trials['noise_condition'][0])
 
-tracker.stop_recording(gaze=True)
+        # Adjust visual noise level
+        if 'visual' in noise_condition:
+            visual_noise = visual_noise_levels[noise_condition]
 
-# %% Pause
-pause()
+        PF(noise_condition, trials)
 
-# %%Run MGS for the last two noise conditions
-tracker.start_recording(gaze=True)
+    tracker.stop_recording(gaze=True)
 
-for j, noise_condition in enumerate(noise_conditions_msg[2:]):
+    # %% Pause
+    pause()
 
-    # Adjust visual noise level
-    if '_25' in noise_condition:
-        visual_noise = visual_noise_25
-    if '_50' in noise_condition:
-        visual_noise = visual_noise_50
+    # %%Run MGS for the last two noise conditions
+    tracker.start_recording(gaze=True)
 
-    # Run experimental trials of MSG
-    MGS(noise_condition, n_trials)
+    for j, trials in enumerate(mgs_blocks[2:]):
+        noise_condition = str(trials['noise_condition'][0])
 
-tracker.stop_recording(gaze=True)
-# %%
+        # Adjust visual noise level
+        if 'visual' in noise_condition:
+            visual_noise = visual_noise_levels[noise_condition]
 
-# Close window and save data
-text.text = 'Nu är det slut! Ta av dig hörlurarna men sitt kvar på din plats.'
-text.draw()
-win.flip()
-core.wait(10)
+        # Run experimental trials of MSG
+        MGS(noise_condition, n_trials, trials)
 
-win.close()
+    tracker.stop_recording(gaze=True)
+    # %%
 
-tracker.save_data(append_version=False)
+    # Close window and save data
+    text.text = 'Nu är det slut! Ta av dig hörlurarna men sitt kvar på din plats.'
+    text.draw()
+    win.flip()
+    core.wait(10)
 
-# Save trial messages to dataframe
-df = pd.DataFrame(trial_messages, columns=['all'])
-df1 = df['all'].str.split("_", n = 7, expand = True)
+    win.close()
 
-# e.g., ['MSG', 'visual', 25, 3, 0.73, -0.73, 'start_saccade_window']
-df1.columns = ['time', 'task', 'noise_condition', 'noise_level', 'trial',
-               'target_x', 'target_y', 'event']
+    tracker.save_data(append_version=False)
 
-df1.to_csv(settings.FILENAME + '.tsv', sep='\t')
+    # Save trial events
+    # e.g., [time, 'MGS', 'visual', '25', 3, 0.73, -0.73, 'start_saccade_window', False]
+    session_writer.finalize()
+    event_log.save(settings.FILENAME + '.tsv')
 
+if __name__ == '__main__':
+    main()
@@ -6,76 +6,529 @@ Created on Mon Nov  9 12:46:57 2020
 """
 
 import numpy as np
-from psychopy import visual
-from psychopy.tools.monitorunittools import cm2deg, deg2pix
-import copy
+import collections
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
 
 
 # %%
+class Tobii2Deg:
+    ''' Converts Tobiis coordinate system [0, 1] to degrees.
+    Note that the Tobii coordinate system start in the upper left corner
+    and the PsychoPy coordinate system in the center
+    Assumes pixels are square
+
+    The monitor is queried once, when the transform is created. Without
+    correction for the flat screen, the whole conversion is one affine
+    transform (scale and offset per axis).
+    '''
+    def __init__(self, mon, correctFlat=False):
+        '''
+        Args:   mon: PsychoPy monitor
+                correctFlat: correct for the flat screen (as in cm2deg)
+        '''
+        width = mon.getWidth()
+        size_pix = mon.getSizePix()
+        self.distance = mon.getDistance()
+        self.correctFlat = correctFlat
+
+        # Normalized -> cm (center, flip y, scale)
+        cm_scale = np.array([width,
+                             -width * (float(size_pix[1]) / float(size_pix[0]))])
+        cm_offset = -0.5 * cm_scale
+
+        if correctFlat:
+            self.scale, self.offset = cm_scale, cm_offset
+        else:
+            # cm -> deg is a scale factor (see cm2deg)
+            self.scale = cm_scale / (self.distance * 0.017455)
+            self.offset = cm_offset / (self.distance * 0.017455)
+
+        # [sx, sy, sx, sy, ...] and [ox, oy, ...] per dtype, grown on demand,
+        # so that the flattened data can be transformed in two contiguous passes
+        self._flat = {}
+
+    def _flat_scale_offset(self, size, dtype):
+        scale, offset = self._flat.get(dtype, (np.zeros(0), np.zeros(0)))
+        if len(scale) < size:
+            n = max(size, 2 * len(scale)) // 2
+            scale = np.tile(self.scale, n).astype(dtype)
+            offset = np.tile(self.offset, n).astype(dtype)
+            self._flat[dtype] = (scale, offset)
+        return scale[:size], offset[:size]
+
+    def __call__(self, pos, out=None):
+        '''
+        Args:   pos: ... x 2 array with positions in [0, 1], e.g., N x 2 or
+                     N x 2 (eyes) x 2 for stacked left/right eyes.
+                     float32 input gives float32 output
+                out: optional contiguous array (same shape as pos) to write
+                     the result into; may be pos itself
+        Returns:
+            pos_deg (same shape as pos)
+        '''
+        pos = np.asarray(pos)
+        if out is None:
+            dtype = pos.dtype if pos.dtype == np.float32 else np.float64
+            out = np.empty(pos.shape, dtype=dtype)
+
+        assert out.flags.c_contiguous, 'out has to be C contiguous'
+        flat_out = out.reshape(-1)
+        scale, offset = self._flat_scale_offset(flat_out.size,
+                                                flat_out.dtype.type)
+        np.multiply(pos.reshape(-1), scale, out=flat_out)
+        flat_out += offset
+
+        if self.correctFlat:
+            out /= self.distance
+            np.arctan(out, out=out)
+            np.degrees(out, out=out)
+
+        return out
+
 def tobii2deg(pos, mon):
     ''' Converts Tobiis coordinate system [0, 1 to degrees.
     Note that the Tobii coordinate system start in the upper left corner
     and the PsychoPy coordinate system in the center
     Assumes pixels are square
     Args:   pos: N x 2 array with calibratio position in [0, 1]
-            screen_height: height of screen in cm
+            mon: PsychoPy monitor
+
+    Use a Tobii2Deg object instead when converting many blocks of data
+    with the same monitor.
     '''
+    return Tobii2Deg(mon)(pos)
 
-    pos_temp = copy.deepcopy(pos) # To avoid that the called parameter is changed
+# %%
+def sigmoid_ramp(n_samples):
+    ''' Sigmoid onset ramp used to fade in the auditory noise
 
-    # Center
-    pos_temp[:, 0] = pos_temp[:, 0] - 0.5
-    pos_temp[:, 1] = (pos_temp[:, 1] - 0.5) * -1
+    Args:
+        n_samples (int): length of the ramp in samples
 
-    # Cenvert to psychopy coordinates (center)
-    pos_temp[:, 0] = pos_temp[:, 0] * mon.getWidth()
-    pos_temp[:, 1] = pos_temp[:, 1] * mon.getWidth() * (float(mon.getSizePix()[1]) / \
-                                              float(mon.getSizePix()[0]))
+    Returns:
+        ramp (n_samples array) rising from ~0 to ~1.
 
-    # Convert to deg.
-    pos_deg = cm2deg(pos_temp, mon, correctFlat=False)
-    return pos_deg
+    '''
+    x = np.linspace(-n_samples, n_samples, n_samples)
+    return 1/(1 + np.exp(-1/(n_samples/4)*x))
 
-# %%
-def generate_auditory_noise(n_samples):
+def noise_seed_sequence(seed):
+    ''' Returns a SeedSequence from an int, None or a SeedSequence '''
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+def child_seed(seed_seq, k):
+    ''' Child k of seed_seq, i.e., what seed_seq.spawn() would give
+    as its k:th child, but without having to spawn all previous ones
+    '''
+    return np.random.SeedSequence(seed_seq.entropy,
+                                  spawn_key=seed_seq.spawn_key + (k,),
+                                  pool_size=seed_seq.pool_size)
+
+def parallel_map(fn, n, workers=1):
+    ''' Yields fn(0), fn(1), ..., fn(n - 1) in order, computed in worker threads
+
+    At most 2 * workers results are pending at the time, so memory use stays
+    bounded when the results are consumed as a stream. Numpy's random
+    generators release the GIL while filling arrays, so threads scale.
+
+    Args:
+        fn (callable): function of the index k
+        n (int): number of indices
+        workers (int): number of worker threads (None is one per core)
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or n <= 1:
+        for k in range(n):
+            yield fn(k)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for k in range(n):
+            pending.append(pool.submit(fn, k))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def auditory_noise_chunk(seed_seq, k, chunk_size, n_samples,
+                         dtype=np.float32, ramp=None):
+    ''' Generate chunk k of a stereo white noise stream
+
+    Each chunk is drawn from its own child stream of seed_seq, so any chunk
+    can be computed independently of the others.
+
+    Args:
+        seed_seq (SeedSequence): seed of the whole stream
+        k (int): index of the chunk
+        chunk_size (int): number of samples in a (full) chunk
+        n_samples (int): total length of the stream in samples
+        dtype: np.float32 ([-1, 1]) or np.int16 (full scale)
+        ramp (array): onset ramp applied to the first len(ramp) samples
+
+    Returns:
+        chunk (M x 2 array), where M <= chunk_size.
+
+    '''
+    start = k * chunk_size
+    n = min(chunk_size, n_samples - start)
+
+    rng = np.random.default_rng(child_seed(seed_seq, k))
+    chunk = rng.random((n, 2), dtype=np.float32)
+    chunk *= 2
+    chunk -= 1
+
+    # Apply the part of the ramp that falls within this chunk
+    if ramp is not None and start < len(ramp):
+        stop = min(start + n, len(ramp))
+        chunk[:stop - start] *= ramp[start:stop, np.newaxis]
+
+    if np.dtype(dtype) == np.int16:
+        chunk *= np.iinfo(np.int16).max
+        return chunk.astype(np.int16)
+
+    return chunk.astype(dtype, copy=False)
+
+def auditory_noise_chunks(n_samples, chunk_size=48000, seed=None,
+                          dtype=np.float32, ramp_samples=0, workers=1):
+    ''' Generate stereo white noise from a uniform distribution, chunk by chunk
+
+    Only a few chunks are in memory at the time, so memory use does not
+    depend on n_samples. The output is identical for the same
+    seed and chunk_size, whatever the number of workers.
+
+    Args:
+        n_samples (int): length of noise in samples
+        chunk_size (int): samples per chunk (the last chunk may be shorter)
+        seed (int, SeedSequence or None): seed of the noise
+        dtype: np.float32 ([-1, 1]) or np.int16 (full scale)
+        ramp_samples (int): length of sigmoid onset ramp (0 is no ramp)
+        workers (int): number of worker threads (None is one per core)
+
+    Yields:
+        chunk (chunk_size x 2 array).
+
+    '''
+    seed_seq = noise_seed_sequence(seed)
+    ramp = sigmoid_ramp(ramp_samples).astype(np.float32) if ramp_samples else None
+
+    def chunk(k):
+        return auditory_noise_chunk(seed_seq, k, chunk_size, n_samples,
+                                    dtype=dtype, ramp=ramp)
+
+    n_chunks = -(-n_samples // chunk_size)
+    yield from parallel_map(chunk, n_chunks, workers)
+
+def generate_auditory_noise(n_samples, seed=None, dtype=np.float32,
+                            ramp_samples=0, chunk_size=48000, workers=1):
     ''' Generate white noise from a uniform distribution
 
+    Convenience wrapper around auditory_noise_chunks() that returns
+    the whole buffer. Prefer the chunks for long durations.
+
     Args:
         n_samples (int): length of noise array
+        seed (int, SeedSequence or None): seed of the noise
+        dtype: np.float32 ([-1, 1]) or np.int16 (full scale)
+        ramp_samples (int): length of sigmoid onset ramp (0 is no ramp)
+        chunk_size (int): samples per generated chunk
+        workers (int): number of worker threads (None is one per core)
 
     Returns:
-        noise (N x 1 array).
+        noise (N x 2 array).
 
     '''
-
-    noise = np.random.uniform(low=-1, high=1, size=(n_samples, 2))
+    noise = np.empty((n_samples, 2), dtype=dtype)
+    start = 0
+    for chunk in auditory_noise_chunks(n_samples, chunk_size, seed,
+                                       dtype, ramp_samples, workers):
+        noise[start:start + len(chunk)] = chunk
+        start += len(chunk)
 
     return noise
 
 # %%
+def _wav_header(fs, n_frames, n_channels=2, sampwidth=2):
+    ''' Header of a PCM wav file with n_frames frames '''
+    data_size = n_frames * n_channels * sampwidth
+    return (b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVE' +
+            b'fmt ' + struct.pack('<IHHIIHH', 16, 1, n_channels, fs,
+                                  fs * n_channels * sampwidth,
+                                  n_channels * sampwidth, 8 * sampwidth) +
+            b'data' + struct.pack('<I', data_size))
+
+def write_wav_chunks(filename, fs, n_samples, chunks):
+    ''' Stream stereo int16 chunks (n_samples in total) to a wav file
+
+    The file is first written to a temporary file in the same folder and
+    then renamed, so a half written file never ends up under filename.
+
+    Args:
+        filename (str or Path): wav file to write
+        fs (int): sampling frequency
+        n_samples (int): length of the sound in samples
+        chunks (iterable): N x 2 int16 arrays
+    '''
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(suffix='.wav', dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_wav_header(fs, n_samples))
+            for chunk in chunks:
+                f.write(chunk.astype('<i2', copy=False).tobytes())
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
+@profiling.profiled('write_auditory_noise_wav')
+def write_auditory_noise_wav(filename, fs, n_samples, seed=None,
+                             ramp_samples=0, chunk_size=48000, workers=1):
+    ''' Stream stereo int16 white noise to a wav file, chunk by chunk
+
+    Args:
+        filename (str or Path): wav file to write
+        fs (int): sampling frequency
+        n_samples (int): length of noise in samples
+        seed (int, SeedSequence or None): seed of the noise
+        ramp_samples (int): length of sigmoid onset ramp (0 is no ramp)
+        chunk_size (int): samples per generated chunk
+        workers (int): number of worker threads (None is one per core)
+    '''
+    write_wav_chunks(filename, fs, n_samples,
+                     auditory_noise_chunks(n_samples, chunk_size, seed,
+                                           np.int16, ramp_samples, workers))
+
+# %%
+def noise_grid_shape(visualNoiseSize, check_size=1):
+    ''' Shape of the grid of checks that covers the visual noise
+
+    Args:
+        visualNoiseSize (int or (width, height)): size of the noise in
+            pixels, e.g., the screen resolution
+        check_size (int): size of a check in pixels
+
+    Returns:
+        (rows, cols), rounded up so that the grid covers the whole size
+    '''
+    if np.isscalar(visualNoiseSize):
+        visualNoiseSize = (visualNoiseSize, visualNoiseSize)
+    width, height = visualNoiseSize
+    return (-(-int(height) // check_size), -(-int(width) // check_size))
+
+@profiling.profiled('generate_visual_noise')
 def generate_visual_noise(win, mask_duration,
-                          visualNoiseSize, noise_level= 0.5):
+                          visualNoiseSize, noise_level= 0.5, bank=None,
+                          seed=None, check_size=1):
     ''' Returns noise textures:
 
     Args:
         mask_duration - duration fo noise mask in frames
-        visualNoiseSize - size of mask in units of win
+        visualNoiseSize - size of mask in pixels, int (square) or (width, height)
         noise_level - opacity of the noise (0 - 1), where 0 is no noise
         opacity - transparancy of noise mask
+        bank - NoiseTextureBank with (at least) mask_duration frames of
+               the grid of checks. If None, a uint8 bank is generated from seed
+        seed - seed of the noise if no bank is given
+        check_size - size of a check in pixels. Only the grid of checks is
+               uploaded; it is drawn check_size times larger without
+               interpolation, i.e., upscaled (nearest neighbour) by the GPU
     '''
+    from psychopy import visual  # Only needed once a window is open
+
+    if bank is None:
+        from noise_bank import NoiseTextureBank
+        bank = NoiseTextureBank.generate(mask_duration,
+                                         noise_grid_shape(visualNoiseSize,
+                                                          check_size), seed)
+
+    # Frames are converted to float one at the time, just before upload
+    noiseTexture = np.empty(bank.frame_size, dtype=np.float32)
+
     visualNoise = []  # list of rendered frames
     for n in range(mask_duration):
-        noiseTexture = np.random.uniform(low=-1, high=1,
-                                         size=(visualNoiseSize,
-                                               visualNoiseSize))
-        visualNoise.append(visual.GratingStim(win=win, tex=noiseTexture,
-                                              size=(visualNoiseSize,
-                                                    visualNoiseSize),
-                                              units='pix',
-                                              opacity=noise_level,
-                                              interpolate=False, mask=None))
+        bank.texture(n, out=noiseTexture)
+        visualNoise.append(_noise_stim(visual, win, noiseTexture, check_size,
+                                       noise_level)[0])
         visualNoise[n].draw()
 
     return visualNoise
 
+def _noise_stim(visual, win, texture, check_size, opacity):
+    ''' Stimulus that draws texture check_size times larger (nearest neighbour)
+
+    Returns:
+        stim, name of its texture attribute ('tex' or 'image')
+    '''
+    rows, cols = texture.shape
+    size = (cols * check_size, rows * check_size)
+
+    # GratingStim needs square textures with a power of two size
+    if rows == cols and rows & (rows - 1) == 0:
+        stim, tex = visual.GratingStim, 'tex'
+    else:
+        stim, tex = visual.ImageStim, 'image'
+
+    return stim(win=win, size=size, units='pix', opacity=opacity,
+                interpolate=False, mask=None, **{tex: texture}), tex
+
+class VisualNoiseStream:
+    '''
+    One noise stimulus that shows the next frame of a frame source (e.g.,
+    noise_bank.PhiloxNoiseFrames) every time it is drawn
+
+    A worker thread computes the textures of the upcoming frames into a
+    rolling buffer of n_buffer float32 arrays, so drawing a frame only sets
+    a texture that is ready. Setting it uploads it to the graphics card,
+    which has to happen in the thread of the window and is the limit of this
+    stimulus: rows x cols x 4 bytes per frame (8 MB at 1920 x 1080 with 1 x 1
+    checks, about 500 MB/s at 60 Hz). The upload is not measured by
+    benchmarks.py (there is no OpenGL there) and depends on the hardware, so
+    check the frame timing on the target machine; larger checks (the upload
+    shrinks with check_size squared) or the noise bank avoid it.
+    '''
+    def __init__(self, win, frames, check_size=1, noise_level=0.5, n_buffer=4):
+        '''
+        Args:
+            win - PsychoPy window
+            frames - source of noise frames with frame_size and texture(k)
+            check_size - size of a check of the noise in pixels
+            noise_level - opacity of the noise (0 - 1), where 0 is no noise
+            n_buffer - number of textures in the rolling buffer (at least 3:
+                the one shown, the one last shown and one computed ahead)
+        '''
+        from psychopy import visual  # Only needed once a window is open
+
+        assert n_buffer >= 3, 'n_buffer has to be at least 3'
+        self.frames = frames
+        self.n_frames = 0  # Frames shown so far
+        self.n_waits = 0   # Frames that were not ready when drawn
+
+        self.stim, self._tex = _noise_stim(visual, win, frames.texture(0),
+                                           check_size, noise_level)
+
+        # Free buffers are filled with the next frames by the worker; a
+        # shown texture is only reused after the next one has replaced it
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for _ in range(n_buffer):
+            self._free.put(np.empty(frames.frame_size, dtype=np.float32))
+        self._shown = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce,
+                                        name='visual_noise_stream',
+                                        daemon=True)
+        self._thread.start()
+        while self._ready.qsize() < n_buffer and self._thread.is_alive():
+            time.sleep(0.001)  # Fill the buffer before the first frame
+
+    def _produce(self):
+        k = 0
+        while not self._stop.is_set():
+            try:
+                texture = self._free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self._ready.put(self.frames.texture(k, out=texture))
+            k += 1
+
+    def __getitem__(self, k):
+        ''' Returns the stimulus with the next frame of the source
+
+        k (the noise frame of a frame plan) is not used: the frames follow
+        each other over the whole session, so the noise never repeats. The
+        stream is therefore not indexable like a list of frames: each call
+        moves on to the next frame, so call it exactly once per drawn frame
+        (there is no random access, and no showing a frame again), and it
+        has no length.
+        '''
+        try:
+            texture = self._ready.get_nowait()
+        except queue.Empty:
+            self.n_waits += 1
+            texture = self._ready.get()
+        setattr(self.stim, self._tex, texture)
+        if self._shown is not None:
+            self._free.put(self._shown)
+        self._shown = texture
+        self.n_frames += 1
+        return self.stim
+
+    def close(self):
+        ''' Stops the worker thread '''
+        self._stop.set()
+        self._thread.join()
+
+# %%
+class VisualNoiseLevel:
+    '''
+    View of a shared list of noise frames, drawn with a given opacity
+    '''
+    def __init__(self, frames, opacity):
+        '''
+        Args:
+            frames - list of GratingStim with noise (from generate_visual_noise)
+                     or a VisualNoiseStream
+            opacity - opacity of the noise (0 - 1), where 0 is no noise
+        '''
+        self.frames = frames
+        self.opacity = opacity
+
+    def __getitem__(self, k):
+        ''' Returns noise frame k, with the opacity of this level '''
+        stim = self.frames[k]
+        if stim.opacity != self.opacity:
+            stim.opacity = self.opacity
+        return stim
+
+def generate_visual_noise_levels(win, mask_duration, visualNoiseSize,
+                                 noise_levels, bank=None, seed=None,
+                                 check_size=1):
+    ''' Returns one view of the same noise frames per noise level
+
+    The noise is generated and uploaded once, whatever the number of levels.
+
+    Args:
+        mask_duration - duration fo noise mask in frames
+        visualNoiseSize - size of mask in units of win
+        noise_levels - dict with opacities (0 - 1), e.g., {'visual_25': 0.25}
+        bank - NoiseTextureBank with (at least) mask_duration frames
+        seed - seed of the noise if no bank is given
+        check_size - size of a check of the noise in pixels
+
+    Returns:
+        dict with a VisualNoiseLevel per key in noise_levels
+    '''
+    frames = generate_visual_noise(win, mask_duration, visualNoiseSize,
+                                   1.0, bank, seed, check_size)
+
+    return {key: VisualNoiseLevel(frames, opacity)
+            for key, opacity in noise_levels.items()}
+
+def visual_noise_stream_levels(win, frames, noise_levels, check_size=1):
+    ''' Returns one view of a VisualNoiseStream per noise level
+
+    Args:
+        frames - source of noise frames (e.g., noise_bank.PhiloxNoiseFrames)
+        noise_levels - dict with opacities (0 - 1), e.g., {'visual_25': 0.25}
+        check_size - size of a check of the noise in pixels
+
+    Returns:
+        dict with a VisualNoiseLevel per key in noise_levels
+    '''
+    stream = VisualNoiseStream(win, frames, check_size, 1.0)
 
+    return {key: VisualNoiseLevel(stream, opacity)
+            for key, opacity in noise_levels.items()}
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Prepare auditory and visual noise in the background
+
+The noise assets (wav file and texture bank) are generated, or read from the
+cache, in a worker thread, e.g., while the eye tracker is calibrated. Only
+loading the sound and uploading the textures (which need the window/GL
+context) are left for the main thread once the preparation is ready.
+
+@author: Marcus
+"""
+
+import threading
+
+import numpy as np
+
+import noise_cache
+import noise_helpers as helpers
+import profiling
+
+
+# %%
+class NoisePreparation:
+    '''
+    Handle to noise assets being prepared in a worker thread
+    '''
+    def __init__(self, asset_cache, fs_audio, duration_auditory_noise,
+                 mask_duration, visualNoiseSize, seed, bank_dtype=np.uint8,
+                 workers=None, colour='white', band=None, check_size=1,
+                 visual_bank=True):
+        '''
+        Args:
+            asset_cache (NoiseCache): cache the assets are read from/written to
+            fs_audio (int): sampling frequency of the auditory noise
+            duration_auditory_noise (float): duration of auditory noise (s)
+            mask_duration (int): number of frames in the visual noise bank
+            visualNoiseSize (int or (width, height)): size of the visual
+                noise in pixels
+            seed (int): seed of the noise
+            bank_dtype: dtype of the visual noise bank
+            workers (int): number of threads generating noise (None is one
+                per core)
+            colour (str): colour of the auditory noise, e.g., 'pink'
+            band (low, high): band of the auditory noise (Hz)
+            check_size (int): size of the checks of the visual noise in
+                pixels; the bank only holds the grid of checks
+            visual_bank (bool): prepare the visual noise bank (False if the
+                visual noise frames are computed on demand)
+        '''
+        self.asset_cache = asset_cache
+        self.fs_audio = fs_audio
+        self.duration_auditory_noise = duration_auditory_noise
+        self.mask_duration = mask_duration
+        self.visualNoiseSize = visualNoiseSize
+        self.seed = seed
+        self.bank_dtype = bank_dtype
+        self.workers = workers
+        self.colour = colour
+        self.band = band
+        self.check_size = check_size
+        self.visual_bank = visual_bank
+
+        self.sound_file = None
+        self.bank = None
+        self._error = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='noise_preparation',
+                                        daemon=True)
+
+    def _run(self):
+        try:
+            with profiling.stage('auditory noise file'):
+                self.sound_file = noise_cache.auditory_noise_file(
+                    self.asset_cache, self.fs_audio,
+                    self.duration_auditory_noise, self.seed,
+                    workers=self.workers, colour=self.colour, band=self.band)
+            if self.visual_bank:
+                with profiling.stage('visual noise bank'):
+                    self.bank = noise_cache.visual_noise_bank(
+                        self.asset_cache, self.mask_duration,
+                        helpers.noise_grid_shape(self.visualNoiseSize, self.check_size),
+                        self.seed, self.bank_dtype, workers=self.workers)
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._done.set()
+
+    def start(self):
+        ''' Starts the preparation and returns self '''
+        self._thread.start()
+        return self
+
+    def ready(self):
+        ''' True if the preparation has finished (or failed) '''
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        ''' Waits until the noise is prepared
+
+        Exceptions raised in the worker thread are raised here.
+
+        Returns:
+            sound_file (Path), bank (NoiseTextureBank, None if not visual_bank)
+        '''
+        if not self._done.wait(timeout):
+            raise TimeoutError('Noise preparation did not finish in time')
+        if self._error is not None:
+            raise self._error
+
+        return self.sound_file, self.bank
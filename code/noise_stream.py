@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Real-time streaming of auditory noise with bounded memory
+
+A producer thread pulls noise from a source (generated on the fly, or read
+from a wav file) and puts it in a queue of fixed-size blocks. The audio
+callback only copies the next block to the output buffer, so the noise can
+play for any duration with a memory use of queue_depth blocks. The noise is
+faded in with the sigmoid onset ramp every time it starts and stops at the
+next callback when stopped.
+
+Sinks that call the callback:
+    SoundDeviceOutput - the sound card (via sounddevice)
+    HeadlessSink - stand-in that records the delivered blocks, underruns
+                   and the time spent in each callback
+
+@author: Marcus
+"""
+
+import queue
+import threading
+import time
+import wave
+
+import numpy as np
+
+import noise_helpers as helpers
+
+
+# %% Sources: callables that return an iterator of N x 2 float32 chunks
+def white_noise_source(seed=None, chunk_size=48000):
+    ''' Endless stereo white noise, the same as the noise (without ramp) of
+    noise_helpers.auditory_noise_chunks() with the same seed and chunk_size
+    '''
+    seed_seq = helpers.noise_seed_sequence(seed)
+
+    def chunks():
+        k = 0
+        while True:
+            yield helpers.auditory_noise_chunk(seed_seq, k, chunk_size,
+                                               (k + 1) * chunk_size)
+            k += 1
+    return chunks
+
+def wav_source(filename, loop=True, chunk_size=48000):
+    ''' Stereo int16 wav file, read chunk by chunk (and looped) '''
+    def chunks():
+        while True:
+            with wave.open(str(filename), 'rb') as f:
+                assert f.getsampwidth() == 2, 'Only 16 bit wav files are supported'
+                n_channels = f.getnchannels()
+                while True:
+                    data = f.readframes(chunk_size)
+                    if not data:
+                        break
+                    chunk = np.frombuffer(data, dtype='<i2').reshape(-1, n_channels)
+                    chunk = chunk.astype(np.float32) / np.iinfo(np.int16).max
+                    yield chunk if n_channels == 2 else np.repeat(chunk[:, :1], 2, axis=1)
+            if not loop:
+                return
+    return chunks
+
+
+# %%
+class NoiseStream:
+    '''
+    Blocks of noise from a source, produced ahead of the audio callback
+    '''
+    def __init__(self, source, fs=48000, block_size=512, queue_depth=8,
+                 ramp_duration=1, level=1.0):
+        '''
+        Args:
+            source (callable): returns an iterator of N x 2 float32 chunks,
+                restarted every time the stream starts
+            fs (int): sampling frequency
+            block_size (int): samples per block given to the callback
+            queue_depth (int): number of blocks produced ahead
+            ramp_duration (float): duration of the onset ramp (s)
+            level (float): gain of the noise (0 - 1)
+        '''
+        self.source = source
+        self.fs = fs
+        self.block_size = block_size
+        self.queue_depth = queue_depth
+        self.ramp = (helpers.sigmoid_ramp(int(fs * ramp_duration)).astype(np.float32)
+                     if ramp_duration else np.zeros(0, dtype=np.float32))
+        self.level = level
+
+        self.playing = False
+        self.n_blocks = 0      # Blocks given to the callback since start
+        self.n_underruns = 0   # Callbacks that found no block ready
+        self._queue = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _blocks(self):
+        ''' The source re-cut into blocks, with the ramp applied '''
+        pending = np.zeros((0, 2), dtype=np.float32)
+        start = 0  # Sample index of the next block
+        for chunk in self.source():
+            pending = np.concatenate([pending, chunk]) if len(pending) else chunk
+            while len(pending) >= self.block_size:
+                block = pending[:self.block_size] * np.float32(self.level)
+                pending = pending[self.block_size:]
+                if start < len(self.ramp):
+                    n = min(self.block_size, len(self.ramp) - start)
+                    block[:n] *= self.ramp[start:start + n, np.newaxis]
+                start += self.block_size
+                yield block
+
+    def _produce(self, q, stop):
+        for block in self._blocks():
+            while not stop.is_set():
+                try:
+                    q.put(block, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                return
+
+    def start(self, wait=True):
+        ''' (Re)starts the noise from the beginning, with the onset ramp
+
+        Args:
+            wait (bool): wait until the queue is full, so that the first
+                callbacks do not underrun
+        '''
+        self.stop()
+        self._queue = queue.Queue(maxsize=self.queue_depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(self._queue, self._stop),
+                                        daemon=True)
+        self.n_blocks = 0
+        self.n_underruns = 0
+        self._thread.start()
+        while wait and not self._queue.full() and self._thread.is_alive():
+            time.sleep(0.001)
+        self.playing = True
+
+    def stop(self):
+        ''' Stops the noise; the next callback outputs silence '''
+        self.playing = False
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def callback(self, outdata, frames, time_info=None, status=None):
+        ''' Fills outdata (frames x 2) with the next block (sounddevice signature) '''
+        if not self.playing:
+            outdata.fill(0)
+            return
+        assert frames == self.block_size, 'frames has to be block_size'
+        try:
+            outdata[:] = self._queue.get_nowait()
+            self.n_blocks += 1
+        except queue.Empty:
+            outdata.fill(0)
+            self.n_underruns += 1
+
+
+# %% Sinks
+class SoundDeviceOutput:
+    '''
+    Plays a NoiseStream on the sound card, with the play()/stop() of a
+    PsychoPy sound
+    '''
+    def __init__(self, stream, device=None, latency='low'):
+        '''
+        Args:
+            stream (NoiseStream): the noise
+            device: sounddevice output device (None is the default)
+            latency: latency of the output stream (see sounddevice)
+        '''
+        import sounddevice
+
+        self.stream = stream
+        self.output = sounddevice.OutputStream(samplerate=stream.fs,
+                                               blocksize=stream.block_size,
+                                               channels=2, dtype='float32',
+                                               device=device, latency=latency,
+                                               callback=stream.callback)
+
+    def play(self):
+        self.stream.start()
+        self.output.start()
+
+    def stop(self):
+        self.stream.stop()
+        self.output.stop()
+
+    def close(self):
+        self.stop()
+        self.output.close()
+
+
+class HeadlessSink:
+    '''
+    Stand-in for the sound card that calls the callback block by block
+    '''
+    def __init__(self, stream, keep_blocks=False):
+        '''
+        Args:
+            stream (NoiseStream): the noise
+            keep_blocks (bool): keep a copy of every delivered block
+        '''
+        self.stream = stream
+        self.keep_blocks = keep_blocks
+        self.blocks = []
+        self.callback_times = []  # Time spent in each callback (s)
+        self.underruns = []       # Callback numbers without a block ready
+
+    def play(self):
+        self.stream.start()
+
+    def stop(self):
+        self.stream.stop()
+
+    def run(self, duration, realtime=True):
+        ''' Calls the callback for duration seconds of audio
+
+        Args:
+            duration (float): duration (s)
+            realtime (bool): call it at the rate of the sound card, or as
+                fast as possible (which tests if the producer keeps up)
+        '''
+        stream = self.stream
+        outdata = np.empty((stream.block_size, 2), dtype=np.float32)
+        block_duration = stream.block_size / stream.fs
+        t_start = time.perf_counter()
+        for i in range(int(duration / block_duration)):
+            if realtime:
+                delay = t_start + i * block_duration - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            n_underruns = stream.n_underruns
+            t0 = time.perf_counter()
+            stream.callback(outdata, stream.block_size)
+            self.callback_times.append(time.perf_counter() - t0)
+
+            if stream.n_underruns > n_underruns:
+                self.underruns.append(i)
+            if self.keep_blocks:
+                self.blocks.append(outdata.copy())
+
+    def summary(self):
+        ''' Number of callbacks and underruns, and callback time (ms) '''
+        t = np.array(self.callback_times) * 1000
+        return {'callbacks': len(t), 'underruns': len(self.underruns),
+                'callback_mean_ms': float(t.mean()) if len(t) else np.nan,
+                'callback_max_ms': float(t.max()) if len(t) else np.nan}
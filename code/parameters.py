@@ -10,11 +10,13 @@ test = True
 
 Fs = 60  # screen refresh rate
 mask_duration = Fs  # Duration of noise mask in frames
-visualNoiseSize = 1024*2  # Dimension in pixels of visual noise.
 
 MY_MONITOR = 'testMonitor'  # needs to exists in PsychoPy monitor center
 FULLSCREEN = True
 SCREEN_RES = [1920, 1080]
+
+visualNoiseSize = SCREEN_RES  # Dimension in pixels of visual noise (int is square).
+visualNoiseCheckSize = 1  # Size in pixels of the checks of the visual noise (e.g., 4 is 4x4)
 SCREEN_WIDTH = 52.7  # cm
 VIEWING_DIST = 63  # distance from eye to center of screen (cm)
 
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in wall time and memory profiling of stages (e.g., of the session startup)
+
+A stage is a block of code wrapped in a context manager or a decorator,
+
+    with profiling.stage('visual noise bank'):
+        ...
+
+    @profiling.profiled('upload visual noise')
+    def generate_visual_noise(...):
+
+or the time between two calls to mark(), which is how noise_em.py records
+its startup stages. For each stage, the wall time, the resident set size
+(RSS) before and after, the peak RSS of the process so far and the peak of
+the memory allocated by Python/numpy (tracemalloc) are recorded. Stages can
+be nested; the peak of a stage includes its nested stages. Stages in other
+threads are recorded with the name of the thread, but share the tracemalloc
+peak with the stages running at the same time.
+
+Profiling is off until enable() is called, and then the hooks cost nothing
+but a check of a flag.
+
+@author: Marcus
+"""
+
+import csv
+import functools
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+COLUMNS = ['stage', 'thread', 'depth', 't_start', 'wall', 'rss_start_MB',
+           'rss_end_MB', 'peak_rss_MB', 'traced_peak_MB']
+
+
+# %%
+def memory_usage():
+    ''' RSS and peak RSS of the process (MB), nan if not available '''
+    if os.path.isfile('/proc/self/status'):
+        fields = {}
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                fields[key] = value
+        return (int(fields['VmRSS'].split()[0]) / 1024,
+                int(fields['VmHWM'].split()[0]) / 1024)
+
+    try:
+        import psutil
+    except ImportError:
+        return np.nan, np.nan
+    info = psutil.Process().memory_info()
+    return info.rss / 1024**2, getattr(info, 'peak_wset', np.nan) / 1024**2
+
+
+class StageProfiler:
+    '''
+    Wall time, RSS and tracemalloc peak of (nested) stages
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self.records = []  # One dict (with COLUMNS) per finished stage
+        self._t0 = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def enable(self, trace=True):
+        ''' Starts profiling
+
+        Args:
+            trace (bool): also record the peak of Python/numpy allocations
+                with tracemalloc (which slows down allocations)
+        '''
+        self.trace = trace
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._t0 = time.perf_counter()
+        self.enabled = True
+        self._local.stack = [self._begin()]  # Stage that ends at the next mark()
+
+    def disable(self):
+        self.enabled = False
+        if self.trace:
+            tracemalloc.stop()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _traced_peak(self):
+        return tracemalloc.get_traced_memory()[1] / 1024**2 if self.trace else np.nan
+
+    def _begin(self):
+        stack = self._stack()
+        if stack and self.trace:
+            stack[-1]['peak'] = max(stack[-1]['peak'], self._traced_peak())
+        if self.trace:
+            tracemalloc.reset_peak()
+        return {'t': time.perf_counter(), 'rss': memory_usage()[0],
+                'peak': 0, 'depth': len(stack)}
+
+    def _end(self, name, frame):
+        rss, peak_rss = memory_usage()
+        peak = max(frame['peak'], self._traced_peak())
+        stack = self._stack()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        with self._lock:
+            self.records.append({
+                'stage': name, 'thread': threading.current_thread().name,
+                'depth': frame['depth'], 't_start': frame['t'] - self._t0,
+                'wall': time.perf_counter() - frame['t'],
+                'rss_start_MB': frame['rss'], 'rss_end_MB': rss,
+                'peak_rss_MB': peak_rss, 'traced_peak_MB': peak})
+
+    @contextmanager
+    def stage(self, name):
+        ''' Profiles the block of code in the with statement '''
+        if not self.enabled:
+            yield
+            return
+
+        frame = self._begin()
+        self._stack().append(frame)
+        try:
+            yield
+        finally:
+            self._stack().pop()
+            self._end(name, frame)
+
+    def profiled(self, name=None):
+        ''' Decorator that profiles each call of a function '''
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or fn.__name__):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def mark(self, name):
+        ''' Ends the stage that started at the previous mark (or enable())
+
+        Call it outside of other stages, in the thread that called enable().
+        '''
+        stack = self._stack()
+        if not self.enabled or not stack:
+            return
+        self._end(name, stack.pop())
+        stack.append(self._begin())
+
+    def table(self):
+        ''' The records as a printable table, in order of start '''
+        lines = [f'{"stage":<30s} {"thread":<18s} {"t (s)":>7s} {"wall (s)":>9s} '
+                 f'{"RSS (MB)":>9s} {"dRSS":>7s} {"peak RSS":>9s} {"traced":>8s}']
+        for r in sorted(self.records, key=lambda r: r['t_start']):
+            name = '  ' * r['depth'] + r['stage']
+            lines.append(f'{name:<30s} {r["thread"][:18]:<18s} '
+                         f'{r["t_start"]:7.2f} {r["wall"]:9.3f} '
+                         f'{r["rss_end_MB"]:9.1f} '
+                         f'{r["rss_end_MB"] - r["rss_start_MB"]:7.1f} '
+                         f'{r["peak_rss_MB"]:9.1f} {r["traced_peak_MB"]:8.1f}')
+        return '\n'.join(lines)
+
+    def save(self, filename):
+        ''' Saves the records to a tab separated file '''
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, COLUMNS, delimiter='\t')
+            writer.writeheader()
+            writer.writerows(sorted(self.records, key=lambda r: r['t_start']))
+
+
+# %% The profiler of the process, used by the hooks in the other modules
+profiler = StageProfiler()
+
+enable = profiler.enable
+disable = profiler.disable
+stage = profiler.stage
+profiled = profiler.profiled
+mark = profiler.mark
+
+def print_table():
+    print(profiler.table())
+
+def save(filename):
+    profiler.save(filename)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Trial schedule of a whole session, compiled up front from a seed
+
+All randomization of a session (the order of the noise conditions of MGS and
+PF, and the target position, fixation duration and memory delay of every MGS
+trial) is drawn at once, vectorized, from one seeded generator, and stored in
+a table with one row per trial and all durations in frames. The tasks only
+read their rows, so there is no random number generation between the frames
+of a session, and the table can be saved with the data, inspected and
+replayed exactly (load()).
+
+Blocks run in this order: MGS training, MGS in the first two conditions, PF
+in all conditions, MGS in the last two conditions. Each MGS block has rows
+for the repeated trials too, and the training block for training_rounds
+rounds (later rounds reuse the rows of the earlier rounds).
+
+@author: Marcus
+"""
+
+import csv
+
+import numpy as np
+
+SCHEDULE_DTYPE = [('block', 'i4'), ('task', 'U8'), ('noise_condition', 'U16'),
+                  ('training', '?'), ('trial', 'i4'), ('amplitude', 'f8'),
+                  ('direction', 'f8'), ('x', 'f8'), ('y', 'f8'),
+                  ('fixation_frames', 'i4'), ('flash_frames', 'i4'),
+                  ('memory_delay_frames', 'i4'),
+                  ('saccade_window_frames', 'i4'), ('feedback_frames', 'i4')]
+
+
+# %%
+class TrialSchedule:
+    '''
+    Table of all trials of a session (see SCHEDULE_DTYPE), by block
+    '''
+    def __init__(self, trials, seed=None):
+        '''
+        Args:
+            trials (structured array): rows with SCHEDULE_DTYPE, by block
+            seed (int): seed the schedule was compiled from
+        '''
+        self.trials = trials
+        self.seed = seed
+        self._starts = np.searchsorted(trials['block'],
+                                       np.arange(self.n_blocks + 1))
+
+    @property
+    def n_blocks(self):
+        return int(self.trials['block'].max()) + 1 if len(self.trials) else 0
+
+    def block(self, b):
+        ''' Rows of block b (a view of the table) '''
+        return self.trials[self._starts[b]:self._starts[b + 1]]
+
+    def blocks(self, task, training=False):
+        ''' Rows of each block of a task, in the order they are run '''
+        return [self.block(b) for b in range(self.n_blocks)
+                if self.block(b)['task'][0] == task
+                and self.block(b)['training'][0] == training]
+
+    def training_round(self, r, n_trials):
+        ''' Rows of MGS training round r (rounds beyond the table wrap) '''
+        rows = self.blocks('MGS', training=True)[0]
+        n_rounds = len(rows) // n_trials
+        start = (r % n_rounds) * n_trials
+        return rows[start:start + n_trials]
+
+    def save(self, filename):
+        ''' Saves the table (and the seed, on the first line) as a .tsv file '''
+        with open(filename, 'w', newline='') as f:
+            f.write(f'# seed: {self.seed}\n')
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(self.trials.dtype.names)
+            writer.writerows(self.trials.tolist())
+
+    @classmethod
+    def load(cls, filename):
+        ''' Reads a schedule saved by save(), e.g., to replay a session '''
+        with open(filename, newline='') as f:
+            seed = f.readline().split(':', 1)[1].strip()
+            reader = csv.reader(f, delimiter='\t')
+            names = next(reader)
+            rows = [tuple(row) for row in reader]
+
+        trials = np.empty(len(rows), dtype=SCHEDULE_DTYPE)
+        for i, name in enumerate(names):
+            column = [row[i] for row in rows]
+            if trials.dtype[name] == np.bool_:
+                column = [value == 'True' for value in column]
+            trials[name] = column
+        return cls(trials, None if seed == 'None' else int(seed))
+
+
+def compile_schedule(seed, noise_conditions, n_trials, n_trials_practise,
+                     max_repeated_trials, amplitude, direction,
+                     central_fixation_duration, memory_delay, flash_duration,
+                     wait_response_duration, target_duration_feedback,
+                     long_fixation_duration, refresh_rate, training_rounds=10):
+    ''' Draws the trial schedule of a session
+
+    Args:
+        seed (int or None): seed of the schedule (None draws a new seed,
+            which is kept in the schedule)
+        noise_conditions (list): e.g., ['silence', 'auditory', 'visual_25']
+        n_trials (int): trials per MGS block
+        n_trials_practise (int): trials per MGS training round
+        max_repeated_trials (int): extra rows per MGS block for repeated trials
+        amplitude (array): target amplitudes (deg), drawn uniformly
+        direction (array): target directions (deg), drawn uniformly
+        central_fixation_duration (min, max): fixation duration (s)
+        memory_delay (min, max): memory delay; as in the original task, the
+            minimum is in s and max - min is a spread in frames
+        flash_duration (float): duration of the flashed target (s)
+        wait_response_duration (float): duration of the saccade window (s)
+        target_duration_feedback (float): duration of the feedback target (s)
+        long_fixation_duration (float): duration of a PF trial (s)
+        refresh_rate (int): screen refresh rate (Hz)
+        training_rounds (int): number of MGS training rounds with own rows
+
+    Returns:
+        TrialSchedule
+    '''
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1, np.uint32)[0])
+    rng = np.random.default_rng(seed)
+
+    mgs_order = rng.permutation(noise_conditions)
+    pf_order = rng.permutation(noise_conditions)
+    n_mgs = n_trials + max_repeated_trials
+
+    # (task, noise condition, training, number of rows) in the order they run
+    blocks = ([('MGS', 'silence', True, n_trials_practise * training_rounds)] +
+              [('MGS', c, False, n_mgs) for c in mgs_order[:2]] +
+              [('FIX', c, False, 1) for c in pf_order] +
+              [('MGS', c, False, n_mgs) for c in mgs_order[2:]])
+    n_rows = np.array([b[3] for b in blocks])
+    block = np.repeat(np.arange(len(blocks)), n_rows)
+
+    trials = np.zeros(n_rows.sum(), dtype=SCHEDULE_DTYPE)
+    trials['block'] = block
+    trials['task'] = [b[0] for b in blocks for _ in range(b[3])]
+    trials['noise_condition'] = [b[1] for b in blocks for _ in range(b[3])]
+    trials['training'] = np.repeat([b[2] for b in blocks], n_rows)
+    trials['trial'] = np.arange(len(trials)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+
+    # MGS: target position and durations of all trials in one go
+    mgs = trials['task'] == 'MGS'
+    n = int(mgs.sum())
+    amplitudes = np.asarray(amplitude)[rng.integers(len(amplitude), size=n)]
+    directions = np.asarray(direction)[rng.integers(len(direction), size=n)]
+    trials['amplitude'][mgs] = amplitudes
+    trials['direction'][mgs] = directions
+    trials['x'][mgs] = amplitudes * np.cos(np.deg2rad(directions))
+    trials['y'][mgs] = amplitudes * np.sin(np.deg2rad(directions))
+    trials['fixation_frames'][mgs] = (rng.uniform(*central_fixation_duration, n)
+                                      * refresh_rate).astype(int)
+    trials['flash_frames'][mgs] = int(refresh_rate * flash_duration)
+    # As in the original task, int(rand * (max - min) + min * refresh_rate):
+    # the spread is added in frames, not seconds, so at 60 Hz the delay is
+    # 120 frames, or 121 in about a third of the trials
+    trials['memory_delay_frames'][mgs] = (
+        rng.uniform(0, memory_delay[1] - memory_delay[0], n)
+        + memory_delay[0] * refresh_rate).astype(int)
+    trials['saccade_window_frames'][mgs] = int(wait_response_duration * refresh_rate)
+    trials['feedback_frames'][mgs] = int(refresh_rate * target_duration_feedback)
+
+    # PF: one long fixation per condition
+    trials['fixation_frames'][~mgs] = int(long_fixation_duration * refresh_rate)
+
+    return TrialSchedule(trials, seed)
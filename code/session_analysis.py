@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Analysis of one session: trial segmentation, saccades and per-trial measures
+
+Reads the Titta data file (.h5 with gaze samples and messages) saved by
+noise_em.py, splits it into trials (epochs.EpochIndex) and computes, per
+trial,
+    MGS: saccades before the saccade window (inhibition errors), latency,
+         amplitude and landing position of the first saccade in the window
+    FIX (PF): number of saccades leaving an AOI around the fixation point
+
+@author: Marcus
+"""
+
+import warnings
+
+import numpy as np
+
+import epochs
+import noise_helpers as helpers
+import parameters as params
+import saccade_detection
+
+PIPELINE_VERSION = 1
+
+DEFAULT_SETTINGS = {'fs': 600,
+                    'aoi_radius': 2.0,        # deg around fixation point (PF)
+                    'min_amplitude': 1.0,     # deg, smaller saccades are ignored
+                    'min_duration': 0.010}    # s
+
+
+# %%
+class ScreenGeometry:
+    ''' Monitor stand-in with the geometry in parameters.py (for Tobii2Deg) '''
+    def __init__(self, width=params.SCREEN_WIDTH, size_pix=params.SCREEN_RES,
+                 distance=params.VIEWING_DIST):
+        self.width = width
+        self.size_pix = size_pix
+        self.distance = distance
+
+    def getWidth(self):
+        return self.width
+
+    def getSizePix(self):
+        return self.size_pix
+
+    def getDistance(self):
+        return self.distance
+
+
+def parse_trial_message(msg):
+    ''' Splits e.g. 'MGS_visual_25_3_0.73_-0.73[_TRAINING]' into its fields '''
+    parts = msg.split('_')
+    trial = {'task': parts[0], 'noise_condition': parts[1],
+             'noise_level': parts[2], 'trial': int(parts[3]),
+             'target_x': np.nan, 'target_y': np.nan,
+             'training': parts[-1] == 'TRAINING'}
+    if parts[0] == 'MGS':
+        trial['target_x'], trial['target_y'] = float(parts[4]), float(parts[5])
+    return trial
+
+
+# %%
+def load_session(gaze_file):
+    ''' Loads gaze samples and messages from a Titta .h5 file
+
+    Returns:
+        t (N array, system time stamps in us), xy (N x 2 x 2 array in deg,
+        samples x [left, right] x [x, y]), messages (DataFrame with the
+        columns system_time_stamp and msg)
+    '''
+    import pandas as pd
+
+    gaze = pd.read_hdf(gaze_file, 'gaze')
+    messages = pd.read_hdf(gaze_file, 'msg')
+
+    t = gaze['system_time_stamp'].to_numpy()
+    xy = np.empty((len(gaze), 2, 2))
+    for e, eye in enumerate(['left', 'right']):
+        for d, dim in enumerate(['x', 'y']):
+            xy[:, e, d] = gaze[f'{eye}_gaze_point_on_display_area_{dim}']
+
+    # Lost samples are NaN; only samples where both eyes are lost are lost
+    helpers.Tobii2Deg(ScreenGeometry())(xy, out=xy)
+
+    return t, xy, messages
+
+
+def binocular(xy):
+    ''' Average of the eyes (or the one eye that is not lost) '''
+    with warnings.catch_warnings():
+        # Samples where both eyes are lost stay NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanmean(xy, axis=1)
+
+
+# %%
+def analyze_trial(trial_msg, t, xy, events, settings):
+    ''' Measures of one trial from its samples (t in us, xy in deg) '''
+    result = parse_trial_message(trial_msg)
+    result['n_samples'] = len(t)
+    result['prop_lost'] = (float(np.mean(np.all(np.isnan(xy), axis=(1, 2))))
+                           if len(t) else np.nan)
+
+    gaze = binocular(xy)
+    saccades, _ = saccade_detection.detect_saccades(
+        gaze, settings['fs'], t / 1e6, settings['min_duration'])
+    saccades = saccades[saccades['amplitude'] >= settings['min_amplitude']]
+    result['n_saccades'] = len(saccades)
+
+    if result['task'] == 'FIX':
+        # Saccades that start inside and land outside the AOI
+        r = settings['aoi_radius']
+        start_in = np.hypot(saccades['x_onset'], saccades['y_onset']) < r
+        end_out = ~(np.hypot(saccades['x_offset'], saccades['y_offset']) < r)
+        result['n_saccades_leaving_aoi'] = int(np.sum(start_in & end_out))
+
+    elif result['task'] == 'MGS':
+        t_window = events.get('start_saccade_window', np.inf) / 1e6
+        before = saccades['t_onset'] < t_window
+        result['n_saccades_before_window'] = int(np.sum(before))
+
+        in_window = saccades[~before]
+        if len(in_window):
+            first = in_window[0]
+            result['latency'] = first['t_onset'] - t_window
+            result['amplitude'] = float(first['amplitude'])
+            result['landing_x'] = float(first['x_offset'])
+            result['landing_y'] = float(first['y_offset'])
+            result['landing_error'] = float(np.hypot(
+                first['x_offset'] - result['target_x'],
+                first['y_offset'] - result['target_y']))
+
+    return result
+
+
+def analyze_session(gaze_file, settings=None):
+    ''' Per-trial measures of one session
+
+    Args:
+        gaze_file (str or Path): Titta .h5 file
+        settings (dict): overrides of DEFAULT_SETTINGS
+
+    Returns:
+        DataFrame with one row per trial
+    '''
+    import pandas as pd
+
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    t, xy, messages = load_session(gaze_file)
+
+    index = epochs.EpochIndex.from_messages(t, messages)
+
+    rows = []
+    for i, trial_msg in enumerate(index.trials):
+        t_trial, xy_trial = index.epoch(i, t, xy)
+        rows.append(analyze_trial(trial_msg, t_trial, xy_trial,
+                                  index.events[i], settings))
+
+    return pd.DataFrame(rows)
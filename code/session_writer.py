@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-safe, incremental saving of a session
+
+Trial events (and optionally gaze samples from the Titta buffer) are appended
+to files in a session folder by a background thread, at condition boundaries
+and every few seconds. If the session is interrupted (escape, crash, power
+cut), recover_session() rebuilds the events and gaze data from the folder.
+
+Usage (recovery):
+    python session_writer.py <session folder>
+
+@author: Marcus
+"""
+
+import csv
+import glob
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+from event_log import COLUMNS
+
+EVENTS_FILE = 'events.tsv'
+GAZE_PATTERN = 'gaze_{:05d}.npz'
+COMPLETE_FILE = 'complete'
+
+
+# %%
+class SessionWriter:
+    '''
+    Appends new events and gaze samples to a session folder in the background
+    '''
+    def __init__(self, folder, event_log, tracker=None, interval=30):
+        '''
+        Args:
+            folder (str or Path): session folder (created if needed)
+            event_log (EventLog): log with the trial events
+            tracker: Titta tracker; if given, new gaze samples are saved too
+            interval (float): seconds between automatic flushes
+                (None is only when flush() is called)
+        '''
+        self.folder = str(folder)
+        self.event_log = event_log
+        self.tracker = tracker
+        self.interval = interval
+
+        self.n_events = 0        # Events saved so far
+        self.n_gaze_chunks = 0
+        self.t_gaze = None       # System time stamp of last saved gaze sample
+        self.errors = []
+
+        os.makedirs(self.folder, exist_ok=True)
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run,
+                                        name='session_writer', daemon=True)
+
+    def start(self):
+        ''' Starts the background thread and returns self '''
+        self._thread.start()
+        return self
+
+    def flush(self):
+        ''' Asks the background thread to save new data (returns at once) '''
+        t_now = None
+        if self.tracker is not None:
+            t_now = self.tracker.get_system_time_stamp()
+        self._requests.put(('flush', t_now))
+
+    def finalize(self, complete=True, timeout=10):
+        ''' Saves the remaining data and stops the background thread
+
+        Args:
+            complete (bool): the session ran to its end; only then is the
+                completion marker written (an aborted session is not complete)
+            timeout (float): time to wait for the background thread (s)
+        '''
+        self.flush()
+        self._requests.put(('stop', None))
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        else:
+            # Never started; save in this thread
+            self._run()
+
+        if not complete:
+            return
+        with open(os.path.join(self.folder, COMPLETE_FILE), 'w') as f:
+            f.write(time.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def _run(self):
+        while True:
+            try:
+                request, t_now = self._requests.get(timeout=self.interval)
+            except queue.Empty:
+                request, t_now = 'flush', None
+
+            if request == 'stop':
+                break
+
+            try:
+                self._save_events()
+                if self.tracker is not None:
+                    self._save_gaze(t_now)
+            except Exception as e:
+                # Never let saving bring down the experiment
+                self.errors.append(e)
+                print(f'SessionWriter: could not save data ({e})')
+
+    def _save_events(self):
+        stop = len(self.event_log)
+        if stop == self.n_events:
+            return
+
+        rows = self.event_log.rows(self.n_events, stop)
+        filename = os.path.join(self.folder, EVENTS_FILE)
+        new_file = not os.path.isfile(filename)
+        with open(filename, 'a', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            if new_file:
+                writer.writerow(COLUMNS)
+            writer.writerows(zip(*[rows[c] for c in COLUMNS]))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.n_events = stop
+
+    def _save_gaze(self, t_now=None):
+        if t_now is None:
+            t_now = self.tracker.get_system_time_stamp()
+        t_start = 0 if self.t_gaze is None else self.t_gaze + 1
+
+        samples = self.tracker.buffer.peek_time_range('gaze', t_start, t_now)
+        if not samples or len(samples['system_time_stamp']) == 0:
+            return
+
+        filename = os.path.join(self.folder,
+                                GAZE_PATTERN.format(self.n_gaze_chunks))
+        temp_name = filename + '.tmp'
+        with open(temp_name, 'wb') as f:
+            np.savez(f, **{k: np.asarray(v) for k, v in samples.items()})
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, filename)
+
+        self.n_gaze_chunks += 1
+        self.t_gaze = int(samples['system_time_stamp'][-1])
+
+
+# %%
+def recover_session(folder):
+    ''' Rebuilds events and gaze data from a (possibly partial) session folder
+
+    Args:
+        folder (str or Path): session folder written by SessionWriter
+
+    Returns:
+        events (DataFrame), gaze (DataFrame or None), complete (bool)
+    '''
+    import pandas as pd
+
+    folder = str(folder)
+    events_file = os.path.join(folder, EVENTS_FILE)
+    if os.path.isfile(events_file):
+        # A power cut may leave a partially written last line
+        events = pd.read_csv(events_file, sep='\t', on_bad_lines='skip')
+        events = events.dropna(subset=['event'])
+    else:
+        events = pd.DataFrame(columns=COLUMNS)
+
+    chunks = []
+    for filename in sorted(glob.glob(os.path.join(folder, 'gaze_*.npz'))):
+        try:
+            with np.load(filename) as data:
+                chunks.append(pd.DataFrame({k: data[k] for k in data.files}))
+        except (OSError, ValueError) as e:
+            print(f'Skipping unreadable gaze chunk {filename} ({e})')
+    gaze = pd.concat(chunks, ignore_index=True) if chunks else None
+
+    complete = os.path.isfile(os.path.join(folder, COMPLETE_FILE))
+
+    return events, gaze, complete
+
+
+def main(folder):
+    events, gaze, complete = recover_session(folder)
+    base = os.path.normpath(folder)
+    events.to_csv(base + '_recovered.tsv', sep='\t')
+    print(f'{len(events)} events -> {base}_recovered.tsv')
+    if gaze is not None:
+        gaze.to_csv(base + '_recovered_gaze.tsv', sep='\t', index=False)
+        print(f'{len(gaze)} gaze samples -> {base}_recovered_gaze.tsv')
+    if not complete:
+        print('Session was not completed')
+
+if __name__ == '__main__':
+    main(sys.argv[1])
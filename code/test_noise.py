@@ -16,12 +16,13 @@ prefs.hardware['audioLatencyMode'] = 1
 # prefs.hardware['audioLib'] = ['sounddevice']
 # print(prefs.hardware)
 
-from scipy.io.wavfile import write
 from pathlib import Path
 
 from psychopy import gui, event, visual, monitors, sound, logging
 # from tasks import screen_specs
 import noise_helpers as helpers
+import noise_cache
+import frame_timing
 import parameters as params
 import os, sys
 import numpy as np
@@ -30,10 +31,11 @@ import numpy as np
 path = os.path.abspath(os.path.dirname(__file__))
 os.chdir(path)
 
-sound_file = Path.cwd() / "white_noise.wav"
-
 fs_audio = 48000
 duration_auditory_noise = 5 * 60 # in seconds
+noise_seed = 20201109 # Seed of the generated noise (part of the cache key)
+asset_cache = noise_cache.NoiseCache(Path.cwd() / 'noise_cache',
+                                     max_bytes=2 * 1024**3)
 
 # %% open a window and generate visual and auditory noise
 screen_fs = 60
@@ -53,22 +55,18 @@ text = visual.TextStim(win, text='',
 # visual_noise = make_noise(params.mask_duration,
 #                           opacity=params.noise_level)
 
+noise_bank = noise_cache.visual_noise_bank(asset_cache, params.mask_duration,
+                                           helpers.noise_grid_shape(params.visualNoiseSize,
+                                                                    params.visualNoiseCheckSize),
+                                           noise_seed)
 visual_noise = helpers.generate_visual_noise(win, params.mask_duration,
-                          params.visualNoiseSize, params.noise_level)
-
-noise_array = helpers.generate_auditory_noise(fs_audio * duration_auditory_noise)
-
-# Ramp up noise slowly
-x = np.linspace(-fs_audio, fs_audio, fs_audio)
-z = 1/(1 + np.exp(-1/(fs_audio/4)*x))
-noise_array[:fs_audio] = noise_array[:fs_audio] * np.c_[z,z]
+                          params.visualNoiseSize, params.noise_level, noise_bank,
+                          check_size=params.visualNoiseCheckSize)
 
-# Create file with noise if it does not already exist
-if not sound_file.is_file():
-    max_amplitude = np.iinfo(np.int16).max
-    noise_array = max_amplitude * noise_array
-    write("white_noise.wav", fs_audio, noise_array.astype(np.int16))
-auditory_noise = sound.Sound("white_noise.wav")
+# Create file with noise if there is no valid cached file (ramped up over 1 s)
+sound_file = noise_cache.auditory_noise_file(asset_cache, fs_audio,
+                                             duration_auditory_noise, noise_seed)
+auditory_noise = sound.Sound(str(sound_file))
 
 win.clearBuffer() # Clear buffer from drawings of noise
 
@@ -91,7 +89,9 @@ text.text = 'Så här ser bruset ut. Tryck på mellanslagstangenten för att gå
 
 keypressed = False
 j = 0
-t = []
+flip_timer = frame_timing.FlipTimer(screen_fs)
+flip_timer.set_context('TEST', 'visual')
+noise_phase = flip_timer.phase_code('noise')
 idx = np.random.randint(0, screen_fs, screen_fs)
 while not keypressed:
     key = event.getKeys()
@@ -109,12 +109,12 @@ while not keypressed:
     visual_noise[idx[np.mod(j, params.mask_duration)]].draw()
     # visual_noise.draw()
 
-    win.flip()
-    t.append(core.getTime())
+    flip_timer.record(win.flip(), noise_phase, j > 0)
 
     j += 1
 
 print(win.getActualFrameRate())
+frame_timing.print_summary(flip_timer.summary())
 win.flip()
 
 
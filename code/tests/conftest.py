@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+The experiment modules are scripts in code/, not a package
+
+@author: Marcus
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Scoring of gaze samples against AOIs
+
+@author: Marcus
+"""
+
+import numpy as np
+import pytest
+
+from aoi import AOIs, score_aois
+
+
+@pytest.fixture
+def aois():
+    aois = AOIs()
+    aois.add_rect((0, 0), 1, name='fixation')
+    aois.add_circle((5, 0), 2, time_range=(1, 3), name='target')
+    return aois
+
+def test_inside_rect_and_circle(aois):
+    # Eye 0 at the fixation point, eye 1 at the target
+    xy = np.zeros((4, 2, 2))
+    xy[:, 1] = (5, 1.5)
+    proportion, n_valid = score_aois(xy, aois)
+    assert np.array_equal(proportion, [[1, 0], [0, 1]])
+    assert np.array_equal(n_valid, [[4, 4], [4, 4]])
+
+def test_borders_are_outside(aois):
+    xy = np.array([[[1, 0]], [[0, 1]], [[5, 2]], [[7, 0]]], dtype=float)
+    proportion, _ = score_aois(xy, aois)
+    assert np.array_equal(proportion, [[0], [0]])
+
+def test_time_range(aois):
+    xy = np.tile([5.0, 0.0], (5, 1, 1))
+    t = np.arange(5)
+    proportion, n_valid = score_aois(xy, aois, t)
+    # Only t = 1 and 2 are scored against the target
+    assert proportion[1, 0] == 1
+    assert n_valid[1, 0] == 2
+    assert n_valid[0, 0] == 5
+
+def test_lost_samples(aois):
+    xy = np.zeros((4, 1, 2))
+    xy[:2] = np.nan
+    outside, n_valid = score_aois(xy, aois, lost='outside')
+    exclude, _ = score_aois(xy, aois, lost='exclude')
+    assert outside[0, 0] == 0.5
+    assert exclude[0, 0] == 1
+    assert n_valid[0, 0] == 2
+
+def test_no_samples_in_window(aois):
+    xy = np.zeros((3, 1, 2))
+    proportion, n_valid = score_aois(xy, aois, t=np.array([5, 6, 7]))
+    assert np.isnan(proportion[1, 0])
+    assert n_valid[1, 0] == 0
+
+def test_unknown_lost(aois):
+    with pytest.raises(AssertionError):
+        score_aois(np.zeros((1, 1, 2)), aois, lost='ignore')
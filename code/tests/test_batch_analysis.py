@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Cached per-session results of the batch analysis
+
+@author: Marcus
+"""
+
+import shutil
+
+import pandas as pd
+
+import batch_analysis
+import session_analysis
+
+
+def test_renamed_session_gets_its_own_name(tmp_path):
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    (data_dir / 'p01.h5').write_bytes(b'gaze data of p01')
+
+    # The result of p01 is cached (as if analyzed before)
+    settings = dict(session_analysis.DEFAULT_SETTINGS)
+    cache = batch_analysis.ResultCache(tmp_path / 'cache', settings)
+    cache.store(cache.input_hash(data_dir / 'p01.h5'),
+                pd.DataFrame({'trial': [0, 1], 'latency': [0.2, 0.3]}))
+    cache.save_index()
+
+    # A copy under a new name has the same contents, and so the same result
+    shutil.copy(data_dir / 'p01.h5', data_dir / 'p02.h5')
+    table = batch_analysis.run_batch(data_dir, tmp_path / 'results.tsv',
+                                     cache_dir=tmp_path / 'cache')
+
+    assert table['session'].tolist() == ['p01', 'p01', 'p02', 'p02']
+    assert table.columns[0] == 'session'
+    assert table['latency'].tolist() == [0.2, 0.3, 0.2, 0.3]
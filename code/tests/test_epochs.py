@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Epoch index from trial markers
+
+@author: Marcus
+"""
+
+import numpy as np
+import pytest
+
+from epochs import EpochIndex, parse_markers
+
+TRIAL = 'MGS_visual_25_3_10_0'
+
+MESSAGES = [(10, 'onset_' + TRIAL),
+            (12, 'start_flash_' + TRIAL),
+            (15, 'end_flash_' + TRIAL),
+            (17, 'calibration done'),
+            (20, 'offset_' + TRIAL),
+            # The same trial message repeated is a new trial
+            (30, 'onset_' + TRIAL),
+            (40, 'offset_' + TRIAL),
+            # No offset
+            (50, 'onset_FIX_auditory_0_1_0_0')]
+
+
+@pytest.fixture
+def index():
+    t = np.arange(0, 60, 2)  # Samples every 2 time units
+    msg_times, msgs = zip(*MESSAGES)
+    return t, EpochIndex(t, msg_times, msgs)
+
+def test_parse_markers():
+    msg_times, msgs = zip(*MESSAGES)
+    trials = parse_markers(msg_times, msgs)
+    assert [trial for trial, _ in trials] == [TRIAL, TRIAL]
+    assert trials[0][1] == {'onset': 10, 'start_flash': 12, 'end_flash': 15,
+                            'offset': 20}
+
+def test_trials(index):
+    t, epochs = index
+    assert len(epochs) == 2
+    # Onset to offset, both inclusive
+    assert np.array_equal(t[epochs.slice(0)], [10, 12, 14, 16, 18, 20])
+    assert np.array_equal(t[epochs.slice(1)], np.arange(30, 42, 2))
+
+def test_phases(index):
+    t, epochs = index
+    assert epochs.phases(0) == ['flash']
+    assert epochs.phases(1) == []
+    assert np.array_equal(t[epochs.slice(0, 'flash')], [12, 14])
+
+def test_epoch_views(index):
+    t, epochs = index
+    xy = np.zeros((len(t), 2, 2))
+    t_epoch, xy_epoch = epochs.epoch(0, t, xy, phase='flash')
+    assert np.shares_memory(xy_epoch, xy)
+    assert xy_epoch.shape == (2, 2, 2)
+    assert np.array_equal(t_epoch, [12, 14])
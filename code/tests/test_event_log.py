@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Event log recording and saving
+
+@author: Marcus
+"""
+
+import pandas as pd
+
+from event_log import COLUMNS, EventLog
+
+
+def fill(log, n):
+    for i in range(n):
+        log.record(i / 10, 'MGS' if i % 3 else 'FIX',
+                   ['silence', 'auditory', 'visual'][i % 3], str(25 * (i % 2)),
+                   i, 0.5 * i, -0.5 * i, f'event_{i % 4}', training=i < 2)
+
+def test_grow():
+    log = EventLog(capacity=2)
+    fill(log, 9)
+    assert len(log) == 9
+    assert log.column('trial').tolist() == list(range(9))
+
+def test_rows():
+    log = EventLog()
+    fill(log, 5)
+    rows = log.rows(1, 3)
+    assert rows['task'] == ['MGS', 'MGS']
+    assert rows['noise_condition'] == ['auditory', 'visual']
+    assert rows['event'] == ['event_1', 'event_2']
+    assert rows['training'] == [True, False]
+
+def test_save_round_trip(tmp_path):
+    log = EventLog(capacity=4)
+    fill(log, 10)
+    filename = tmp_path / 'events.tsv'
+    log.save(filename)
+
+    saved = pd.read_csv(filename, sep='\t', index_col=0,
+                        dtype={'noise_level': str})
+    assert list(saved.columns) == COLUMNS
+    expected = log.to_frame()
+    for name in COLUMNS:
+        assert saved[name].tolist() == expected[name].tolist()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Validation and eviction of the noise cache
+
+@author: Marcus
+"""
+
+import json
+import os
+
+import pytest
+
+from noise_cache import NoiseCache, asset_key
+
+
+def fetch(cache, seed, size=1000):
+    ''' Path to the asset of seed, and how many times it was built '''
+    calls = []
+
+    def build(path):
+        calls.append(path)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+    return cache.fetch('test', {'seed': seed}, '.bin', build), len(calls)
+
+@pytest.fixture
+def cache(tmp_path):
+    return NoiseCache(tmp_path, max_bytes=10**6)
+
+def test_key_depends_on_params():
+    assert asset_key('a', {'seed': 1}) == asset_key('a', {'seed': 1})
+    assert asset_key('a', {'seed': 1}) != asset_key('a', {'seed': 2})
+    assert asset_key('a', {'seed': 1}) != asset_key('b', {'seed': 1})
+
+def test_hit(cache):
+    path, n_built = fetch(cache, 1)
+    assert n_built == 1
+    assert fetch(cache, 1) == (path, 0)
+    assert cache.lookup('test', {'seed': 1}, '.bin') == path
+
+def test_changed_asset_is_rebuilt(cache):
+    path, _ = fetch(cache, 1)
+    with open(path, 'r+b') as f:
+        f.write(b'\0' * 10)
+    assert cache.lookup('test', {'seed': 1}, '.bin') is None
+    assert not path.exists()
+    assert fetch(cache, 1)[1] == 1
+
+def test_truncated_asset_is_rebuilt(cache):
+    path, _ = fetch(cache, 1)
+    with open(path, 'r+b') as f:
+        f.truncate(10)
+    assert fetch(cache, 1)[1] == 1
+
+@pytest.mark.parametrize('manifest', ['{"size": 10', '[]',
+                                      '{"size": 1000, "checksum": "x"}'])
+def test_bad_manifest_is_a_miss(cache, manifest):
+    path, _ = fetch(cache, 1)
+    with open(str(path) + '.json', 'w') as f:
+        f.write(manifest)
+    assert cache.lookup('test', {'seed': 1}, '.bin') is None
+    assert not path.exists()
+
+    # Eviction skips (and removes) assets with a bad manifest too
+    path, _ = fetch(cache, 2)
+    with open(str(path) + '.json', 'w') as f:
+        f.write(manifest)
+    cache.evict()
+    assert not path.exists()
+
+def test_evict_least_recently_used(tmp_path):
+    cache = NoiseCache(tmp_path, max_bytes=2500)
+    paths = [fetch(cache, seed)[0] for seed in range(2)]
+
+    # Use the first asset, so that the second is the least recently used
+    manifest_path = str(paths[1]) + '.json'
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest['last_used'] -= 100
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    cache.lookup('test', {'seed': 0}, '.bin')
+
+    new_path, _ = fetch(cache, 2)
+    assert paths[0].exists()
+    assert not paths[1].exists()
+    assert new_path.exists()
+
+def test_new_asset_is_kept_over_budget(tmp_path):
+    cache = NoiseCache(tmp_path, max_bytes=500)
+    path, _ = fetch(cache, 1)
+    assert path.exists()
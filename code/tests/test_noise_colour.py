@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Level of the auditory noise conditions
+
+@author: Marcus
+"""
+
+import wave
+
+import numpy as np
+import pytest
+
+import noise_cache
+import noise_colour
+import noise_helpers as helpers
+
+FS = 48000
+CONDITIONS = [('white', None), ('pink', None), ('brown', None),
+              ('white', (500, 4000)), ('pink', (500, 4000))]
+
+
+def rms(x):
+    return np.sqrt(np.mean(np.asarray(x, dtype=float) ** 2))
+
+@pytest.mark.parametrize('colour, band', CONDITIONS[1:])
+def test_same_rms_as_uniform_noise(colour, band):
+    noise = np.concatenate(list(noise_colour.coloured_noise_chunks(
+        5 * FS, colour, FS, seed=1, band=band)))
+    assert rms(noise) == pytest.approx(noise_colour.UNIFORM_RMS, rel=0.03)
+    # The group delay of the filter is trimmed, so there is no silent start
+    assert rms(noise[:FS // 10]) == pytest.approx(noise_colour.UNIFORM_RMS,
+                                                  rel=0.15)
+
+def test_white_wav_is_uniform_noise(tmp_path):
+    # Built by the parallel white noise generator, the same for any workers
+    cache = noise_cache.NoiseCache(tmp_path / 'cache')
+    filename = noise_cache.auditory_noise_file(cache, FS, 3, seed=1, workers=4)
+    helpers.write_auditory_noise_wav(tmp_path / 'white.wav', FS, 3 * FS, 1,
+                                     ramp_samples=FS)
+    with open(filename, 'rb') as f, open(tmp_path / 'white.wav', 'rb') as g:
+        assert f.read() == g.read()
+
+def test_same_rms_in_wav_files(tmp_path):
+    cache = noise_cache.NoiseCache(tmp_path)
+    levels = []
+    for colour, band in CONDITIONS:
+        filename = noise_cache.auditory_noise_file(cache, FS, 3, seed=1,
+                                                   ramp_duration=0,
+                                                   colour=colour, band=band)
+        with wave.open(str(filename), 'rb') as f:
+            data = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+        levels.append(rms(data) / np.iinfo(np.int16).max)
+
+    # Clipping (about 8% of the samples) costs shaped noise about 0.7 dB
+    assert levels[0] == pytest.approx(noise_colour.UNIFORM_RMS, rel=0.01)
+    assert levels[1:] == pytest.approx([noise_colour.UNIFORM_RMS] * 4, rel=0.1)
+
+def test_spectral_slope():
+    noise = np.concatenate(list(noise_colour.coloured_noise_chunks(
+        10 * FS, 'pink', FS, seed=2)))[:, 0]
+    power = np.abs(np.fft.rfft(noise)) ** 2
+    f = np.fft.rfftfreq(len(noise), 1 / FS)
+    band = (f > 100) & (f < 10000)
+    slope = np.polyfit(np.log10(f[band]), np.log10(power[band]), 1)[0]
+    assert slope == pytest.approx(-1, abs=0.1)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Saccade detection, in batch and on streamed chunks
+
+@author: Marcus
+"""
+
+import numpy as np
+import pytest
+
+import saccade_detection
+from headless import synthetic_gaze
+
+FS = 600
+
+
+@pytest.fixture(scope='module')
+def gaze():
+    xy, onsets = synthetic_gaze(FS * 60, FS)
+    saccades, thresholds = saccade_detection.detect_saccades(xy, FS)
+    return xy, onsets, saccades, thresholds
+
+def stream(xy, chunk_size, thresholds=None):
+    detector = saccade_detection.SaccadeDetector(FS, thresholds=thresholds)
+    parts = [detector.process(xy[i:i + chunk_size])
+             for i in range(0, len(xy), chunk_size)]
+    return detector, np.concatenate(parts + [detector.flush()])
+
+
+# %%
+def test_batch_finds_saccades(gaze):
+    xy, onsets, saccades, _ = gaze
+    for eye in range(2):
+        found = saccades['onset'][saccades['eye'] == eye]
+        # Nearest detected onset of each simulated saccade
+        nearest = np.abs(onsets[:, np.newaxis] - found).min(axis=1)
+        assert np.mean(nearest <= 10) > 0.95
+        assert len(found) <= len(onsets)
+
+@pytest.mark.parametrize('chunk_size', [97, 600, 3000])
+def test_stream_fixed_thresholds_equals_batch(gaze, chunk_size):
+    xy, _, saccades, thresholds = gaze
+    _, streamed = stream(xy, chunk_size, thresholds)
+    assert np.array_equal(streamed, saccades)
+
+@pytest.mark.parametrize('chunk_size', [97, 600, 3000])
+def test_stream_adaptive_converges_to_batch(gaze, chunk_size):
+    xy, _, saccades, thresholds = gaze
+    detector, streamed = stream(xy, chunk_size)
+
+    # Thresholds from the running histograms of all samples
+    for histogram, (peak, onset) in zip(detector._histograms, thresholds):
+        assert histogram.threshold() == pytest.approx((peak, onset), rel=0.01)
+
+    # The same saccades; only the first ones, detected before the thresholds
+    # settled, may start a sample or two earlier
+    assert len(streamed) == len(saccades)
+    for eye in range(2):
+        a = streamed[streamed['eye'] == eye]
+        b = saccades[saccades['eye'] == eye]
+        assert len(a) == len(b)
+        assert np.all(np.abs(a['onset'] - b['onset']) <= 2)
+        assert np.all(np.abs(a['offset'] - b['offset']) <= 2)
+
+def test_velocity_histogram_matches_adaptive_threshold(gaze):
+    xy = gaze[0]
+    v = saccade_detection.velocity(xy[:, 0], FS)
+    histogram = saccade_detection.VelocityHistogram()
+    for chunk in np.array_split(v, 7):
+        histogram.add(chunk)
+    assert (histogram.threshold() ==
+            pytest.approx(saccade_detection.adaptive_threshold(v), rel=0.01))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Trial schedule compilation, saving and replay
+
+@author: Marcus
+"""
+
+import numpy as np
+import pytest
+
+import schedule
+
+CONDITIONS = ['silence', 'auditory', 'visual_25', 'visual_50']
+
+
+def compile_schedule(seed=1, **kwargs):
+    return schedule.compile_schedule(
+        seed, CONDITIONS, n_trials=30, n_trials_practise=5,
+        max_repeated_trials=10, amplitude=np.array([10, 10]),
+        direction=np.arange(0, 360, 45)[1::2],
+        central_fixation_duration=[2, 3.5], memory_delay=[2, 3.5],
+        flash_duration=0.3, wait_response_duration=1,
+        target_duration_feedback=1, long_fixation_duration=60,
+        refresh_rate=60, **kwargs)
+
+def test_blocks():
+    trial_schedule = compile_schedule()
+    training = trial_schedule.blocks('MGS', training=True)
+    mgs = trial_schedule.blocks('MGS')
+    pf = trial_schedule.blocks('FIX')
+    assert len(training) == 1 and len(training[0]) == 5 * 10
+    assert [len(b) for b in mgs] == [40] * 4
+    assert [len(b) for b in pf] == [1] * 4
+    assert sorted(b['noise_condition'][0] for b in mgs) == sorted(CONDITIONS)
+    assert sorted(b['noise_condition'][0] for b in pf) == sorted(CONDITIONS)
+    # Training rounds beyond the table wrap
+    assert np.array_equal(trial_schedule.training_round(12, 5),
+                          trial_schedule.training_round(2, 5))
+
+def test_same_seed_same_schedule():
+    assert np.array_equal(compile_schedule(3).trials, compile_schedule(3).trials)
+    assert not np.array_equal(compile_schedule(3).trials,
+                              compile_schedule(4).trials)
+
+def test_new_seed_is_kept():
+    trial_schedule = compile_schedule(None)
+    assert trial_schedule.seed is not None
+    assert np.array_equal(compile_schedule(trial_schedule.seed).trials,
+                          trial_schedule.trials)
+
+@pytest.mark.parametrize('seed', [7, None])
+def test_save_load(tmp_path, seed):
+    trial_schedule = compile_schedule(seed)
+    trial_schedule.seed = seed
+    filename = tmp_path / 'schedule.tsv'
+    trial_schedule.save(filename)
+
+    loaded = schedule.TrialSchedule.load(filename)
+    assert loaded.seed == seed
+    assert loaded.trials.dtype == trial_schedule.trials.dtype
+    assert np.array_equal(loaded.trials, trial_schedule.trials)
+    assert loaded.n_blocks == trial_schedule.n_blocks
+
+def test_memory_delay_as_original_task():
+    # int(rand * (3.5 - 2) + 2 * 60): 120 frames, or 121 in a third of trials
+    trials = compile_schedule(None).trials
+    mgs = trials['task'] == 'MGS'
+    delays = trials['memory_delay_frames'][mgs]
+    assert set(delays) == {120, 121}
+    assert np.mean(delays == 121) == pytest.approx(1 / 3, abs=0.1)
+    assert np.all(trials['memory_delay_frames'][~mgs] == 0)